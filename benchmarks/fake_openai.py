@@ -0,0 +1,335 @@
+"""
+Fake OpenAI API server for load tests
+
+Answers chat completions, streamed or not, and embeddings the way the OpenAI
+API does, after a configurable delay and with replies of a given number of
+tokens, so llmtool can be driven hard without network access or cost.  It can
+also script tool calls, advertise rate limits in response headers and refuse
+requests with 429s.
+
+    python benchmarks/fake_openai.py [--port 8080] [--latency 0.2] ...
+    OPENAI_BASE_URL=http://127.0.0.1:8080/v1 OPENAI_API_KEY=fake llmtool ...
+
+It prints the URL it listens on as its first line of output.  Replies to the
+chat completion request following a tool call's result always have content, so
+conversations don't loop on tools.
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import http.server
+
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+# word repeated to make replies; each is one token with the cl100k_base encoding
+REPLY_WORD = " load"
+EMBEDDING_DIMENSIONS = 1536
+
+
+@dataclass
+class Config:
+    # seconds before the response starts, as a mean with a jitter of +-50%
+    latency: float = 0.1
+    # tokens in each reply
+    reply_tokens: int = 50
+    # rate at which streamed tokens are sent, 0 for as fast as possible
+    tokens_per_second: float = 0.0
+    # function to call when tools are offered with a user message, if any
+    tool_call: Optional[str] = None
+    tool_arguments: str = "{}"
+    # fraction of requests refused with a 429 regardless of load
+    error_rate: float = 0.0
+    # limits advertised in x-ratelimit headers and enforced with 429s, if set
+    requests_per_minute: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
+    retry_after: float = 0.1
+
+
+class Usage:
+    """Requests and tokens served over the last minute, for rate limit headers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.window: deque[tuple[float, int]] = deque()
+        self.tokens = 0
+
+    def add(self, tokens: int) -> tuple[int, int]:
+        """Records a request, returning requests and tokens in the window"""
+        now = time.monotonic()
+        with self.lock:
+            while self.window and self.window[0][0] < now - 60:
+                self.tokens -= self.window.popleft()[1]
+            self.window.append((now, tokens))
+            self.tokens += tokens
+            return len(self.window), self.tokens
+
+
+def estimate_tokens(body: dict) -> int:
+    return len(json.dumps(body)) // 4
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: Config
+    usage: Usage
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        config = self.config
+
+        prompt_tokens = estimate_tokens(body)
+        requests, tokens = self.usage.add(prompt_tokens + config.reply_tokens)
+        headers = self.rate_limit_headers(requests, tokens)
+        if random.random() < config.error_rate or any(
+            remaining < 0 for remaining in self.remaining(requests, tokens)
+        ):
+            return self.send_error_json(429, "rate_limit_exceeded", headers)
+
+        time.sleep(config.latency * random.uniform(0.5, 1.5))
+        if self.path.endswith("/embeddings"):
+            return self.send_json(self.embeddings(body), headers)
+        if not self.path.endswith("/chat/completions"):
+            return self.send_error_json(404, "not_found", {})
+
+        tool_call = self.scripted_tool_call(body)
+        if body.get("stream"):
+            return self.stream_completion(body, tool_call, prompt_tokens, headers)
+
+        message = {"role": "assistant", "content": None}
+        if tool_call:
+            message["tool_calls"] = [tool_call]
+        else:
+            message["content"] = REPLY_WORD * config.reply_tokens
+        completion_tokens = 0 if tool_call else config.reply_tokens
+        self.send_json(
+            {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": message,
+                        "finish_reason": "tool_calls" if tool_call else "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            },
+            headers,
+        )
+
+    def remaining(self, requests: int, tokens: int) -> list[int]:
+        config = self.config
+        return [
+            limit - used
+            for limit, used in (
+                (config.requests_per_minute, requests),
+                (config.tokens_per_minute, tokens),
+            )
+            if limit
+        ]
+
+    def rate_limit_headers(self, requests: int, tokens: int) -> dict:
+        headers = {}
+        for kind, limit, used in (
+            ("requests", self.config.requests_per_minute, requests),
+            ("tokens", self.config.tokens_per_minute, tokens),
+        ):
+            if limit:
+                headers[f"x-ratelimit-limit-{kind}"] = str(limit)
+                headers[f"x-ratelimit-remaining-{kind}"] = str(max(limit - used, 0))
+        return headers
+
+    def scripted_tool_call(self, body: dict) -> Optional[dict]:
+        messages = body.get("messages") or [{}]
+        if (
+            not self.config.tool_call
+            or not body.get("tools")
+            or body.get("tool_choice") == "none"
+            or messages[-1].get("role") != "user"
+        ):
+            return None
+
+        return {
+            "id": f"call_{random.getrandbits(48):x}",
+            "type": "function",
+            "function": {
+                "name": self.config.tool_call,
+                "arguments": self.config.tool_arguments,
+            },
+        }
+
+    def embeddings(self, body: dict) -> dict:
+        inputs = body["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        tokens = sum(len(text) // 4 for text in inputs)
+        return {
+            "object": "list",
+            "model": body["model"],
+            "data": [
+                {
+                    "object": "embedding",
+                    "index": i,
+                    "embedding": [random.random() for _ in range(EMBEDDING_DIMENSIONS)],
+                }
+                for i in range(len(inputs))
+            ],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def stream_completion(
+        self, body: dict, tool_call: Optional[dict], prompt_tokens: int, headers: dict
+    ):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        if tool_call:
+            deltas = [{"tool_calls": [{"index": 0, **tool_call}]}]
+        else:
+            deltas = [{"content": REPLY_WORD}] * self.config.reply_tokens
+        delay = (
+            1 / self.config.tokens_per_second if self.config.tokens_per_second else 0
+        )
+
+        for i, delta in enumerate(deltas):
+            if delay and i:
+                time.sleep(delay)
+            self.write_event(
+                {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": "fake",
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+                }
+            )
+        if (body.get("stream_options") or {}).get("include_usage"):
+            completion_tokens = 0 if tool_call else len(deltas)
+            self.write_event(
+                {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": "fake",
+                    "choices": [],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                }
+            )
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    def write_event(self, event: dict):
+        self.write_chunk(b"data: " + json.dumps(event).encode() + b"\n\n")
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def send_json(self, payload: dict, headers: dict, status: int = 200):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status: int, code: str, headers: dict):
+        if status == 429:
+            headers = {**headers, "retry-after": str(self.config.retry_after)}
+        self.send_json(
+            {"error": {"message": code, "type": code, "code": code}}, headers, status
+        )
+
+
+class FakeOpenAIServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config: Config, port: int = 0, host: str = "127.0.0.1"):
+        handler = type("Handler", (Handler,), {"config": config, "usage": Usage()})
+        super().__init__((host, port), handler)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    defaults = Config()
+    parser.add_argument("--port", type=int, default=8080, help="0 for any free port")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=defaults.latency,
+        help="mean seconds before each response starts",
+    )
+    parser.add_argument("--reply-tokens", type=int, default=defaults.reply_tokens)
+    parser.add_argument(
+        "--tokens-per-second",
+        type=float,
+        default=defaults.tokens_per_second,
+        help="pace of streamed replies, 0 for no delay",
+    )
+    parser.add_argument(
+        "--tool-call",
+        help="function to call in reply to each user message it is offered with",
+    )
+    parser.add_argument(
+        "--tool-arguments", default=defaults.tool_arguments, help="JSON arguments"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=defaults.error_rate,
+        help="fraction of requests refused with a 429",
+    )
+    parser.add_argument("--rpm", type=int, help="requests per minute to enforce")
+    parser.add_argument("--tpm", type=int, help="tokens per minute to enforce")
+    args = parser.parse_args(argv)
+
+    config = Config(
+        latency=args.latency,
+        reply_tokens=args.reply_tokens,
+        tokens_per_second=args.tokens_per_second,
+        tool_call=args.tool_call,
+        tool_arguments=args.tool_arguments,
+        error_rate=args.error_rate,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+    )
+    server = FakeOpenAIServer(config, args.port)
+    print(server.base_url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,350 @@
+"""
+Microbenchmarks of the hot paths of a turn
+
+Times markdown parsing and highlighting, chat history loading, saving and
+truncation, token counting, message parsing and embedding input truncation on
+generated fixtures of several sizes, reporting the median time per call.
+Results can be saved as JSON and later runs compared against them, exiting
+non-zero when a case has slowed down by more than the tolerance.
+
+    python benchmarks/hot_paths.py [-k FILTER] [--runs N] [--json]
+    python benchmarks/hot_paths.py --save baseline.json
+    python benchmarks/hot_paths.py --compare baseline.json [--tolerance 0.25]
+
+Token counting needs tiktoken's cl100k_base encoding, which it downloads on
+first use.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import platform
+import shutil
+import statistics
+import gc
+
+from typing import Callable, NamedTuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from llmtool.genai import embedding
+from llmtool.genai.history import ChatHistory, count_tokens
+from llmtool.genai.message import (
+    AssistantMessage,
+    ToolCallsMessage,
+    UserMessage,
+    message_from_json,
+)
+from llmtool.interactive_markdown import MarkdownDocument
+
+SEED = 1234
+MARKDOWN_LINES = [1_000, 10_000, 100_000]
+HISTORY_MESSAGES = [10, 100, 1_000, 10_000]
+# time each sample is made to take at least, by calling the case repeatedly
+MIN_SAMPLE_SECONDS = 0.05
+# median slowdown over the baseline tolerated by --compare
+DEFAULT_TOLERANCE = 0.25
+
+WORDS = (
+    "the model reply history token cache request stream function result file "
+    "line code block shell command message conversation summary value index"
+).split()
+
+CODE_SAMPLES = {
+    "python": [
+        "def handle(request):",
+        "    result = process(request.body, retries=3)",
+        "    return {'status': result.status, 'items': list(result)}",
+    ],
+    "javascript": [
+        "const items = await fetch(url).then((r) => r.json());",
+        "items.forEach((item, i) => console.log(`${i}: ${item.name}`));",
+    ],
+    "bash": ['for f in *.log; do grep -c ERROR "$f"; done', "echo done"],
+}
+
+
+class Case(NamedTuple):
+    # returns the function to time
+    setup: Callable[[], Callable[[], object]]
+    # whether setup must run again before every call, for cases which mutate
+    fresh: bool = False
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def generate_markdown(rng: random.Random, lines: int) -> str:
+    """A reply of prose, lists and fenced code blocks in several languages"""
+    out = []
+    while len(out) < lines:
+        kind = rng.random()
+        if kind < 0.5:
+            out.append(sentence(rng, rng.randint(5, 20)))
+        elif kind < 0.7:
+            out.extend(f"- {sentence(rng, rng.randint(3, 8))}" for _ in range(3))
+        else:
+            language = rng.choice(list(CODE_SAMPLES))
+            out.append("```" + language)
+            for _ in range(rng.randint(2, 10)):
+                out.extend(CODE_SAMPLES[language])
+            out.append("```")
+        out.append("")
+
+    out = out[:lines]
+    if sum(line.startswith("```") for line in out) % 2:
+        # cut off inside a code block
+        out[-1] = "```"
+    return "\n".join(out) + "\n"
+
+
+def generate_message_json(rng: random.Random, i: int) -> list[dict]:
+    """A user message and a reply, which every fourth time calls a tool"""
+    messages = [{"role": "user", "content": sentence(rng, rng.randint(5, 40))}]
+    if i % 4 == 3:
+        call_id = f"call_{i}"
+        messages += [
+            {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": call_id,
+                        "type": "function",
+                        "function": {
+                            "name": "get_file_contents",
+                            "arguments": json.dumps({"path": f"src/file_{i}.py"}),
+                        },
+                    }
+                ],
+            },
+            {
+                "role": "tool",
+                "tool_call_id": call_id,
+                "name": "get_file_contents",
+                "content": "\n".join(CODE_SAMPLES["python"] * 10),
+            },
+        ]
+    messages.append(
+        {"role": "assistant", "content": sentence(rng, rng.randint(20, 200))}
+    )
+    return messages
+
+
+def write_history(rng: random.Random, name: str, messages: int):
+    history = ChatHistory(name, "")
+    i = 0
+    while len(history.messages) < messages:
+        for message_json in generate_message_json(rng, i):
+            # token counts are estimated so that writing fixtures needs no tokenizer
+            content = json.dumps(message_json)
+            history.append(message_from_json(message_json), len(content) // 4)
+        i += 1
+    history.save()
+
+
+def build_cases(rng: random.Random) -> dict[str, Case]:
+    cases = {}
+
+    for lines in MARKDOWN_LINES:
+        markdown = generate_markdown(rng, lines)
+        cases[f"markdown.get_nodes/{lines}"] = Case(
+            lambda markdown=markdown: MarkdownDocument(markdown).get_nodes
+        )
+        cases[f"markdown.to_highlighted_string/{lines}"] = Case(
+            lambda markdown=markdown: MarkdownDocument(markdown).to_highlighted_string
+        )
+
+    for messages in HISTORY_MESSAGES:
+        name = f"bench-{messages}"
+        write_history(rng, name, messages)
+        # saving adds to the history, so it gets a copy the other cases don't read
+        save_name = f"bench-save-{messages}"
+        shutil.copy(
+            ChatHistory(name, "").file_path, ChatHistory(save_name, "").file_path
+        )
+
+        def load(name=name):
+            return ChatHistory(name, "").load
+
+        def save(name=save_name):
+            history = ChatHistory(name, "")
+            history.load()
+            reply = AssistantMessage(content=sentence(rng, 50))
+
+            def append_and_save():
+                history.append(reply, 60)
+                history.save()
+
+            return append_and_save
+
+        def truncate(name=name):
+            history = ChatHistory(name, "")
+            history.load()
+            budget = history.get_token_count() // 2
+            return lambda: history.truncate_by_token_count(budget)
+
+        cases[f"history.load/{messages}"] = Case(load, fresh=True)
+        cases[f"history.save/{messages}"] = Case(save)
+        cases[f"history.truncate_by_token_count/{messages}"] = Case(
+            truncate, fresh=True
+        )
+
+    for words in [20, 2_000]:
+        message = UserMessage(content=sentence(rng, words))
+        cases[f"count_tokens/{words}_words"] = Case(
+            lambda message=message: lambda: count_tokens(message)
+        )
+    tool_calls = ToolCallsMessage(
+        tool_calls=generate_message_json(rng, 3)[1]["tool_calls"]
+    )
+    cases["count_tokens/tool_calls"] = Case(lambda: lambda: count_tokens(tool_calls))
+
+    message_jsons = [m for i in range(250) for m in generate_message_json(rng, i)]
+    cases[f"message_from_json/{len(message_jsons)}"] = Case(
+        lambda: lambda: [message_from_json(m) for m in message_jsons]
+    )
+
+    # under the byte limit, just over it, and long enough to be cut
+    for words in [1_000, 2_000, 20_000]:
+        text = sentence(rng, words)
+        cases[f"embedding.truncate/{words}_words"] = Case(
+            lambda text=text: lambda: embedding.truncate(text)
+        )
+
+    return cases
+
+
+def measure(case: Case, runs: int) -> dict:
+    """Times a case, returning statistics of its time per call in microseconds"""
+    # collections triggered by earlier cases' garbage would land in random samples
+    gc.collect()
+    gc.disable()
+    try:
+        samples, loops = _sample(case, runs)
+    finally:
+        gc.enable()
+
+    per_call = [sample / loops * 1e6 for sample in samples]
+    return {
+        "median_us": round(statistics.median(per_call), 3),
+        "min_us": round(min(per_call), 3),
+        "runs": len(per_call),
+        "loops": loops,
+    }
+
+
+def _sample(case: Case, runs: int) -> tuple[list[float], int]:
+    if case.fresh:
+        samples = []
+        for _ in range(runs):
+            function = case.setup()
+            start = time.perf_counter()
+            function()
+            samples.append(time.perf_counter() - start)
+        loops = 1
+    else:
+        function = case.setup()
+        # calibrate, so that fast cases are timed over many calls
+        loops = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(loops):
+                function()
+            elapsed = time.perf_counter() - start
+            if elapsed >= MIN_SAMPLE_SECONDS:
+                break
+            loops *= 10 if elapsed < MIN_SAMPLE_SECONDS / 10 else 2
+
+        samples = [elapsed]
+        for _ in range(runs - 1):
+            start = time.perf_counter()
+            for _ in range(loops):
+                function()
+            samples.append(time.perf_counter() - start)
+
+    return samples, loops
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Prints each case's change against the baseline, returning regressions"""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:45} {result['median_us']:12.1f}us  (new)")
+            continue
+
+        ratio = result["median_us"] / before["median_us"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressions.append(
+                f"{name}: {before['median_us']:.1f}us -> "
+                f"{result['median_us']:.1f}us ({ratio:.2f}x)"
+            )
+        print(
+            f"{name:45} {result['median_us']:12.1f}us  "
+            f"{(ratio - 1) * 100:+6.1f}%{flag}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-k", "--filter", help="only run cases containing this")
+    parser.add_argument("--runs", type=int, default=7, help="samples per case")
+    parser.add_argument("--json", help="print results as JSON", action="store_true")
+    parser.add_argument("--save", metavar="PATH", help="write results as JSON")
+    parser.add_argument(
+        "--compare", metavar="PATH", help="compare against results saved earlier"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="slowdown of the median allowed by --compare, as a fraction",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as home:
+        os.makedirs(os.path.join(home, "tmp"))
+        os.environ["HOME"] = home
+
+        cases = build_cases(random.Random(SEED))
+        for name, case in cases.items():
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = measure(case, args.runs)
+            if not args.json and not args.compare:
+                print(f"{name:45} {results[name]['median_us']:12.1f}us")
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("FAIL " + regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Load test of the agent loop against a local fake OpenAI server
+
+Starts benchmarks/fake_openai.py, then drives many conversations at once, each
+sending a series of messages through Agent.send_user_message (or the streaming
+variant, or the CLI in a subprocess per message).  Reports throughput, latency
+percentiles per message and resident memory, whose growth over long
+conversations shows leaks in the history and request paths.
+
+    python benchmarks/load_test.py [--conversations 16] [--messages 20]
+        [--mode agent|stream|cli] [--latency 0.1] [--tool-call NAME]
+        [--error-rate 0.05] [--json]
+
+Counting tokens needs tiktoken's cl100k_base encoding, which it downloads on
+first use.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import concurrent.futures
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FAKE_SERVER = os.path.join(ROOT, "benchmarks", "fake_openai.py")
+MODEL = "gpt-4-1106-preview"
+# seconds between samples of resident memory
+RSS_SAMPLE_SECONDS = 0.2
+
+
+def rss_bytes() -> int:
+    """Current resident memory of this process"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # the peak is the best other platforms offer, in KB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentile(samples: list[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class MemorySampler(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.samples: list[int] = [rss_bytes()]
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(RSS_SAMPLE_SECONDS):
+            self.samples.append(rss_bytes())
+
+    def stop(self) -> dict:
+        self.stopped.set()
+        self.join()
+        self.samples.append(rss_bytes())
+        mb = 1024 * 1024
+        return {
+            "start_mb": round(self.samples[0] / mb, 1),
+            "peak_mb": round(max(self.samples) / mb, 1),
+            "end_mb": round(self.samples[-1] / mb, 1),
+        }
+
+
+def start_server(args) -> tuple[subprocess.Popen, str]:
+    command = [
+        sys.executable,
+        FAKE_SERVER,
+        "--port=0",
+        f"--latency={args.latency}",
+        f"--reply-tokens={args.reply_tokens}",
+        f"--tokens-per-second={args.tokens_per_second}",
+        f"--error-rate={args.error_rate}",
+    ]
+    if args.tool_call:
+        command += [f"--tool-call={args.tool_call}"]
+        command += [f"--tool-arguments={args.tool_arguments}"]
+    if args.rpm:
+        command.append(f"--rpm={args.rpm}")
+    if args.tpm:
+        command.append(f"--tpm={args.tpm}")
+
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    return server, server.stdout.readline().strip()
+
+
+def message_text(conversation: int, i: int) -> str:
+    return f"Message {i} of conversation {conversation}: " + "lorem ipsum " * 20
+
+
+def run_agent_conversation(conversation: int, args, latencies: list[float]):
+    from llmtool.genai.agent import Agent
+
+    agent = Agent(
+        args.model,
+        f"load-{conversation}",
+        args.threshold,
+        not args.tool_call,
+        logging.getLogger(),
+        tools=args.tool_call,
+    )
+    for i in range(args.messages):
+        start = time.perf_counter()
+        if args.mode == "stream":
+            "".join(agent.stream_user_message(message_text(conversation, i)))
+        else:
+            agent.send_user_message(message_text(conversation, i))
+        latencies.append(time.perf_counter() - start)
+
+
+def run_cli_conversation(conversation: int, args, latencies: list[float]):
+    for i in range(args.messages):
+        command = [sys.executable, "-m", "llmtool", "--no-daemon", "--skip-styling"]
+        command += ["-m", args.model, "-c", f"load-{conversation}"]
+        command += ["-t", str(args.threshold)]
+        if args.tool_call:
+            command += ["--tools", args.tool_call]
+        else:
+            command.append("--disable-functions")
+
+        start = time.perf_counter()
+        subprocess.run(
+            command + [message_text(conversation, i)],
+            cwd=ROOT,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        latencies.append(time.perf_counter() - start)
+
+
+def warm_up():
+    """Loads the openai client and tokenizer, so the first messages aren't outliers"""
+    import openai
+
+    from llmtool.genai import tokens
+
+    tokens.get_encoding()
+
+
+def run_load(args) -> dict:
+    if args.mode == "cli":
+        run_conversation = run_cli_conversation
+    else:
+        warm_up()
+        run_conversation = run_agent_conversation
+    latencies: list[float] = []
+    errors = []
+    memory = MemorySampler()
+    memory.start()
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.conversations) as executor:
+        futures = [
+            executor.submit(run_conversation, conversation, args, latencies)
+            for conversation in range(args.conversations)
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                errors.append(repr(future.exception()))
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "mode": args.mode,
+        "conversations": args.conversations,
+        "messages": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 2),
+        "messages_per_second": round(len(latencies) / elapsed, 1),
+        "rss": memory.stop(),
+    }
+    if latencies:
+        result["latency_ms"] = {
+            f"p{p}": round(percentile(latencies, p) * 1000, 1) for p in (50, 95, 99)
+        }
+        result["latency_ms"]["max"] = round(max(latencies) * 1000, 1)
+    if args.mode == "cli":
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        result["rss"]["child_peak_mb"] = round(children / 1024, 1)
+    return result
+
+
+def print_result(result: dict):
+    print(
+        f"{result['messages']} messages in {result['conversations']} conversations "
+        f"({result['mode']}) in {result['seconds']}s: "
+        f"{result['messages_per_second']} messages/s"
+    )
+    if "latency_ms" in result:
+        print(
+            "latency "
+            + ", ".join(f"{k} {v:.1f}ms" for k, v in result["latency_ms"].items())
+        )
+    print("rss " + ", ".join(f"{k} {v}" for k, v in result["rss"].items()))
+    for error in result["errors"]:
+        print("ERROR " + error, file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--conversations", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=20, help="per conversation")
+    parser.add_argument(
+        "--mode",
+        choices=["agent", "stream", "cli"],
+        default="agent",
+        help="send_user_message, stream_user_message, or the CLI per message",
+    )
+    parser.add_argument("--model", default=MODEL)
+    parser.add_argument("-t", "--threshold", type=int, default=8000)
+    parser.add_argument(
+        "--base-url", help="use a server already running rather than starting one"
+    )
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--reply-tokens", type=int, default=50)
+    parser.add_argument("--tokens-per-second", type=float, default=0.0)
+    parser.add_argument(
+        "--tool-call", help="function the model calls for every user message"
+    )
+    parser.add_argument("--tool-arguments", default="{}")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rpm", type=int)
+    parser.add_argument("--tpm", type=int)
+    parser.add_argument("--json", help="print results as JSON", action="store_true")
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        server, base_url = start_server(args)
+
+    try:
+        with tempfile.TemporaryDirectory() as home:
+            os.makedirs(os.path.join(home, "tmp"))
+            # histories and rate limit state are kept apart from the user's
+            os.environ.update(
+                HOME=home, OPENAI_BASE_URL=base_url, OPENAI_API_KEY="fake"
+            )
+            result = run_load(args)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_result(result)
+    sys.exit(1 if result["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
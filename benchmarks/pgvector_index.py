@@ -0,0 +1,195 @@
+"""
+Recall and latency benchmark for pgvector indexes
+
+Loads a generated corpus of clustered unit vectors into a scratch table.  Then,
+for each index configuration, it builds the index the way `llmtool index` does
+and runs queries against it, reporting recall@10 against exact search along
+with p50/p99 query latency.  Needs postgres with the vector extension, e.g.
+
+    docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=bench pgvector/pgvector:pg16
+    python benchmarks/pgvector_index.py \\
+        --dsn "host=localhost user=postgres password=bench"
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import psycopg2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from llmtool.genai.documents import build_index_sql, set_search_parameters
+
+TABLE = "bench_documents"
+K = 10
+COPY_BATCH_ROWS = 2000
+
+# (method, build options, search parameter name, values of it to try)
+CONFIGURATIONS = [
+    ("hnsw", {"m": 16, "ef_construction": 64}, "ef_search", [20, 40, 100]),
+    ("ivfflat", {}, "probes", [1, 5, 10, 20]),
+]
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def generate_corpus(
+    rng: np.random.Generator, rows: int, dim: int, clusters: int
+) -> np.ndarray:
+    """Unit vectors scattered around random centers, like real embeddings"""
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32)
+    assignments = rng.integers(0, clusters, rows)
+    noise = rng.standard_normal((rows, dim), dtype=np.float32)
+    return normalize(centers[assignments] + noise * 0.5)
+
+
+def generate_queries(
+    rng: np.random.Generator, corpus: np.ndarray, count: int
+) -> np.ndarray:
+    picks = corpus[rng.integers(0, len(corpus), count)]
+    noise = rng.standard_normal(picks.shape, dtype=np.float32)
+    return normalize(picks + noise * 0.1)
+
+
+def exact_top_k(corpus: np.ndarray, queries: np.ndarray) -> list[set[int]]:
+    scores = queries @ corpus.T
+    top = np.argpartition(-scores, K - 1, axis=1)[:, :K]
+    return [set(row.tolist()) for row in top]
+
+
+def vector_literal(vector: np.ndarray) -> str:
+    return "[" + ",".join(f"{v:.6f}" for v in vector) + "]"
+
+
+def load_corpus(conn, corpus: np.ndarray):
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE EXTENSION IF NOT EXISTS vector;
+            DROP TABLE IF EXISTS {TABLE};
+            CREATE TABLE {TABLE} (
+                id INTEGER PRIMARY KEY,
+                embedding VECTOR({corpus.shape[1]})
+            );
+        """)
+        for start in range(0, len(corpus), COPY_BATCH_ROWS):
+            rows = io.StringIO()
+            for i in range(start, min(start + COPY_BATCH_ROWS, len(corpus))):
+                rows.write(f"{i}\t{vector_literal(corpus[i])}\n")
+            rows.seek(0)
+            cur.copy_expert(f"COPY {TABLE} (id, embedding) FROM STDIN", rows)
+    conn.commit()
+
+
+def percentile(values: list[float], p: float) -> float:
+    return float(np.percentile(values, p))
+
+
+def run_queries(conn, queries: np.ndarray, parameters: dict) -> tuple[list, list]:
+    results = []
+    latencies = []
+    with conn.cursor() as cur:
+        set_search_parameters(cur, **parameters)
+        for query in queries:
+            literal = vector_literal(query)
+            start = time.perf_counter()
+            cur.execute(
+                f"SELECT id FROM {TABLE} ORDER BY embedding <=> %s::vector LIMIT %s",
+                (literal, K),
+            )
+            rows = cur.fetchall()
+            latencies.append((time.perf_counter() - start) * 1000)
+            results.append({row[0] for row in rows})
+    conn.rollback()
+
+    return results, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--dsn",
+        type=str,
+        help="postgres DSN",
+        default="dbname=genai_documents user=genai",
+    )
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="print results as JSON", action="store_true")
+    parser.add_argument(
+        "--keep", help="keep the benchmark table afterwards", action="store_true"
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    corpus = generate_corpus(rng, args.rows, args.dim, args.clusters)
+    queries = generate_queries(rng, corpus, args.queries)
+    expected = exact_top_k(corpus, queries)
+
+    conn = psycopg2.connect(args.dsn)
+    print(f"loading {args.rows} x {args.dim} corpus", file=sys.stderr)
+    load_corpus(conn, corpus)
+
+    report = []
+    try:
+        for method, options, parameter, values in CONFIGURATIONS:
+            if method == "ivfflat":
+                options = {"lists": max(args.rows // 1000, 10)}
+
+            start = time.perf_counter()
+            with conn.cursor() as cur:
+                cur.execute(build_index_sql(TABLE, method, **options))
+                cur.execute(f"SELECT pg_relation_size('{TABLE}_embedding_idx')")
+                (index_bytes,) = cur.fetchone()
+            conn.commit()
+            build_seconds = time.perf_counter() - start
+
+            for value in values:
+                results, latencies = run_queries(conn, queries, {parameter: value})
+                recall = np.mean([len(r & e) / K for r, e in zip(results, expected)])
+                report.append(
+                    {
+                        "method": method,
+                        "options": options,
+                        parameter: value,
+                        "build_s": round(build_seconds, 2),
+                        "index_mb": round(index_bytes / 2**20, 1),
+                        f"recall@{K}": round(float(recall), 4),
+                        "p50_ms": round(percentile(latencies, 50), 2),
+                        "p99_ms": round(percentile(latencies, 99), 2),
+                    }
+                )
+    finally:
+        if not args.keep:
+            with conn.cursor() as cur:
+                cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+            conn.commit()
+        conn.close()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    for row in report:
+        setting = " ".join(f"{k}={v}" for k, v in row["options"].items())
+        search = "ef_search" if row["method"] == "hnsw" else "probes"
+        print(
+            f"{row['method']:8} {setting:28} {search}={row[search]:<4} "
+            f"recall@{K} {row[f'recall@{K}']:.3f}  p50 {row['p50_ms']:6.2f}ms  "
+            f"p99 {row['p99_ms']:6.2f}ms  build {row['build_s']:.1f}s  "
+            f"{row['index_mb']}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
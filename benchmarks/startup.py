@@ -0,0 +1,163 @@
+"""
+Cold-start benchmark for the llmtool CLI
+
+Runs each command in a fresh interpreter against a generated conversation and
+reports its median wall time along with the slowest imports from -X importtime.
+Exits non-zero if a command goes over its time budget or imports a module it
+has no use for, so it can guard startup time in CI.
+
+    python benchmarks/startup.py [--runs N] [--budget-scale X] [--json]
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from llmtool.genai.history import ChatHistory
+from llmtool.genai.message import UserMessage, AssistantMessage
+
+CONVERSATION = "startup-bench"
+HISTORY_MESSAGES = 2000
+
+# modules which are slow to import and only needed when talking to the model,
+# the document database or highlighting code
+HEAVY_MODULES = ["openai", "tiktoken", "psycopg2", "pygments", "numpy"]
+
+# name: (argv, time budget in ms, modules which must not be imported)
+COMMANDS = {
+    "help": (["--help"], 150, HEAVY_MODULES),
+    "token-count": (["-n", "-c", CONVERSATION], 150, HEAVY_MODULES),
+    "retrieve-last": (
+        ["-r", "-c", CONVERSATION, "--skip-styling"],
+        150,
+        HEAVY_MODULES,
+    ),
+}
+
+
+def write_history(home: str):
+    os.makedirs(os.path.join(home, "tmp"), exist_ok=True)
+    os.environ["HOME"] = home
+
+    history = ChatHistory(CONVERSATION, "")
+    for i in range(HISTORY_MESSAGES // 2):
+        # token counts are given so that generating the fixture needs no tokenizer
+        history.append(UserMessage(content=f"question {i}"), 3)
+        history.append(AssistantMessage(content=f"answer {i} " * 50), 100)
+    history.save()
+
+
+def run(argv: list[str], env: dict) -> tuple[float, str]:
+    """Runs llmtool once, returning wall time in seconds and importtime output"""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "llmtool"] + argv,
+        env=env,
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+
+    if result.returncode != 0:
+        raise RuntimeError(f"llmtool {' '.join(argv)} failed:\n{result.stderr}")
+
+    return elapsed, result.stderr
+
+
+def parse_importtime(output: str) -> dict[str, tuple[int, int]]:
+    """
+    Returns the cumulative import time in microseconds of each module, along with
+    its depth in the import tree
+    """
+    imports = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # names are indented by two spaces per level, after one separating space
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports[name.strip()] = (int(cumulative), depth)
+
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--budget-scale",
+        type=float,
+        default=1.0,
+        help="multiply time budgets, for slow machines",
+    )
+    parser.add_argument("--top", type=int, default=5, help="slowest imports to show")
+    parser.add_argument("--json", help="print results as JSON", action="store_true")
+    args = parser.parse_args()
+
+    failures = []
+    results = {}
+    with tempfile.TemporaryDirectory() as home:
+        write_history(home)
+        env = dict(os.environ, HOME=home, PYTHONDONTWRITEBYTECODE="1")
+
+        # warm the filesystem cache so that the first run isn't an outlier
+        run(["--help"], env)
+
+        for name, (argv, budget_ms, forbidden) in COMMANDS.items():
+            times = []
+            for _ in range(args.runs):
+                elapsed, importtime = run(argv, env)
+                times.append(elapsed * 1000)
+
+            imports = parse_importtime(importtime)
+            top_level = {m: t for m, (t, depth) in imports.items() if depth == 0}
+            slowest = sorted(top_level.items(), key=lambda i: i[1], reverse=True)
+            median = statistics.median(times)
+            budget = budget_ms * args.budget_scale
+
+            results[name] = {
+                "median_ms": round(median, 1),
+                "min_ms": round(min(times), 1),
+                "max_ms": round(max(times), 1),
+                "budget_ms": budget,
+                "slowest_imports_ms": {
+                    m: round(t / 1000, 1) for m, t in slowest[: args.top]
+                },
+            }
+
+            if median > budget:
+                failures.append(f"{name}: median {median:.1f}ms over {budget:.0f}ms")
+            for module in forbidden:
+                if module in imports:
+                    failures.append(f"{name}: imports {module}")
+
+    if args.json:
+        print(json.dumps({"results": results, "failures": failures}, indent=2))
+    else:
+        for name, result in results.items():
+            print(
+                f"{name:15} median {result['median_ms']:7.1f}ms "
+                f"(min {result['min_ms']:.1f}, max {result['max_ms']:.1f}, "
+                f"budget {result['budget_ms']:.0f})"
+            )
+            for module, ms in result["slowest_imports_ms"].items():
+                print(f"{'':17}{module:30} {ms:6.1f}ms")
+        for failure in failures:
+            print("FAIL " + failure, file=sys.stderr)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,26 @@
+import os
 import sys
+import atexit
 import argparse
+import importlib
 import logging
 
+from typing import Iterable, Union
+
 from llmtool.interactive_markdown import (
     MarkdownDocument,
+    MarkdownParser,
     CodeBlock,
-    SyntaxHighlightingError,
+    SyntaxError as MarkdownSyntaxError,
+    highlight_code_blocks,
+    resolve_language,
 )
 
+from llmtool import spans
 from llmtool.patch import apply_patch
 
 from llmtool.genai.agent import Agent
+from llmtool.genai.functions import UnknownFunction
 
 
 def get_message(cli_args) -> str:
@@ -26,13 +36,24 @@ def get_message(cli_args) -> str:
 
 class ReplyPresenter:
     def __init__(
-        self, reply: str, interactive: bool = False, skip_styling: bool = False
+        self,
+        reply: Union[str, Iterable[str]],
+        interactive: bool = False,
+        skip_styling: bool = False,
     ):
         self.reply = reply
         self.interactive = interactive
         self.skip_styling = skip_styling
 
     def present(self):
+        if not isinstance(self.reply, str):
+            if not self.interactive:
+                self.present_stream()
+                return
+
+            # interactive mode needs whole code blocks to act on
+            self.reply = "".join(self.reply)
+
         if self.interactive:
             self.present_interactive()
         else:
@@ -42,17 +63,21 @@ class ReplyPresenter:
                 self.present_raw()
 
     def present_interactive(self):
-        doc = MarkdownDocument(self.reply)
-        for node in doc.get_nodes():
+        nodes = MarkdownDocument(self.reply).get_nodes()
+        highlighted = iter(
+            highlight_code_blocks([n for n in nodes if isinstance(n, CodeBlock)])
+        )
+        for node in nodes:
             if isinstance(node, CodeBlock):
-                sys.stdout.write(node.to_highlighted_string())
+                sys.stdout.write(next(highlighted))
 
-                if node.language == "diff":
+                language = resolve_language(node.language)
+                if language == "diff":
                     response = input("apply diff? (y/n)")
                     if response.strip() == "y":
                         apply_patch(node.code)
 
-                if node.language == "sh":
+                if language == "bash":
                     response = input("execute shell command? (y/n)")
                     if response.strip() == "y":
                         os.system(node.code)
@@ -60,18 +85,102 @@ class ReplyPresenter:
                 sys.stdout.write(node.raw())
 
     def present_highlighted(self):
-        markdown_document = MarkdownDocument(self.reply)
+        """Prints the reply with highlighted code blocks, or raw if it won't parse"""
         try:
-            print(markdown_document.to_highlighted_string())
-        except SyntaxHighlightingError as e:
-            print("Syntax Highlighting Error: " + str(e), file=sys.stderr)
+            highlighted = MarkdownDocument(self.reply).to_highlighted_string()
+        except MarkdownSyntaxError as e:
+            print("Markdown Syntax Error: " + str(e), file=sys.stderr)
             self.present_raw()
+            return
+
+        print(highlighted)
 
     def present_raw(self):
         print(self.reply)
 
+    def present_stream(self):
+        if sys.stdout.isatty() and not self.skip_styling:
+            self.present_stream_highlighted()
+        else:
+            self.present_stream_raw()
+
+    def present_stream_raw(self):
+        """Writes reply deltas to stdout as they arrive"""
+        parts = []
+        for delta in self.reply:
+            parts.append(delta)
+            sys.stdout.write(delta)
+            sys.stdout.flush()
+
+        sys.stdout.write("\n")
+        self.reply = "".join(parts)
+
+    def present_stream_highlighted(self):
+        """
+        Writes reply lines as they complete, highlighting each code block once its
+        closing fence arrives.  Falls back to raw output on a markdown syntax error.
+        """
+        parts = []
+        parser = MarkdownParser()
+
+        def write_nodes(nodes):
+            for node in nodes:
+                if isinstance(node, CodeBlock):
+                    sys.stdout.write(node.to_highlighted_string())
+                else:
+                    sys.stdout.write(node.raw() + "\n")
+            sys.stdout.flush()
+
+        deltas = iter(self.reply)
+        try:
+            for delta in deltas:
+                parts.append(delta)
+                write_nodes(parser.feed(delta))
+            write_nodes(parser.close())
+        except MarkdownSyntaxError as e:
+            print("Markdown Syntax Error: " + str(e), file=sys.stderr)
+            sys.stdout.write(parser.flush_raw())
+            for delta in deltas:
+                parts.append(delta)
+                sys.stdout.write(delta)
+                sys.stdout.flush()
+            sys.stdout.write("\n")
+
+        self.reply = "".join(parts)
+
+
+# subcommands map to the module implementing them, which is only imported when
+# the subcommand is run
+SUBCOMMANDS = {
+    "serve": "llmtool.daemon",
+    "ingest": "llmtool.ingest",
+    "index": "llmtool.index",
+    "batch": "llmtool.batch",
+    "search": "llmtool.search",
+}
+
+
+def connect_to_daemon():
+    """Returns a client for the llmtool daemon if one is running"""
+    from llmtool import daemon
+
+    path = daemon.socket_path()
+    if not os.path.exists(path):
+        return None
+
+    try:
+        return daemon.Client(path)
+    except OSError:
+        print("Failed to connect to llmtool daemon at " + path, file=sys.stderr)
+        return None
+
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        module = importlib.import_module(SUBCOMMANDS[sys.argv[1]])
+        module.main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description="")
     parser.add_argument(
         "-s",
@@ -93,6 +202,19 @@ def main():
         help="maximum token count threshold",
         default=8000,
     )
+    parser.add_argument(
+        "--tools",
+        type=str,
+        help="functions offered to GPT: all, auto, or a list of names and profiles "
+        "(files, shell, notes)",
+        default=None,
+    )
+    parser.add_argument(
+        "--summarize",
+        help="summarize old messages instead of dropping them at the threshold",
+        required=False,
+        action="store_true",
+    )
     parser.add_argument(
         "-i",
         "--interactive",
@@ -127,6 +249,42 @@ def main():
         required=False,
         action="store_true",
     )
+    parser.add_argument(
+        "--stream",
+        help="print the reply as it is generated",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache",
+        help="reuse replies to identical requests from the response cache",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        help="seconds a cached reply is reused for",
+        default=None,
+    )
+    parser.add_argument(
+        "--clear-cache",
+        help="drop cached replies for the model and exit",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        help="don't forward messages to a running llmtool daemon",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile",
+        help="print the time spent in each phase to stderr; implies --no-daemon",
+        required=False,
+        action="store_true",
+    )
     parser.add_argument(
         "-v", "--verbose", help="verbose logging", required=False, action="store_true"
     )
@@ -137,25 +295,71 @@ def main():
     logger.addHandler(logging.StreamHandler(sys.stderr))
     if args.verbose:
         logger.setLevel(logging.DEBUG)
+    if args.profile:
+        spans.enable()
+        atexit.register(spans.report)
 
-    agent = Agent(
-        args.model, args.conversation, args.threshold, args.disable_functions, logger
-    )
+    try:
+        agent = Agent(
+            args.model,
+            args.conversation,
+            args.threshold,
+            args.disable_functions,
+            logger,
+            summarize=args.summarize,
+            tools=args.tools,
+        )
+    except UnknownFunction as e:
+        parser.error(f"--tools: {e}")
 
     if args.retrieve_last:
-        agent.load_chat_history()
-        message = agent.chat_history.messages[-1]
+        # tool calls have no content to show
+        message = agent.chat_history.last_message(with_content=True)
+        if message is None:
+            sys.exit("No messages in this conversation")
         presenter = ReplyPresenter(message.content, args.interactive, args.skip_styling)
         presenter.present()
-    if args.get_token_count:
-        agent.load_chat_history()
-        print(agent.chat_history.get_token_count())
+    elif args.get_token_count:
+        print(agent.chat_history.load_token_count())
+    elif args.clear_cache:
+        from llmtool.genai.response_cache import ResponseCache
+
+        count = ResponseCache().invalidate_model(args.model)
+        print(f"Dropped {count} cached replies for {args.model}")
     else:
         message_text = get_message(args)
 
-        # Send message to chat GPT
-        reply = agent.send_user_message(message_text)
-        presenter = ReplyPresenter(reply.content, args.interactive)
+        # phases run in the daemon can't be timed from here
+        client = None if args.no_daemon or args.profile else connect_to_daemon()
+        if client is not None:
+            reply = client.send_user_message(
+                {
+                    "conversation": args.conversation,
+                    "model": args.model,
+                    "threshold": args.threshold,
+                    "disable_functions": args.disable_functions,
+                    "message": message_text,
+                    "stream": args.stream,
+                    "cache": args.cache,
+                    "cache_ttl": args.cache_ttl,
+                    "summarize": args.summarize,
+                    "tools": args.tools,
+                }
+            )
+            if not args.stream:
+                reply = "".join(reply)
+        else:
+            if args.cache:
+                from llmtool.genai.response_cache import DEFAULT_TTL, ResponseCache
+
+                agent.response_cache = ResponseCache(args.cache_ttl or DEFAULT_TTL)
+
+            # Send message to chat GPT
+            if args.stream:
+                reply = agent.stream_user_message(message_text)
+            else:
+                reply = agent.send_user_message(message_text).content
+        presenter = ReplyPresenter(reply, args.interactive)
         presenter.present()
 
 
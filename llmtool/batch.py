@@ -0,0 +1,222 @@
+"""
+Running many prompts from a JSONL file
+
+    llmtool batch input.jsonl -o output.jsonl [--concurrency N] [--rpm N] [--tpm N]
+
+Each input line is an object with a "prompt", and optionally a "conversation"
+to continue, a "model" and a "system" prompt.  Prompts without a conversation
+are answered without reading or writing any history.
+
+Results are appended to the output as they complete, one object per line with
+the zero-based line number of its prompt as "index" and either a "reply" or an
+"error".  Prompts whose index already has a reply in the output are skipped,
+so an interrupted batch picks up where it left off when run again.
+"""
+
+import os
+import sys
+import json
+import asyncio
+import logging
+import argparse
+import functools
+
+from typing import Iterator, Optional
+
+DEFAULT_MODEL = "gpt-4-1106-preview"
+DEFAULT_CONCURRENCY = 8
+DEFAULT_THRESHOLD = 8000
+
+
+def completed_indices(path: str) -> set[int]:
+    """Indices with a reply in an existing output file"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+
+    with open(path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # torn write from an interrupted run
+                continue
+            if "reply" in result:
+                done.add(result["index"])
+
+    return done
+
+
+def read_prompts(path: str, skip: set[int]) -> Iterator[tuple[int, str]]:
+    """Yields (index, line) pairs for the input lines not yet done"""
+    with open(path) if path != "-" else sys.stdin as f:
+        for index, line in enumerate(f):
+            if index in skip or not line.strip():
+                continue
+            yield index, line
+
+
+def open_output(path: str):
+    """Opens the output for appending, ending any line torn by a crash"""
+    output = open(path, "a")
+    if output.tell() > 0:
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                output.write("\n")
+    return output
+
+
+class Batch:
+    def __init__(self, args: argparse.Namespace, output, logger: logging.Logger):
+        from llmtool.genai.documents import DbDelegator
+        from llmtool.genai.rate_limit import RateLimiter
+        from llmtool.genai.scheduler import make_client
+
+        self.args = args
+        # one client, so that connections are pooled across prompts
+        self.client = make_client(async_=True)
+        self.output = output
+        self.logger = logger
+        self.rate_limiter = RateLimiter(args.rpm, args.tpm)
+        # shared by every prompt, so the database is connected to once
+        self.documents_db = DbDelegator()
+        # agents of named conversations, which must be shared so turns are ordered
+        self.agents = {}
+        self.completed = 0
+        self.failed = 0
+
+    @functools.cached_property
+    def function_handler(self):
+        """Functions for every agent, so their tools run in one pool of threads"""
+        from llmtool.genai.functions import get_default_handler
+
+        return get_default_handler(self.documents_db)
+
+    def agent_for(self, prompt: dict):
+        from llmtool.genai.async_agent import AsyncAgent
+        from llmtool.genai.history import EphemeralChatHistory
+        from llmtool.genai.prompts import DEFAULT as DEFAULT_PROMPT
+
+        model = prompt.get("model", self.args.model)
+        system = prompt.get("system", DEFAULT_PROMPT)
+        conversation = prompt.get("conversation")
+
+        def build(chat_history=None):
+            agent = AsyncAgent(
+                model,
+                conversation or "batch",
+                self.args.threshold,
+                not self.args.functions,
+                self.logger,
+                client=self.client,
+                documents_db=self.documents_db,
+                prompt=system,
+                chat_history=chat_history,
+                rate_limiter=self.rate_limiter,
+            )
+            if self.args.functions:
+                agent.function_handler = self.function_handler
+            return agent
+
+        if conversation is None:
+            return build(EphemeralChatHistory("batch", system))
+
+        key = (conversation, model, system)
+        if key not in self.agents:
+            self.agents[key] = build()
+        return self.agents[key]
+
+    def write(self, result: dict):
+        self.output.write(json.dumps(result) + "\n")
+        self.output.flush()
+
+    async def run_prompt(self, index: int, line: str):
+        try:
+            prompt = json.loads(line)
+            reply = await self.agent_for(prompt).send_user_message(prompt["prompt"])
+        except Exception as e:
+            self.failed += 1
+            self.logger.warning(f"prompt {index} failed: {e}")
+            self.write({"index": index, "error": str(e)})
+            return
+
+        self.completed += 1
+        self.write({"index": index, "reply": reply.content})
+
+    async def worker(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            await self.run_prompt(*item)
+
+    async def run(self, prompts: Iterator[tuple[int, str]]):
+        # the input is read as it is consumed, so only a few prompts are held at once
+        queue: asyncio.Queue[Optional[tuple[int, str]]] = asyncio.Queue(
+            self.args.concurrency
+        )
+        workers = [
+            asyncio.create_task(self.worker(queue))
+            for _ in range(self.args.concurrency)
+        ]
+        for item in prompts:
+            await queue.put(item)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        prog="llmtool batch", description="run prompts from a JSONL file"
+    )
+    parser.add_argument("input", help="JSONL file of prompts, or - for stdin")
+    parser.add_argument(
+        "-o", "--output", help="JSONL file results are appended to", required=True
+    )
+    parser.add_argument(
+        "-m", "--model", type=str, help="default GPT model", default=DEFAULT_MODEL
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=int,
+        help="maximum token count threshold",
+        default=DEFAULT_THRESHOLD,
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="prompts run at once, with requests also capped by $LLMTOOL_CONCURRENCY",
+        default=DEFAULT_CONCURRENCY,
+    )
+    parser.add_argument("--rpm", type=float, help="requests per minute limit")
+    parser.add_argument("--tpm", type=float, help="tokens per minute limit")
+    parser.add_argument(
+        "--functions",
+        help="let the model call functions, which are disabled by default",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-v", "--verbose", help="verbose logging", required=False, action="store_true"
+    )
+    args = parser.parse_args(argv)
+
+    logger = logging.getLogger()
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    done = completed_indices(args.output)
+    with open_output(args.output) as output:
+        batch = Batch(args, output, logger)
+        asyncio.run(batch.run(read_prompts(args.input, done)))
+
+    print(
+        f"{batch.completed} completed, {batch.failed} failed, "
+        f"{len(done)} already done",
+        file=sys.stderr,
+    )
+    if batch.failed:
+        sys.exit(1)
@@ -0,0 +1,410 @@
+"""
+Persistent llmtool process which keeps agents warm between invocations
+
+`llmtool serve` listens on a unix socket and keeps, for the life of the process,
+one OpenAI client with pooled HTTP connections, the loaded tokenizer, a pooled
+document database connection and an agent with in-memory history per
+conversation.  When the socket exists the CLI forwards messages to it instead
+of building all of that itself.
+
+The protocol is newline-delimited JSON.  The client sends one request, and the
+server replies with any number of {"delta": ...}, {"output": ...} and
+{"confirm": ...} messages followed by {"done": true} or {"error": ...}.  Output
+of running functions is shown to the user, and each {"confirm": ...} must be
+answered by the client with {"confirm": true|false}.
+"""
+
+import os
+import sys
+import json
+import socket
+import logging
+import argparse
+import contextlib
+import threading
+import socketserver
+
+from typing import Iterator, Optional
+
+DEFAULT_SOCKET_PATH = "~/tmp/llmtool.sock"
+
+
+def socket_path() -> str:
+    return os.path.expanduser(os.getenv("LLMTOOL_SOCKET", DEFAULT_SOCKET_PATH))
+
+
+class DaemonError(Exception):
+    pass
+
+
+class Connection:
+    """Newline-delimited JSON over a socket"""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.rfile = sock.makefile("rb")
+        # tool calls run in parallel, so messages may be sent from several threads
+        self.send_lock = threading.Lock()
+
+    def send(self, message: dict):
+        data = json.dumps(message).encode() + b"\n"
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def receive(self) -> Optional[dict]:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class Client:
+    def __init__(self, path: str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            raise
+        self.connection = Connection(sock)
+
+    def send_user_message(self, request: dict) -> Iterator[str]:
+        """
+        Sends a message to the daemon, yielding the reply as it arrives.
+        Confirmation prompts for functions are answered on this terminal.
+        """
+        from llmtool.genai.functions import confirm_on_terminal, echo_on_terminal
+
+        try:
+            self.connection.send(request)
+            while True:
+                message = self.connection.receive()
+                if message is None:
+                    raise DaemonError("daemon closed the connection")
+                elif "delta" in message:
+                    yield message["delta"]
+                elif "output" in message:
+                    echo_on_terminal(message["output"])
+                elif "confirm" in message:
+                    confirmed = confirm_on_terminal(message["confirm"])
+                    self.connection.send({"confirm": confirmed})
+                elif "error" in message:
+                    raise DaemonError(message["error"])
+                elif message.get("done"):
+                    return
+        finally:
+            self.connection.close()
+
+
+class AgentPool:
+    """One warm agent per conversation, with resources shared between them"""
+
+    def __init__(self, logger: logging.Logger):
+        from llmtool.genai import tokens
+        from llmtool.genai.documents import DbDelegator
+        from llmtool.genai.scheduler import make_client
+
+        self.logger = logger
+        self.client = make_client()
+        self.documents_db = DbDelegator()
+        self.agents = {}
+        self.locks = {}
+        # response caches by TTL, for requests which opt in to caching
+        self.response_caches = {}
+        self.lock = threading.Lock()
+
+        # pay for these now rather than on the first request
+        tokens.get_encoding()
+        self.documents_db.db
+
+    def get(self, request: dict):
+        """Returns the agent for a request along with a lock serializing its turns"""
+        from llmtool.genai.agent import Agent
+
+        key = (
+            request["conversation"],
+            request["model"],
+            request["threshold"],
+            request["disable_functions"],
+        )
+        with self.lock:
+            if key not in self.agents:
+                self.agents[key] = Agent(
+                    request["model"],
+                    request["conversation"],
+                    request["threshold"],
+                    request["disable_functions"],
+                    self.logger,
+                    client=self.client,
+                    documents_db=self.documents_db,
+                )
+                self.locks[key] = threading.Lock()
+
+            return self.agents[key], self.locks[key]
+
+    def response_cache(self, request: dict):
+        from llmtool.genai.response_cache import DEFAULT_TTL, ResponseCache
+
+        if not request.get("cache"):
+            return None
+
+        ttl = request.get("cache_ttl") or DEFAULT_TTL
+        with self.lock:
+            if ttl not in self.response_caches:
+                self.response_caches[ttl] = ResponseCache(ttl)
+            return self.response_caches[ttl]
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    server: "Server"
+
+    def handle(self):
+        connection = Connection(self.request)
+        try:
+            request = connection.receive()
+            if request is None:
+                return
+            self.handle_request(connection, request)
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.logger.debug("client went away")
+        except Exception as e:
+            self.server.logger.exception("request failed")
+            try:
+                connection.send({"error": str(e)})
+            except OSError:
+                pass
+
+    def handle_request(self, connection: Connection, request: dict):
+        from llmtool.genai.functions import tools_for_conversation
+
+        def confirm(prompt: str) -> bool:
+            connection.send({"confirm": prompt})
+            reply = connection.receive()
+            return bool(reply and reply.get("confirm"))
+
+        agent, lock = self.server.agents.get(request)
+        response_cache = self.server.agents.response_cache(request)
+        with lock:
+            agent.response_cache = response_cache
+            agent.summarize = request.get("summarize", False)
+            agent.tools = request.get("tools") or tools_for_conversation(
+                request["conversation"]
+            )
+            agent.function_handler.confirm = confirm
+            agent.function_handler.echo = lambda text: connection.send({"output": text})
+            if request.get("stream"):
+                # closed while the lock is held, so a turn abandoned by the client
+                # is discarded before the next one starts
+                with contextlib.closing(
+                    agent.stream_user_message(request["message"])
+                ) as deltas:
+                    for delta in deltas:
+                        connection.send({"delta": delta})
+            else:
+                reply = agent.send_user_message(request["message"])
+                connection.send({"delta": reply.content})
+
+        connection.send({"done": True})
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, agents: AgentPool, logger: logging.Logger):
+        self.agents = agents
+        self.logger = logger
+
+        self.path = path
+        self.remove_stale_socket()
+
+        # the daemon can run shell commands, so only we may connect to it
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+        # identifies our socket, so we don't remove one a successor has bound
+        stat = os.stat(path)
+        self.socket_id = (stat.st_dev, stat.st_ino)
+
+    def remove_stale_socket(self):
+        """
+        Removes a socket left behind by a daemon which is gone, raising
+        DaemonError if one is still listening on it
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.path)
+            except FileNotFoundError:
+                return
+            except ConnectionRefusedError:
+                self.logger.debug(f"removing stale socket {self.path}")
+                os.unlink(self.path)
+                return
+        raise DaemonError(f"a daemon is already listening on {self.path}")
+
+    def remove_socket(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if (stat.st_dev, stat.st_ino) == self.socket_id:
+            os.unlink(self.path)
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        prog="llmtool serve", description="keep agents warm for the llmtool CLI"
+    )
+    parser.add_argument(
+        "--socket", type=str, help="unix socket path", default=socket_path()
+    )
+    parser.add_argument(
+        "-v", "--verbose", help="verbose logging", required=False, action="store_true"
+    )
+    args = parser.parse_args(argv)
+
+    logger = logging.getLogger()
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    try:
+        server = Server(args.socket, AgentPool(logger), logger)
+    except DaemonError as e:
+        sys.exit(str(e))
+    logger.info(f"llmtool daemon listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.remove_socket()
+
+
+# Allow testing by running this file directly
+if __name__ == "__main__":
+    import tempfile
+    import unittest
+    import subprocess
+
+    from unittest import mock
+
+    from llmtool.genai.scheduler import get_scheduler
+
+    FAKE_SERVER = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "benchmarks",
+        "fake_openai.py",
+    )
+
+    class TestProtocol(unittest.TestCase):
+        """Drives a daemon on a temporary socket, against the fake API server"""
+
+        def start(self, *fake_args: str) -> Server:
+            fake = subprocess.Popen(
+                [sys.executable, FAKE_SERVER, "--port=0", "--latency=0", *fake_args],
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+            self.addCleanup(fake.wait)
+            self.addCleanup(fake.terminate)
+
+            home = tempfile.TemporaryDirectory()
+            self.addCleanup(home.cleanup)
+            os.makedirs(os.path.join(home.name, "tmp"))
+            environ = mock.patch.dict(
+                os.environ,
+                HOME=home.name,
+                OPENAI_BASE_URL=fake.stdout.readline().strip(),
+                OPENAI_API_KEY="fake",
+                LLMTOOL_HISTORY_INDEX="0",
+            )
+            environ.start()
+            self.addCleanup(environ.stop)
+            # its rate limit state is kept under HOME
+            get_scheduler.cache_clear()
+
+            self.path = os.path.join(home.name, "tmp", "llmtool.sock")
+            self.logger = logging.getLogger("llmtool.daemon.test")
+            server = Server(self.path, AgentPool(self.logger), self.logger)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            self.addCleanup(server.server_close)
+            self.addCleanup(thread.join)
+            self.addCleanup(server.shutdown)
+            return server
+
+        def send(self, message: str, **request) -> Iterator[str]:
+            return Client(self.path).send_user_message(
+                {
+                    "conversation": "test",
+                    "model": "gpt-4",
+                    "threshold": 8000,
+                    "disable_functions": False,
+                    "message": message,
+                    **request,
+                }
+            )
+
+        def test_deltas_and_done(self):
+            self.start("--reply-tokens=5")
+            self.assertEqual(list(self.send("hi", stream=True)), [" load"] * 5)
+            self.assertEqual(list(self.send("again")), [" load" * 5])
+
+        def test_confirm_round_trip(self):
+            self.start(
+                "--tool-call=execute_shell_command",
+                '--tool-arguments={"command": "echo from the tool"}',
+            )
+            output = []
+            with mock.patch(
+                "llmtool.genai.functions.confirm_on_terminal", return_value=True
+            ) as confirm, mock.patch(
+                "llmtool.genai.functions.echo_on_terminal", output.append
+            ):
+                reply = "".join(self.send("run it", stream=True))
+
+            self.assertIn("echo from the tool", confirm.call_args.args[0])
+            self.assertEqual("".join(output), "from the tool\n")
+            self.assertTrue(reply)
+
+        def test_declined_confirm(self):
+            server = self.start(
+                "--tool-call=execute_shell_command",
+                '--tool-arguments={"command": "echo from the tool"}',
+            )
+            with mock.patch(
+                "llmtool.genai.functions.confirm_on_terminal", return_value=False
+            ), mock.patch("llmtool.genai.functions.echo_on_terminal") as echo:
+                list(self.send("run it"))
+
+            echo.assert_not_called()
+            [agent] = server.agents.agents.values()
+            self.assertIn("declined", agent.chat_history.messages[2].content)
+
+        def test_error(self):
+            self.start()
+            with self.assertLogs(self.logger, logging.ERROR):
+                with self.assertRaisesRegex(DaemonError, "Unknown .* bogus"):
+                    list(self.send("hi", tools="bogus"))
+
+        def test_client_disconnects_mid_stream(self):
+            server = self.start("--reply-tokens=200", "--tokens-per-second=400")
+            deltas = self.send("hi", stream=True)
+            next(deltas)
+            deltas.close()
+
+            # the abandoned turn is discarded and the conversation carries on
+            self.assertEqual("".join(self.send("again")), " load" * 200)
+            [agent] = server.agents.agents.values()
+            self.assertEqual(
+                [message.content for message in agent.chat_history.messages],
+                ["again", " load" * 200],
+            )
+
+    unittest.main()
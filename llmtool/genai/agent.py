@@ -1,24 +1,127 @@
-import os
 import sys
-import json
+import time
 import logging
+import functools
+import contextlib
 
-from openai import OpenAI
+from typing import TYPE_CHECKING, Iterator, Optional, Union
 
-from typing import Union
-
-from llmtool.genai.functions import get_default_handler
-from llmtool.genai.history import ChatHistory
+from llmtool import spans
+from llmtool.genai.documents import DbDelegator
+from llmtool.genai.functions import (
+    Function,
+    check_tools,
+    get_default_handler,
+    tools_for_conversation,
+)
+from llmtool.genai.history import ChatHistory, count_tokens
 from llmtool.genai.message import (
-    FunctionMessage,
-    FunctionCallResultMessage,
     AssistantMessage,
     BaseMessage,
+    FunctionCallResultMessage,
+    FunctionMessage,
+    SystemMessage,
+    ToolCallsMessage,
+    ToolResultMessage,
     UserMessage,
 )
 from llmtool.genai.prompts import DEFAULT as DEFAULT_PROMPT
+from llmtool.genai.prompts import SUMMARIZE as SUMMARIZE_PROMPT
+from llmtool.genai.rate_limit import COMPLETION_TOKENS_ESTIMATE
+from llmtool.genai.scheduler import get_scheduler, make_client
+
+if TYPE_CHECKING:
+    from llmtool.genai.response_cache import ResponseCache
+
+# requests made for one user message before the model must answer without tools
+MAX_STEPS = 10
+
+# share of the token threshold a summarized history is brought down to, so that
+# summaries are made once in a while rather than on every turn
+SUMMARY_TARGET_FRACTION = 0.5
+SUMMARY_MAX_TOKENS = 512
+# characters of each message given to the model when summarizing
+SUMMARY_MESSAGE_CHARS = 4000
+
+
+def transcript_entry(message: BaseMessage) -> str:
+    """Renders a message as text for the model to summarize"""
+    if isinstance(message, ToolCallsMessage):
+        calls = ", ".join(
+            f"{call['function']['name']}({call['function']['arguments']})"
+            for call in message.tool_calls
+        )
+        text = (message.content or "") + f"\n[called {calls}]"
+    elif isinstance(message, FunctionMessage):
+        call = message.function_call
+        text = f"[called {call['name']}({call['arguments']})]"
+    elif isinstance(message, (ToolResultMessage, FunctionCallResultMessage)):
+        text = f"[{message.name} returned]\n{message.content}"
+    else:
+        text = message.content or ""
+
+    if len(text) > SUMMARY_MESSAGE_CHARS:
+        text = text[:SUMMARY_MESSAGE_CHARS] + " [...]"
+    return f"{message.role}: {text.strip()}"
+
+
+class StreamedReply:
+    """Reassembles a reply from the deltas of a streamed completion"""
+
+    def __init__(self):
+        self.content_parts: list[str] = []
+        # parts of each tool call, by its index in the reply
+        self.tool_calls: dict[int, dict[str, list[str]]] = {}
+        # reported by the final chunk, which has no choices, when it's asked for
+        self.usage = None
+
+    def add(self, chunk) -> Optional[str]:
+        """Adds a chunk of the stream, returning any content it carries"""
+        if getattr(chunk, "usage", None) is not None:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return None
+
+        delta = chunk.choices[0].delta
+        for tool_call in delta.tool_calls or []:
+            parts = self.tool_calls.setdefault(
+                tool_call.index, {"id": [], "name": [], "arguments": []}
+            )
+            if tool_call.id:
+                parts["id"].append(tool_call.id)
+            if tool_call.function and tool_call.function.name:
+                parts["name"].append(tool_call.function.name)
+            if tool_call.function and tool_call.function.arguments:
+                parts["arguments"].append(tool_call.function.arguments)
+
+        if delta.content:
+            self.content_parts.append(delta.content)
+        return delta.content
+
+    def to_message(self) -> Union[ToolCallsMessage, AssistantMessage]:
+        content = "".join(self.content_parts)
+        if not self.tool_calls:
+            return AssistantMessage(content=content)
+
+        return ToolCallsMessage(
+            tool_calls=[
+                {
+                    "id": "".join(parts["id"]),
+                    "type": "function",
+                    "function": {
+                        "name": "".join(parts["name"]),
+                        "arguments": "".join(parts["arguments"]),
+                    },
+                }
+                for _, parts in sorted(self.tool_calls.items())
+            ],
+            content=content or None,
+        )
+
+
+class AgentBase:
+    """State and request building shared by the sync and async agents"""
 
-class Agent:
     def __init__(
         self,
         model: str,
@@ -26,18 +129,199 @@ class Agent:
         max_token_count: int,
         disable_functions: bool,
         logger: logging.Logger,
+        client=None,
+        documents_db: Optional[DbDelegator] = None,
+        max_steps: int = MAX_STEPS,
+        prompt: str = DEFAULT_PROMPT,
+        chat_history: Optional[ChatHistory] = None,
+        response_cache: Optional["ResponseCache"] = None,
+        summarize: bool = False,
+        tools: Optional[str] = None,
     ):
         self.model = model
+        self.max_steps = max_steps
         self.conversation_name = conversation_name
         self.max_token_count = max_token_count
-        self.chat_history = ChatHistory(conversation_name, DEFAULT_PROMPT)
-        self.function_handler = get_default_handler()
+        self.chat_history = chat_history or ChatHistory(conversation_name, prompt)
         self.disable_functions = disable_functions
         self.logger = logger
-        self.client = OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
+        self.documents_db = documents_db
+        self.response_cache = response_cache
+        # summarize old messages rather than dropping them once over the threshold
+        self.summarize = summarize
+        # functions offered to the model, as for FunctionHandler.select_functions
+        if tools:
+            check_tools(tools)
+        self.tools = tools or tools_for_conversation(conversation_name)
+        if client is not None:
+            # shared between agents by the daemon
+            self.client = client
+
+    @contextlib.contextmanager
+    def turn(self):
+        """
+        Discards the messages of a turn which fails or is abandoned, so that the
+        next starts from the saved history rather than on top of unanswered calls
+        """
+        try:
+            yield
+        except BaseException:
+            self.chat_history.discard_changes()
+            raise
+
+    # The function handler is built on first use, so that commands which only
+    # read history don't pay for connecting to the document database
+
+    @functools.cached_property
+    def function_handler(self):
+        return get_default_handler(self.documents_db)
+
+    def append_tool_results(self, message: ToolCallsMessage, results: list[str]):
+        for tool_call, result in zip(message.tool_calls, results):
+            self.chat_history.append(
+                ToolResultMessage(
+                    tool_call_id=tool_call["id"],
+                    name=tool_call["function"]["name"],
+                    content=result,
+                )
+            )
+
+    def build_message_from_response(
+        self, message
+    ) -> Union[ToolCallsMessage, AssistantMessage]:
+        if message.tool_calls:
+            return ToolCallsMessage(
+                tool_calls=[
+                    {
+                        "id": tool_call.id,
+                        "type": "function",
+                        "function": {
+                            "name": tool_call.function.name,
+                            "arguments": tool_call.function.arguments,
+                        },
+                    }
+                    for tool_call in message.tool_calls
+                ],
+                content=message.content,
+            )
+        else:
+            return AssistantMessage(
+                content=message.content,
+            )
+
+    def selected_functions(self) -> list[Function]:
+        if self.disable_functions:
+            return []
+        return self.function_handler.select_functions(
+            self.tools, self.chat_history.messages
         )
 
+    def history_token_budget(self, functions: list[Function]) -> int:
+        """The threshold less what the function schemas sent with it take up"""
+        return self.max_token_count - sum(f.token_count for f in functions)
+
+    def build_summary_request(self) -> Optional[tuple[int, dict]]:
+        """
+        When summarizing and over the threshold, returns the number of the oldest
+        messages to summarize along with the request for their summary
+        """
+        history = self.chat_history
+        if not self.summarize:
+            return None
+
+        budget = self.history_token_budget(self.selected_functions())
+        if history.get_token_count() <= budget:
+            return None
+
+        count = history.summary_block(int(budget * SUMMARY_TARGET_FRACTION))
+        if count == 0:
+            return None
+
+        parts = []
+        if history.summary:
+            parts.append("Summary so far:\n\n" + history.summary)
+        parts.append(
+            "Messages to add to it:\n\n"
+            + "\n\n".join(transcript_entry(history.messages[i]) for i in range(count))
+        )
+        return count, {
+            "model": self.model,
+            "messages": [
+                SystemMessage(SUMMARIZE_PROMPT).to_json(),
+                UserMessage("\n\n".join(parts)).to_json(),
+            ],
+            "max_tokens": SUMMARY_MAX_TOKENS,
+        }
+
+    def build_request(self, step: int) -> dict:
+        """Builds the completion request for a step of the current turn"""
+        functions = self.selected_functions()
+        self.chat_history.truncate_by_token_count(self.history_token_budget(functions))
+        self.logger.debug(f"chat history: {self.chat_history.to_json()}")
+        self.logger.debug(f"functions: {[f.name for f in functions]}")
+
+        request = {
+            "model": self.model,
+            "messages": self.chat_history.to_json(),
+        }
+        if functions:
+            request["tools"] = [f.tool_json for f in functions]
+            if step == self.max_steps - 1:
+                # out of steps, so the model has to answer with what it has
+                request["tool_choice"] = "none"
+
+        return request
+
+    def cached_reply(self, request: dict) -> Optional[AssistantMessage]:
+        from llmtool.genai.response_cache import request_key
+
+        if self.response_cache is None:
+            return None
+
+        with spans.span("response_cache.get") as span:
+            reply = self.response_cache.get(request)
+            span.set(hit=reply is not None)
+        self.logger.debug(
+            f"response cache {'hit' if reply else 'miss'}: {request_key(request)}"
+        )
+        return reply
+
+    def cache_reply(self, request: dict, message: BaseMessage):
+        if (
+            self.response_cache is not None
+            and isinstance(message, AssistantMessage)
+            and message.content
+        ):
+            self.response_cache.put(request, message)
+
+    def estimate_request_tokens(self) -> int:
+        """Tokens the next request is expected to use, for rate limiting"""
+        return (
+            count_tokens(self.chat_history.prompt_message)
+            + self.chat_history.get_token_count()
+            + sum(f.token_count for f in self.selected_functions())
+            + COMPLETION_TOKENS_ESTIMATE
+        )
+
+    @staticmethod
+    def stream_request(request: dict) -> dict:
+        """A request for a streamed completion, whose last chunk reports usage"""
+        return {**request, "stream": True, "stream_options": {"include_usage": True}}
+
+    def final_reply(self, message: BaseMessage) -> AssistantMessage:
+        if isinstance(message, ToolCallsMessage):
+            return AssistantMessage(content=message.content or "")
+        return message
+
+
+class Agent(AgentBase):
+    # The client is built on first use, so that commands which only read
+    # history don't pay for importing openai
+
+    @functools.cached_property
+    def client(self):
+        return make_client()
+
     def load_chat_history(self):
         self.chat_history.load()
 
@@ -45,76 +329,281 @@ class Agent:
         self.chat_history.truncate_by_token_count(self.max_token_count)
         self.chat_history.save()
 
-    def handle_function_calls(
-        self, message: FunctionMessage
-    ) -> Union[AssistantMessage, FunctionMessage]:
-        """
-        Given a message from chatgpt, returns either a message with the result of
-        the function call if a function call was made, or None if not
-        """
+    def summarize_history(self):
+        """Replaces the oldest messages with a summary if over the threshold"""
+        summary_request = self.build_summary_request()
+        if summary_request is None:
+            return
 
-        self.logger.debug(f"handling function call: {message.function_call}")
-        function_call_result = str(
-            self.function_handler.handle_function_call(
-                name=message.function_call["name"],
-                args=json.loads(message.function_call["arguments"]),
+        count, request = summary_request
+        self.logger.debug(f"summarizing the oldest {count} messages")
+        with spans.span("summarize", messages=count):
+            response = get_scheduler().create(
+                self.client.chat.completions, request, self.estimate_request_tokens()
             )
+        self.chat_history.replace_oldest_with_summary(
+            count, response.choices[0].message.content
         )
 
-        function_call_result_message = FunctionCallResultMessage(
-            name=message.function_call["name"],
-            content=function_call_result,
+    def run_tool_calls(self, message: ToolCallsMessage):
+        """Runs the requested tools concurrently and appends their results"""
+        self.logger.debug(f"handling tool calls: {message.tool_calls}")
+        with spans.span("tools", calls=len(message.tool_calls)):
+            results = self.function_handler.handle_tool_calls(message.tool_calls)
+        self.append_tool_results(message, results)
+
+    def send_user_message(self, message_text: str) -> AssistantMessage:
+        user_message = UserMessage(content=message_text)
+        return self.send_message(user_message)
+
+    def send_message(self, message: BaseMessage) -> AssistantMessage:
+        """
+        Sends the message, running any tools the model asks for and sending their
+        results back, until it replies with content or max_steps requests have
+        been made.  History is saved once, when the reply arrives.
+        """
+        with self.turn():
+            self.chat_history.load()
+            self.chat_history.append(message)
+
+            for step in range(self.max_steps):
+                self.summarize_history()
+                request = self.build_request(step)
+                response_message = self.cached_reply(request)
+                if response_message is None:
+                    response = get_scheduler().create(
+                        self.client.chat.completions,
+                        request,
+                        self.estimate_request_tokens(),
+                    )
+                    response_message = self.build_message_from_response(
+                        response.choices[0].message
+                    )
+                    self.cache_reply(request, response_message)
+                self.chat_history.append(response_message)
+
+                if not isinstance(response_message, ToolCallsMessage):
+                    break
+                self.run_tool_calls(response_message)
+
+            self.chat_history.save()
+            return self.final_reply(response_message)
+
+    def stream_user_message(self, message_text: str) -> Iterator[str]:
+        """
+        Like send_user_message, but yields the content of the reply as it arrives
+        """
+        return self.stream_message(UserMessage(content=message_text))
+
+    def stream_message(self, message: BaseMessage) -> Iterator[str]:
+        """
+        Like send_message, but with streamed completions, yielding content deltas.
+        Tool call deltas are collected until the stream ends, then the tools are
+        run and their results streamed back to the model in turn.
+        """
+        with self.turn():
+            self.chat_history.load()
+            self.chat_history.append(message)
+
+            for step in range(self.max_steps):
+                self.summarize_history()
+                request = self.build_request(step)
+                response_message = self.cached_reply(request)
+                if response_message is not None:
+                    yield response_message.content
+                else:
+                    # includes the time the caller takes with each delta
+                    completions = self.client.chat.completions
+                    with spans.span("api.stream") as span:
+                        started = time.perf_counter()
+                        stream = get_scheduler().create(
+                            completions,
+                            self.stream_request(request),
+                            self.estimate_request_tokens(),
+                        )
+
+                        reply = StreamedReply()
+                        chunks = 0
+                        for chunk in stream:
+                            if not chunks:
+                                span.set(
+                                    first_chunk_ms=round(
+                                        (time.perf_counter() - started) * 1000, 1
+                                    )
+                                )
+                            chunks += 1
+                            content = reply.add(chunk)
+                            if content:
+                                yield content
+                        span.set(chunks=chunks)
+
+                    response_message = reply.to_message()
+                    self.cache_reply(request, response_message)
+                self.chat_history.append(response_message)
+
+                if not isinstance(response_message, ToolCallsMessage):
+                    break
+                self.run_tool_calls(response_message)
+
+            self.chat_history.save()
+
+
+# Allow testing by running this file directly
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import threading
+    import unittest
+
+    from types import SimpleNamespace
+    from unittest import mock
+
+    from llmtool.genai.functions import FunctionHandler
+
+    # saves shouldn't touch the user's search index
+    os.environ["LLMTOOL_HISTORY_INDEX"] = "0"
+
+    def tool_call(name: str, arguments: str, id: str):
+        return SimpleNamespace(
+            id=id, function=SimpleNamespace(name=name, arguments=arguments)
         )
 
-        actual_response = self.send_message(function_call_result_message)
-        return actual_response
+    def response(content: Optional[str] = None, tool_calls: list = ()):
+        message = SimpleNamespace(content=content, tool_calls=list(tool_calls))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
 
-    def build_message_from_response(self, message) -> Union[FunctionMessage, AssistantMessage]:
-        if message.function_call: 
-            function_call = message.function_call
-            return FunctionMessage(
-                function_call=function_call,
-            )
-        else:
-            return AssistantMessage(
-                content=message.content,
+    class FakeScheduler:
+        """Answers requests with scripted responses, the last one repeatedly"""
+
+        def __init__(self, *responses):
+            self.responses = list(responses)
+            self.requests = []
+
+        def create(self, resource, request: dict, estimated_tokens: int):
+            self.requests.append(request)
+            return self.responses[min(len(self.requests), len(self.responses)) - 1]
+
+    class TestToolLoop(unittest.TestCase):
+        def setUp(self):
+            home = tempfile.TemporaryDirectory()
+            self.addCleanup(home.cleanup)
+            os.makedirs(os.path.join(home.name, "tmp"))
+            environ = mock.patch.dict(os.environ, HOME=home.name)
+            environ.start()
+            self.addCleanup(environ.stop)
+
+            self.calls = []
+            self.calls_lock = threading.Lock()
+            self.handler = FunctionHandler()
+            self.handler.define_function(
+                name="wait",
+                description="waits, then returns its label",
+                parameters={
+                    "seconds": {"type": "number"},
+                    "label": {"type": "string"},
+                    "path": {"type": "string"},
+                },
+                required=["seconds", "label"],
+                function=self.wait,
             )
 
-    def send_user_message(
-        self, message_text: str
-    ) -> Union[AssistantMessage, FunctionMessage]:
-        user_message = UserMessage(content=message_text)
-        return self.send_message(user_message)
+        def wait(self, seconds: float, label: str, path: Optional[str] = None) -> str:
+            time.sleep(seconds)
+            with self.calls_lock:
+                self.calls.append(label)
+            return label
 
-    def send_message(
-        self, message: Union[UserMessage, FunctionCallResultMessage]
-    ) -> Union[AssistantMessage, FunctionMessage]:
-        # Load chat history
-        previous_messages = self.chat_history.load()
+        def run_turn(self, scheduler: FakeScheduler, max_steps: int = MAX_STEPS):
+            agent = Agent(
+                "gpt-4",
+                "test",
+                8000,
+                False,
+                logging.getLogger(__name__),
+                client=SimpleNamespace(chat=SimpleNamespace(completions=None)),
+                max_steps=max_steps,
+            )
+            agent.function_handler = self.handler
+            with mock.patch(__name__ + ".get_scheduler", return_value=scheduler):
+                return agent, agent.send_user_message("go")
 
-        self.chat_history.append(message)
-        self.chat_history.truncate_by_token_count(self.max_token_count)
-        self.logger.debug(f"chat history: {self.chat_history.to_json()}")
+        def test_parallel_results_come_back_in_order(self):
+            scheduler = FakeScheduler(
+                response(
+                    tool_calls=[
+                        tool_call("wait", '{"seconds": 0.3, "label": "a"}', "1"),
+                        tool_call("wait", '{"seconds": 0, "label": "b"}', "2"),
+                        tool_call("wait", '{"seconds": 0.15, "label": "c"}', "3"),
+                    ]
+                ),
+                response("done"),
+            )
+            start = time.monotonic()
+            agent, reply = self.run_turn(scheduler)
 
-        if self.disable_functions:
-            response = self.client.chat.completions.create(
-                model=self.model, messages=self.chat_history.to_json()
+            self.assertLess(time.monotonic() - start, 0.45)
+            self.assertEqual(self.calls, ["b", "c", "a"])
+            self.assertEqual(reply.content, "done")
+            results = scheduler.requests[1]["messages"][-3:]
+            self.assertEqual(
+                [(m["tool_call_id"], m["content"]) for m in results],
+                [("1", "a"), ("2", "b"), ("3", "c")],
             )
-        else:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=self.chat_history.to_json(),
-                functions=self.function_handler.to_json(),
+
+        def test_calls_naming_the_same_path_run_in_order(self):
+            scheduler = FakeScheduler(
+                response(
+                    tool_calls=[
+                        tool_call(
+                            "wait",
+                            f'{{"seconds": {0.2 - i * 0.1}, "label": "{i}", '
+                            f'"path": "{path}"}}',
+                            str(i),
+                        )
+                        for i, path in enumerate(["~/x", "/tmp/y", "~/./x"])
+                    ]
+                ),
+                response("done"),
             )
+            self.run_turn(scheduler)
+            self.assertEqual(self.calls, ["1", "0", "2"])
 
-        response_message = self.build_message_from_response(
-            response.choices[0].message
-        )
-        if type(response_message) == FunctionMessage:
-            response_message = self.handle_function_calls(response_message.to_hash())
+        def test_max_steps(self):
+            scheduler = FakeScheduler(
+                response(
+                    tool_calls=[tool_call("wait", '{"seconds": 0, "label": "a"}', "1")]
+                )
+            )
+            agent, reply = self.run_turn(scheduler, max_steps=3)
 
-        # Append new messages to the chat history
-        self.chat_history.append(response_message)
-        self.chat_history.save()
+            self.assertEqual(len(scheduler.requests), 3)
+            self.assertNotIn("tool_choice", scheduler.requests[1])
+            self.assertEqual(scheduler.requests[2]["tool_choice"], "none")
+            self.assertEqual(reply.content, "")
+
+        def test_history_is_saved_once_per_turn(self):
+            scheduler = FakeScheduler(
+                response(
+                    tool_calls=[tool_call("wait", '{"seconds": 0, "label": "a"}', "1")]
+                ),
+                response("done"),
+            )
+            with mock.patch.object(
+                ChatHistory, "save", autospec=True, side_effect=ChatHistory.save
+            ) as save:
+                agent, reply = self.run_turn(scheduler)
+            self.assertEqual(save.call_count, 1)
+
+            saved = ChatHistory("test", DEFAULT_PROMPT)
+            saved.load()
+            self.assertEqual(
+                [type(m).__name__ for m in saved.messages],
+                [
+                    "UserMessage",
+                    "ToolCallsMessage",
+                    "ToolResultMessage",
+                    "AssistantMessage",
+                ],
+            )
 
-        return response_message
+    unittest.main()
@@ -0,0 +1,205 @@
+"""
+Asyncio agent, for driving many conversations from one event loop
+
+Requests to the API are made with AsyncOpenAI, and at most CONCURRENCY_LIMIT
+of them are in flight at once across every agent in the process.  Blocking
+work, history I/O and tools, runs in threads so it doesn't stall the loop.
+"""
+
+import os
+import asyncio
+import weakref
+import functools
+
+from typing import AsyncIterator, Optional
+
+from llmtool import spans
+from llmtool.genai.agent import AgentBase, StreamedReply
+from llmtool.genai.functions import group_tool_calls, ungroup_results
+from llmtool.genai.message import (
+    AssistantMessage,
+    BaseMessage,
+    ToolCallsMessage,
+    UserMessage,
+)
+from llmtool.genai.history import count_tokens
+from llmtool.genai.rate_limit import COMPLETION_TOKENS_ESTIMATE, RateLimiter
+from llmtool.genai.scheduler import get_scheduler, make_client
+
+# API requests in flight at once across all agents in the process
+CONCURRENCY_LIMIT = int(os.getenv("LLMTOOL_CONCURRENCY", "16"))
+
+
+# semaphores belong to the loop they are first used on, so there is one per loop
+_request_slots = weakref.WeakKeyDictionary()
+
+
+def request_slots() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    if loop not in _request_slots:
+        _request_slots[loop] = asyncio.Semaphore(CONCURRENCY_LIMIT)
+    return _request_slots[loop]
+
+
+class AsyncAgent(AgentBase):
+    """
+    Agent whose methods are coroutines.  Turns of one conversation are run one
+    at a time, while any number of conversations may be run concurrently.
+    """
+
+    def __init__(self, *args, rate_limiter: Optional[RateLimiter] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+        self.turn_lock = asyncio.Lock()
+
+    @functools.cached_property
+    def client(self):
+        return make_client(async_=True)
+
+    async def load_chat_history(self):
+        await asyncio.to_thread(self.chat_history.load)
+
+    async def save_chat_history(self):
+        self.chat_history.truncate_by_token_count(self.max_token_count)
+        await asyncio.to_thread(self.chat_history.save)
+
+    async def summarize_history(self):
+        """Like Agent.summarize_history"""
+        summary_request = self.build_summary_request()
+        if summary_request is None:
+            return
+
+        count, request = summary_request
+        self.logger.debug(f"summarizing the oldest {count} messages")
+        summary = await self.request_reply(request)
+        self.chat_history.replace_oldest_with_summary(count, summary.content)
+
+    async def run_tool_calls(self, message: ToolCallsMessage):
+        """
+        Runs the requested tools in the handler's threads, appending results.
+        Like FunctionHandler.handle_tool_calls, calls naming the same path run
+        one after another.
+        """
+        self.logger.debug(f"handling tool calls: {message.tool_calls}")
+        loop = asyncio.get_running_loop()
+        handler = self.function_handler
+        tool_calls = message.tool_calls
+        groups = group_tool_calls(tool_calls)
+        with spans.span("tools", calls=len(tool_calls)):
+            group_results = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        handler.executor,
+                        handler.handle_tool_call_group,
+                        [tool_calls[i] for i in group],
+                    )
+                    for group in groups
+                )
+            )
+        self.append_tool_results(message, ungroup_results(groups, group_results))
+
+    async def request_reply(self, request: dict) -> BaseMessage:
+        estimate = self.estimate_request_tokens()
+        if self.rate_limiter:
+            await self.rate_limiter.acquire(estimate)
+        async with request_slots():
+            response = await get_scheduler().acreate(
+                self.client.chat.completions, request, estimate
+            )
+        if self.rate_limiter and response.usage:
+            self.rate_limiter.settle(estimate, response.usage.total_tokens)
+
+        return self.build_message_from_response(response.choices[0].message)
+
+    @staticmethod
+    def streamed_tokens(reply: StreamedReply, estimate: int) -> int:
+        """
+        Tokens used by a streamed request, counted locally for servers which
+        ignore stream_options and don't report usage
+        """
+        if reply.usage is not None:
+            return reply.usage.total_tokens
+        return estimate - COMPLETION_TOKENS_ESTIMATE + count_tokens(reply.to_message())
+
+    async def send_user_message(self, message_text: str) -> AssistantMessage:
+        return await self.send_message(UserMessage(content=message_text))
+
+    async def send_message(self, message: BaseMessage) -> AssistantMessage:
+        """Like Agent.send_message"""
+        async with self.turn_lock:
+            with self.turn():
+                await self.load_chat_history()
+                self.chat_history.append(message)
+
+                for step in range(self.max_steps):
+                    await self.summarize_history()
+                    request = self.build_request(step)
+                    response_message = await asyncio.to_thread(
+                        self.cached_reply, request
+                    )
+                    if response_message is None:
+                        response_message = await self.request_reply(request)
+                        await asyncio.to_thread(
+                            self.cache_reply, request, response_message
+                        )
+                    self.chat_history.append(response_message)
+
+                    if not isinstance(response_message, ToolCallsMessage):
+                        break
+                    await self.run_tool_calls(response_message)
+
+                await asyncio.to_thread(self.chat_history.save)
+                return self.final_reply(response_message)
+
+    def stream_user_message(self, message_text: str) -> AsyncIterator[str]:
+        return self.stream_message(UserMessage(content=message_text))
+
+    async def stream_message(self, message: BaseMessage) -> AsyncIterator[str]:
+        """
+        Like Agent.stream_message.  A request slot is held until its stream has
+        been read to the end.
+        """
+        async with self.turn_lock:
+            with self.turn():
+                await self.load_chat_history()
+                self.chat_history.append(message)
+
+                for step in range(self.max_steps):
+                    await self.summarize_history()
+                    request = self.build_request(step)
+                    response_message = await asyncio.to_thread(
+                        self.cached_reply, request
+                    )
+                    if response_message is not None:
+                        yield response_message.content
+                    else:
+                        estimate = self.estimate_request_tokens()
+                        if self.rate_limiter:
+                            await self.rate_limiter.acquire(estimate)
+                        reply = StreamedReply()
+                        async with request_slots():
+                            stream = await get_scheduler().acreate(
+                                self.client.chat.completions,
+                                self.stream_request(request),
+                                estimate,
+                            )
+                            async for chunk in stream:
+                                content = reply.add(chunk)
+                                if content:
+                                    yield content
+
+                        response_message = reply.to_message()
+                        if self.rate_limiter:
+                            self.rate_limiter.settle(
+                                estimate, self.streamed_tokens(reply, estimate)
+                            )
+                        await asyncio.to_thread(
+                            self.cache_reply, request, response_message
+                        )
+                    self.chat_history.append(response_message)
+
+                    if not isinstance(response_message, ToolCallsMessage):
+                        break
+                    await self.run_tool_calls(response_message)
+
+                await asyncio.to_thread(self.chat_history.save)
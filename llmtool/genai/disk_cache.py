@@ -0,0 +1,119 @@
+"""
+Persistent, size-bounded key/value cache backed by SQLite
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+from typing import Optional
+
+# eviction scans the LRU index, so it is done every so many writes rather than
+# on each one
+EVICTION_INTERVAL = 100
+
+
+class DiskCache:
+    """
+    Maps string keys to bytes in a SQLite database shared between processes.
+    Once it holds more than max_entries the least recently used entries are
+    evicted, and entries older than ttl seconds, if given, are treated as
+    missing.  Hits and misses are counted for the life of the object.
+    """
+
+    def __init__(self, path: str, max_entries: int, ttl: Optional[float] = None):
+        self.path = os.path.expanduser(path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        self.conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                created REAL NOT NULL DEFAULT 0
+            );
+
+            CREATE INDEX IF NOT EXISTS entries_last_used_idx ON entries (last_used);
+        """)
+
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(entries)")]
+        if "created" not in columns:
+            # caches made before entries could expire
+            try:
+                self.conn.execute(
+                    "ALTER TABLE entries ADD COLUMN created REAL NOT NULL DEFAULT 0"
+                )
+            except sqlite3.OperationalError:
+                # another process added it first
+                pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock, self.conn:
+            now = time.time()
+            row = self.conn.execute(
+                "SELECT value, created FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.conn.execute(
+                "UPDATE entries SET last_used = ? WHERE key = ?", (now, key)
+            )
+            return row[0]
+
+    def put(self, key: str, value: bytes):
+        self.put_many([(key, value)])
+
+    def put_many(self, entries: list[tuple[str, bytes]]):
+        """Stores several entries in one transaction"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, last_used, created) "
+                "VALUES (?, ?, ?, ?)",
+                [(key, value, now, now) for key, value in entries],
+            )
+
+            writes = self.writes
+            self.writes += len(entries)
+            if writes // EVICTION_INTERVAL != self.writes // EVICTION_INTERVAL or (
+                writes == 0
+            ):
+                self._evict()
+
+    def delete_prefix(self, prefix: str) -> int:
+        """Removes every entry whose key starts with prefix, returning how many"""
+        with self.lock, self.conn:
+            return self.conn.execute(
+                "DELETE FROM entries WHERE substr(key, 1, ?) = ?",
+                (len(prefix), prefix),
+            ).rowcount
+
+    def _evict(self):
+        self.conn.execute(
+            """
+            DELETE FROM entries WHERE key IN (
+                SELECT key FROM entries ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        )
+
+    def stats(self) -> dict:
+        with self.lock:
+            (entries,) = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
@@ -4,18 +4,134 @@ Provides postgres vector-db based document persistence and search
 
 import os
 import sys
+import hashlib
+import contextlib
+import functools
 
-import psycopg2
+from typing import Optional
 
 import llmtool.genai.embedding as embedding
+from llmtool import spans
+
+MAX_CONNECTIONS = 8
+# rows sent per INSERT statement when saving documents in bulk
+INSERT_PAGE_SIZE = 1000
+
+SEARCH_RESULTS = 10
+
+# The embedding index is built by `llmtool index` once documents are loaded,
+# since IVFFlat lists trained on an empty table give poor recall.  These tune
+# recall against latency at query time for whichever index type was built.
+IVFFLAT_PROBES = int(os.getenv("LLMTOOL_IVFFLAT_PROBES", "10"))
+HNSW_EF_SEARCH = int(os.getenv("LLMTOOL_HNSW_EF_SEARCH", "40"))
+
+INDEX_METHODS = ["hnsw", "ivfflat"]
+
+
+def default_ivfflat_lists(row_count: int) -> int:
+    """pgvector's recommendation: rows / 1000 up to 1M rows, sqrt(rows) after"""
+    if row_count <= 1_000_000:
+        return max(row_count // 1000, 10)
+    return int(row_count**0.5)
+
+
+def build_index_sql(
+    table: str,
+    method: str,
+    lists: int = 100,
+    m: int = 16,
+    ef_construction: int = 64,
+) -> str:
+    """Returns SQL (re)building the cosine distance index on table.embedding"""
+    if method == "hnsw":
+        options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+    elif method == "ivfflat":
+        options = f"lists = {int(lists)}"
+    else:
+        raise ValueError(f"Unknown index method {method}")
+
+    return f"""
+        DROP INDEX IF EXISTS {table}_embedding_idx;
+        CREATE INDEX {table}_embedding_idx ON {table}
+        USING {method} (embedding vector_cosine_ops) WITH ({options});
+        ANALYZE {table};
+    """
+
+
+def set_search_parameters(
+    cur, probes: int = IVFFLAT_PROBES, ef_search: int = HNSW_EF_SEARCH
+):
+    """Tunes index scans for the rest of the current transaction"""
+    cur.execute(
+        "SELECT set_config('ivfflat.probes', %s, true), "
+        "set_config('hnsw.ef_search', %s, true)",
+        (str(probes), str(ef_search)),
+    )
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _vector(values) -> str:
+    return str(list(values))
+
+
+def format_results(rows: list[tuple[int, str]]) -> str:
+    """
+    Formats (document id, text) search results, best first, keeping only the best
+    matching chunk of each document
+    """
+    results = {}
+    for document_id, text in rows:
+        if document_id not in results:
+            results[document_id] = text
+        if len(results) == SEARCH_RESULTS:
+            break
+
+    return "\n".join(
+        [
+            f"Document ID: {document_id}\n{text}\n\n"
+            for document_id, text in results.items()
+        ]
+    )
+
 
 class DbDelegator:
-    def __init__(self):
+    """
+    Connects to the database and initializes its schema on first use, so that
+    commands which never touch documents don't pay for it.  Falls back to a local
+    index when postgres isn't available.
+    """
+
+    @functools.cached_property
+    def db(self):
         try:
-            self.db = DB()
+            import psycopg2
+        except ImportError:
+            print("psycopg2 is not installed.", file=sys.stderr)
+            return self.local_db()
+
+        try:
+            db = DB()
         except psycopg2.OperationalError:
-            print("Failed to connect to database, documents disabled.", file=sys.stderr)
-            self.db = DBStub()
+            print("Failed to connect to database.", file=sys.stderr)
+            return self.local_db()
+
+        db.init_schema()
+        return db
+
+    def local_db(self):
+        try:
+            from llmtool.genai.local_index import LocalDB
+        except ImportError:
+            print("numpy is not installed, documents disabled.", file=sys.stderr)
+            return DBStub()
+
+        print("Using local document index.", file=sys.stderr)
+        db = LocalDB()
+        db.init_schema()
+        return db
 
     def init_schema(self):
         self.db.init_schema()
@@ -23,9 +139,13 @@ class DbDelegator:
     def save_document(self, text: str):
         self.db.save_document(text)
 
+    def save_documents(self, texts: list[str]) -> int:
+        return self.db.save_documents(texts)
+
     def search_documents(self, search_str: str) -> str:
         return self.db.search_documents(search_str)
 
+
 class DBStub:
     def __init__(self):
         pass
@@ -36,56 +156,169 @@ class DBStub:
     def save_document(self, text: str):
         pass
 
+    def save_documents(self, texts: list[str]) -> int:
+        return 0
+
     def search_documents(self, search_str: str) -> str:
         return ""
 
+
 class DB:
-    def __init__(self):
-        self.conn = psycopg2.connect(
+    def __init__(self, max_connections: int = MAX_CONNECTIONS):
+        from psycopg2.pool import ThreadedConnectionPool
+
+        # pooled so that the daemon can serve several conversations at once
+        self.pool = ThreadedConnectionPool(
+            1,
+            max_connections,
             dbname="genai_documents",
             user="genai",
         )
 
+    @contextlib.contextmanager
+    def cursor(self):
+        """Yields a cursor on a pooled connection, committing when done"""
+        conn = self.pool.getconn()
+        try:
+            with spans.span("postgres"), conn.cursor() as cur:
+                yield cur
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
     def init_schema(self):
-        cur = self.conn.cursor()
-        cur.execute(
-            f"""
-            CREATE TABLE IF NOT EXISTS documents (
-                id SERIAL PRIMARY KEY,
-                text TEXT,
-                embedding VECTOR({embedding.VECTOR_SIZE})
-            );
-
-            CREATE INDEX IF NOT EXISTS documents_embedding_idx ON documents
-            USING ivfflat(embedding vector_l2_ops);
-        """
-        )
-        self.conn.commit()
-        cur.close()
+        with self.cursor() as cur:
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS documents (
+                    id SERIAL PRIMARY KEY,
+                    text TEXT,
+                    embedding VECTOR({embedding.VECTOR_SIZE})
+                );
+
+                ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash TEXT;
+
+                CREATE UNIQUE INDEX IF NOT EXISTS documents_content_hash_idx
+                ON documents (content_hash);
+
+                -- long documents are stored without an embedding, and their
+                -- embedded chunks are stored as rows pointing to them
+                ALTER TABLE documents ADD COLUMN IF NOT EXISTS parent_id INTEGER
+                REFERENCES documents (id) ON DELETE CASCADE;
+
+                ALTER TABLE documents ADD COLUMN IF NOT EXISTS chunk_index INTEGER;
+            """)
 
     def save_document(self, text: str):
-        cur = self.conn.cursor()
-        cur.execute(
-            """
-        INSERT INTO documents (text, embedding)
-        VALUES (%s, %s)
-        """,
-            (text, embedding.generate(text)),
+        self.save_documents([text])
+
+    def save_documents(self, texts: list[str]) -> int:
+        """
+        Saves documents whose content isn't already stored, embedding them in as
+        few requests as possible and inserting them in one transaction.  Returns
+        the number of documents inserted.
+        """
+        from psycopg2.extras import execute_values
+
+        new_documents = {content_hash(text): text for text in texts}
+        with self.cursor() as cur:
+            cur.execute(
+                "SELECT content_hash FROM documents WHERE content_hash = ANY(%s)",
+                (list(new_documents),),
+            )
+            for (existing_hash,) in cur.fetchall():
+                del new_documents[existing_hash]
+
+        if not new_documents:
+            return 0
+
+        hashes = list(new_documents)
+        chunks = {h: embedding.chunk(new_documents[h]) for h in hashes}
+        embeddings = iter(
+            embedding.generate_batch([c for h in hashes for c in chunks[h]])
         )
-        self.conn.commit()
-        cur.close()
+        chunk_embeddings = {h: [next(embeddings) for _ in chunks[h]] for h in hashes}
 
-    def search_documents(self, search_str: str) -> str:
-        cur = self.conn.cursor()
+        with self.cursor() as cur:
+            inserted = execute_values(
+                cur,
+                """
+                INSERT INTO documents (text, embedding, content_hash) VALUES %s
+                ON CONFLICT (content_hash) DO NOTHING
+                RETURNING id, content_hash
+                """,
+                [
+                    (
+                        new_documents[h],
+                        (
+                            _vector(chunk_embeddings[h][0])
+                            if len(chunks[h]) == 1
+                            else None
+                        ),
+                        h,
+                    )
+                    for h in hashes
+                ],
+                template="(%s, %s::vector, %s)",
+                page_size=INSERT_PAGE_SIZE,
+                fetch=True,
+            )
 
+            chunk_rows = [
+                (chunk_text, _vector(chunk_embedding), parent_id, chunk_index)
+                for parent_id, h in inserted
+                if len(chunks[h]) > 1
+                for chunk_index, (chunk_text, chunk_embedding) in enumerate(
+                    zip(chunks[h], chunk_embeddings[h])
+                )
+            ]
+            execute_values(
+                cur,
+                """
+                INSERT INTO documents (text, embedding, parent_id, chunk_index)
+                VALUES %s
+                """,
+                chunk_rows,
+                template="(%s, %s::vector, %s, %s)",
+                page_size=INSERT_PAGE_SIZE,
+            )
+
+        return len(inserted)
+
+    def build_index(
+        self,
+        method: str = "hnsw",
+        lists: Optional[int] = None,
+        m: int = 16,
+        ef_construction: int = 64,
+    ):
+        with self.cursor() as cur:
+            if lists is None:
+                cur.execute(
+                    "SELECT COUNT(*) FROM documents WHERE embedding IS NOT NULL"
+                )
+                (row_count,) = cur.fetchone()
+                lists = default_ivfflat_lists(row_count)
+
+            cur.execute(build_index_sql("documents", method, lists, m, ef_construction))
+
+    def search_documents(self, search_str: str) -> str:
         query_embedding = embedding.generate(search_str)
 
+        # fetch extra rows since several chunks of a document may match
         query = """
-        SELECT id, text
+        SELECT COALESCE(parent_id, id), text
         FROM documents
-        ORDER BY embedding <-> %s::vector
-        LIMIT 10
+        WHERE embedding IS NOT NULL
+        ORDER BY embedding <=> %s::vector
+        LIMIT %s
         """
-        cur.execute(query, (query_embedding,))
-        rows = cur.fetchall()
-        return "\n".join([f"Document ID: {row[0]}\n{row[1]}\n\n" for row in rows])
+        with self.cursor() as cur, spans.span("postgres.search") as span:
+            set_search_parameters(cur)
+            cur.execute(query, (_vector(query_embedding), SEARCH_RESULTS * 3))
+            rows = cur.fetchall()
+            span.set(rows=len(rows))
+
+        return format_results(rows)
@@ -1,28 +1,194 @@
-import openai
-import tiktoken
+import array
+import atexit
+import logging
+import hashlib
+import functools
+import itertools
 
-from typing import Sequence
+from dataclasses import dataclass
+from typing import Iterator, Optional, Sequence
+
+from llmtool import spans
+from llmtool.genai import tokens
+from llmtool.genai.disk_cache import DiskCache
+from llmtool.genai.scheduler import get_scheduler, make_client
 
 VECTOR_SIZE = 1536
 MAX_TOKENS = 8191
 MODEL = "text-embedding-ada-002"
 TOKENIZER = "cl100k_base"
 
+# documents longer than this are embedded as several overlapping chunks
+CHUNK_TOKENS = 512
+CHUNK_OVERLAP_TOKENS = 64
 
-def generate(text: str) -> Sequence[float]:
+# limits on a single embeddings request
+MAX_BATCH_INPUTS = 2048
+MAX_BATCH_BYTES = 1_000_000
+
+CACHE_PATH = "~/tmp/llmtool_embeddings.sqlite"
+CACHE_MAX_ENTRIES = 100_000
+
+
+@dataclass
+class Usage:
+    requests: int = 0
+    tokens: int = 0
+
+
+# embeddings API usage by this process
+usage = Usage()
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    return make_client()
+
+
+def _log_cache_stats(cache: DiskCache):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"embedding cache: {cache.stats()}")
+
+
+@functools.lru_cache(maxsize=None)
+def get_cache() -> DiskCache:
+    cache = DiskCache(CACHE_PATH, CACHE_MAX_ENTRIES)
+    atexit.register(_log_cache_stats, cache)
+    return cache
+
+
+def truncate(text: str) -> str:
+    # every token encodes at least one byte, so short texts can't be over the limit
+    if len(text.encode()) <= MAX_TOKENS:
+        return text
+
+    text_tokens = tokens.encode(text, TOKENIZER)
+    if len(text_tokens) <= MAX_TOKENS:
+        return text
+
+    return tokens.get_encoding(TOKENIZER).decode(text_tokens[:MAX_TOKENS])
+
+
+def chunk_spans(text: str) -> list[tuple[int, int]]:
     """
-    generates openai embeddings from text
+    Byte ranges of the UTF-8 encoding of text which chunk splits it into, so
+    chunks can be stored as ranges of the text instead of copies
     """
+    size = len(text.encode())
+    if size <= CHUNK_TOKENS:
+        return [(0, size)]
 
-    def truncate(text: str) -> str:
-        encoding = tiktoken.get_encoding(TOKENIZER)
-        tokens = encoding.encode(text)
-        truncated_tokens = tokens[:MAX_TOKENS]
-        return encoding.decode(truncated_tokens)
+    text_tokens = tokens.encode(text, TOKENIZER)
+    if len(text_tokens) <= CHUNK_TOKENS:
+        return [(0, size)]
 
-    response = openai.Embedding.create(
-        model=MODEL,
-        input=truncate(text),
+    # byte offset at which each token starts, and the end of the last
+    encoding = tokens.get_encoding(TOKENIZER)
+    offsets = list(
+        itertools.accumulate(
+            (len(token) for token in encoding.decode_tokens_bytes(text_tokens)),
+            initial=0,
+        )
     )
+    step = CHUNK_TOKENS - CHUNK_OVERLAP_TOKENS
+    return [
+        (offsets[start], offsets[min(start + CHUNK_TOKENS, len(text_tokens))])
+        for start in range(0, len(text_tokens) - CHUNK_OVERLAP_TOKENS, step)
+    ]
+
+
+def chunk(text: str) -> list[str]:
+    """
+    Splits text into overlapping chunks of at most CHUNK_TOKENS tokens, encoding
+    it only once
+    """
+    spans = chunk_spans(text)
+    if len(spans) == 1:
+        return [text]
+
+    # a chunk boundary may fall inside a character, as when decoding its tokens
+    data = text.encode()
+    return [data[start:end].decode(errors="replace") for start, end in spans]
+
+
+def cache_key(model: str, text: str) -> str:
+    return model + ":" + hashlib.sha256(text.encode()).hexdigest()
+
+
+def generate(text: str) -> Sequence[float]:
+    """
+    generates openai embeddings from text, reusing embeddings already generated
+    for the same text
+    """
+
+    return generate_batch([text])[0]
+
+
+def generate_batch(texts: Sequence[str]) -> list[Sequence[float]]:
+    """
+    generates embeddings for many texts, sending those not already cached in as
+    few requests as possible
+    """
+
+    texts = [truncate(text) for text in texts]
+    keys = [cache_key(MODEL, text) for text in texts]
+    vectors: list[Optional[Sequence[float]]] = [None] * len(texts)
+
+    cache = get_cache()
+    # indices of the texts with each uncached key, so duplicates are sent once
+    misses: dict[str, list[int]] = {}
+    with spans.span("embedding.cache") as span:
+        for i, key in enumerate(keys):
+            if key in misses:
+                misses[key].append(i)
+                continue
+
+            cached = cache.get(key)
+            if cached is None:
+                misses[key] = [i]
+            else:
+                vectors[i] = array.array("f", cached).tolist()
+        span.set(texts=len(texts), misses=len(misses))
+
+    for batch in _batches([indices[0] for indices in misses.values()], texts):
+        inputs = [texts[i] for i in batch]
+        response = get_scheduler().create(
+            get_client().embeddings,
+            {"model": MODEL, "input": inputs},
+            # rough, and corrected from the usage the response reports
+            sum(len(text) for text in inputs) // 4,
+        )
+        usage.requests += 1
+        usage.tokens += response.usage.total_tokens
+
+        entries = []
+        for i, data in zip(batch, sorted(response.data, key=lambda d: d.index)):
+            for duplicate in misses[keys[i]]:
+                vectors[duplicate] = data.embedding
+            entries.append((keys[i], array.array("f", data.embedding).tobytes()))
+        cache.put_many(entries)
+
+    return vectors
+
+
+def _batches(indices: list[int], texts: Sequence[str]) -> Iterator[list[int]]:
+    """Groups texts into batches within the request's input and size limits"""
+    batch: list[int] = []
+    batch_bytes = 0
+    for i in indices:
+        # byte length bounds token count without tokenizing
+        size = len(texts[i].encode())
+        if batch and (
+            len(batch) >= MAX_BATCH_INPUTS or batch_bytes + size > MAX_BATCH_BYTES
+        ):
+            yield batch
+            batch = []
+            batch_bytes = 0
+
+        batch.append(i)
+        batch_bytes += size
 
-    return response["data"][0]["embedding"]
+    if batch:
+        yield batch
@@ -0,0 +1,282 @@
+"""
+Reading bounded windows of files for the get_file_contents function
+
+Files are memory mapped rather than read, so only the pages around the window
+being returned are touched however large the file is.  Special files, which
+can't be mapped, are read up to the window instead.  Each read returns at
+most READ_MAX_TOKENS tokens, ending at a line break where possible, under a
+header giving the file's size and where to continue from.  Counting a file's
+lines means scanning all of it, so counts are remembered until it changes.
+"""
+
+import os
+import mmap
+import stat
+import threading
+
+from collections import OrderedDict
+from typing import Optional, Union
+
+from llmtool.genai import tokens
+
+# tokens of file content returned by a single read
+READ_MAX_TOKENS = 4000
+# bytes read per token allowed before trimming the window to the budget
+BYTES_PER_TOKEN = 4
+# a NUL byte in this much of the start of a file marks it as binary
+BINARY_SNIFF_BYTES = 8192
+# lines are only counted in files up to this size, since it means reading them
+LINE_COUNT_MAX_BYTES = 256 * 1024 * 1024
+# bytes scanned at a time when counting lines
+SCAN_BLOCK_BYTES = 1024 * 1024
+# files whose line counts are remembered
+LINE_COUNT_CACHE_SIZE = 64
+
+# line counts by file identity, size and modification time
+_line_counts: "OrderedDict[tuple, int]" = OrderedDict()
+_line_counts_lock = threading.Lock()
+
+
+def looks_binary(data: bytes) -> bool:
+    return b"\0" in data[:BINARY_SNIFF_BYTES]
+
+
+def _count_lines(mm: Union[mmap.mmap, bytes], start: int, end: int) -> int:
+    return sum(
+        mm[i : min(i + SCAN_BLOCK_BYTES, end)].count(b"\n")
+        for i in range(start, end, SCAN_BLOCK_BYTES)
+    )
+
+
+def _total_lines(content: Union[mmap.mmap, bytes], version: Optional[tuple]) -> int:
+    """
+    Lines in the content of a file, counting a last line with no line break.
+    Counts are remembered by version, if the file has one.
+    """
+    with _line_counts_lock:
+        if version in _line_counts:
+            _line_counts.move_to_end(version)
+            return _line_counts[version]
+
+    size = len(content)
+    count = _count_lines(content, 0, size) + (content[size - 1] != ord("\n"))
+    if version is not None:
+        with _line_counts_lock:
+            _line_counts[version] = count
+            if len(_line_counts) > LINE_COUNT_CACHE_SIZE:
+                _line_counts.popitem(last=False)
+    return count
+
+
+def _line_offset(mm: Union[mmap.mmap, bytes], line: int) -> int:
+    """Byte offset of the start of a 1-based line, or the file size past the end"""
+    remaining = line - 1
+    position = 0
+    while remaining > 0 and position < len(mm):
+        block = mm[position : position + SCAN_BLOCK_BYTES]
+        count = block.count(b"\n")
+        if count < remaining:
+            remaining -= count
+            position += len(block)
+            continue
+
+        for _ in range(remaining):
+            position = mm.find(b"\n", position) + 1
+        return position
+
+    return len(mm) if remaining > 0 else position
+
+
+def _cut_at_line(data: bytes) -> bytes:
+    end = data.rfind(b"\n")
+    return data[: end + 1] if end >= 0 else data
+
+
+def _fit_to_budget(data: bytes, max_tokens: int) -> tuple[bytes, str]:
+    """Shortens data to whole lines within max_tokens, returning it and its text"""
+    while True:
+        text = data.decode(errors="replace")
+        count = tokens.count(text)
+        if count <= max_tokens:
+            return data, text
+        data = _cut_at_line(data[: len(data) * max_tokens // count])
+
+
+def read_file(
+    path: str,
+    offset: Optional[int] = None,
+    start_line: Optional[int] = None,
+    end_line: Optional[int] = None,
+    max_tokens: int = READ_MAX_TOKENS,
+) -> str:
+    """
+    Reads part of a file, from a byte offset or a 1-based line (the first line
+    by default) up to an inclusive end line or the token budget
+    """
+    with open(os.path.expanduser(path), "rb") as f:
+        status = os.fstat(f.fileno())
+        if stat.S_ISREG(status.st_mode) and status.st_size > 0:
+            version = (
+                status.st_dev,
+                status.st_ino,
+                status.st_size,
+                status.st_mtime_ns,
+            )
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return _read_window(
+                    path, mm, True, offset, start_line, end_line, max_tokens, version
+                )
+
+        # files like /proc/cpuinfo report no size and pipes can't be mapped, so
+        # as much of them as a read could return is read instead
+        limit = max(offset or 0, 0) + max_tokens * BYTES_PER_TOKEN
+        data = f.read(limit + 1)
+
+    if not data:
+        return f"[{path}: empty file]"
+    return _read_window(
+        path, data[:limit], len(data) <= limit, offset, start_line, end_line, max_tokens
+    )
+
+
+def _read_window(
+    path: str,
+    content: Union[mmap.mmap, bytes],
+    complete: bool,
+    offset: Optional[int],
+    start_line: Optional[int],
+    end_line: Optional[int],
+    max_tokens: int,
+    version: Optional[tuple] = None,
+) -> str:
+    """
+    read_file of the content of a file, which is all of it if complete and
+    otherwise its start.  version identifies a regular file as it is now.
+    """
+    size = len(content)
+    if looks_binary(content[:BINARY_SNIFF_BYTES]):
+        return (
+            f"[{path}: binary file of {size} bytes, not shown.  Inspect it "
+            "with a shell command such as file, strings or xxd.]"
+        )
+
+    by_line = offset is None
+    if by_line:
+        start_line = max(start_line or 1, 1)
+        start = _line_offset(content, start_line)
+    else:
+        start = min(max(offset, 0), size)
+
+    end = size
+    if end_line is not None:
+        end = max(_line_offset(content, end_line + 1), start)
+
+    limit = min(end, start + max_tokens * BYTES_PER_TOKEN)
+    data = content[start:limit]
+    if limit < end:
+        data = _cut_at_line(data)
+    data, text = _fit_to_budget(data, max_tokens)
+    stop = start + len(data)
+
+    if not complete:
+        extent = f"over {size} bytes"
+    elif size <= LINE_COUNT_MAX_BYTES:
+        extent = f"{size} bytes, {_total_lines(content, version)} lines"
+    else:
+        extent = f"{size} bytes"
+
+    if by_line:
+        last_line = start_line + data.count(b"\n") - (data.endswith(b"\n"))
+        shown = f"lines {start_line}-{last_line}" if data else "nothing"
+        # a line too long for one read is continued from where it was cut, as is
+        # a file which is only read up to a limit
+        more = (
+            f"start_line={last_line + 1}"
+            if data.endswith(b"\n") and complete
+            else f"offset={stop}"
+        )
+    else:
+        shown = f"bytes {start}-{stop}" if data else "nothing"
+        more = f"offset={stop}"
+
+    header = f"[{path}: {extent}; showing {shown}"
+    if stop < end or (not complete and end_line is None):
+        header += f".  Continue with {more}"
+    return header + "]\n" + text
+
+
+# Allow testing by running this file directly
+if __name__ == "__main__":
+    import tempfile
+    import unittest
+
+    from unittest import mock
+
+    class TestReadFile(unittest.TestCase):
+        def write(self, content: bytes) -> str:
+            f = tempfile.NamedTemporaryFile(delete=False)
+            self.addCleanup(os.unlink, f.name)
+            with f:
+                f.write(content)
+            return f.name
+
+        def test_whole_file(self):
+            path = self.write(b"one\ntwo\nthree")
+            self.assertEqual(
+                read_file(path),
+                f"[{path}: 13 bytes, 3 lines; showing lines 1-3]\none\ntwo\nthree",
+            )
+
+        def test_line_window(self):
+            path = self.write(b"".join(b"line %d\n" % i for i in range(1, 11)))
+            result = read_file(path, start_line=3, end_line=4)
+            header, text = result.split("\n", 1)
+            self.assertEqual(text, "line 3\nline 4\n")
+            self.assertTrue(header.endswith("10 lines; showing lines 3-4]"))
+
+            self.assertTrue(read_file(path, start_line=50).endswith("nothing]\n"))
+
+        def test_offset_window(self):
+            path = self.write(b"0123456789")
+            result = read_file(path, offset=4)
+            self.assertEqual(
+                result, f"[{path}: 10 bytes, 1 lines; showing bytes 4-10]\n456789"
+            )
+
+        def test_token_cap(self):
+            path = self.write(b"".join(b"line %04d\n" % i for i in range(1000)))
+            result = read_file(path, max_tokens=50)
+            header, text = result.split("\n", 1)
+            self.assertLessEqual(tokens.count(text), 50)
+            self.assertTrue(text.startswith("line 0000\n") and text.endswith("\n"))
+            last_line = text.count("\n")
+            self.assertIn(f"Continue with start_line={last_line + 1}]", header)
+
+            following = read_file(path, start_line=last_line + 1, max_tokens=50)
+            self.assertIn(f"line {last_line:04d}\n", following)
+
+        def test_binary_file(self):
+            path = self.write(b"\x7fELF\0\0\0" + b"x" * 100)
+            self.assertTrue(read_file(path).startswith(f"[{path}: binary file of 107"))
+
+        def test_special_file(self):
+            read, write = os.pipe()
+            os.write(write, b"from a pipe\n")
+            os.close(write)
+            result = read_file(f"/dev/fd/{read}")
+            os.close(read)
+            self.assertTrue(result.endswith("]\nfrom a pipe\n"))
+
+        def test_line_count_is_remembered_until_the_file_changes(self):
+            path = self.write(b"a\nb\n")
+            with mock.patch(__name__ + "._count_lines", wraps=_count_lines) as count:
+                self.assertIn("2 lines", read_file(path))
+                self.assertIn("2 lines", read_file(path, start_line=2))
+                self.assertEqual(count.call_count, 1)
+
+                with open(path, "ab") as f:
+                    f.write(b"c\n")
+                self.assertIn("3 lines", read_file(path))
+                self.assertEqual(count.call_count, 2)
+
+    unittest.main()
@@ -3,11 +3,39 @@ Provides facilities for allowing chatgpt to call functions, as well as some defa
 functions
 """
 
-from typing import Union, Callable
+from typing import Iterable, Optional, Sequence, Union, Callable
+from concurrent.futures import ThreadPoolExecutor
 
 import os
+import re
+import sys
+import json
+import logging
+import functools
+import threading
 
-from llmtool.genai import documents
+from llmtool import spans
+from llmtool.genai import documents, file_reader, shell, tokens
+from llmtool.genai.message import BaseMessage, ToolCallsMessage, UserMessage
+
+# tool calls from a single reply which may run at once
+MAX_WORKERS = 8
+
+# groups of functions which --tools may name instead of listing them
+TOOL_PROFILES = {
+    "files": ["get_file_contents", "set_file_contents", "list_directory_files"],
+    "shell": ["execute_shell_command"],
+    "notes": ["create_document", "search_documents"],
+}
+# which functions are offered when nothing else is configured
+DEFAULT_TOOLS = os.getenv("LLMTOOL_TOOLS", "all")
+# per-conversation tool selections, mapping conversation names to --tools values
+TOOLS_CONFIG_PATH = "~/.config/llmtool/tools.json"
+
+logger = logging.getLogger(__name__)
+
+# a path like ~/notes.txt or /etc/hosts in a message suggests the file functions
+PATH_PATTERN = re.compile(r"(?:^|\s)[~.]?/\S")
 
 
 class Function:
@@ -18,12 +46,19 @@ class Function:
         parameters: dict,
         required: list,
         function: Callable,
+        keywords: Sequence[str] = (),
     ):
         self.name = name
         self.description = description
         self.parameters = parameters
         self.required = required
         self.function = function
+        # starts of words in a message which suggest it needs this function
+        self.keyword_pattern = (
+            re.compile(r"\b(?:" + "|".join(keywords) + ")", re.IGNORECASE)
+            if keywords
+            else None
+        )
 
     def __call__(self, **kwargs):
         return self.function(**kwargs)
@@ -38,6 +73,7 @@ class Function:
             return {
                 "type": "object",
                 "properties": self.parameters,
+                "required": self.required,
             }
 
         return {
@@ -46,14 +82,57 @@ class Function:
             "parameters": parameters_json(),
         }
 
+    # Schemas are sent with every request, so they are serialized and counted once
+
+    @functools.cached_property
+    def tool_json(self) -> dict:
+        return {"type": "function", "function": self.to_json()}
+
+    @functools.cached_property
+    def token_count(self) -> int:
+        return tokens.count(json.dumps(self.tool_json))
+
+    def matches(self, text: str) -> bool:
+        return bool(self.keyword_pattern and self.keyword_pattern.search(text))
+
 
 class UnknownFunction(Exception):
     pass
 
 
+def confirm_on_terminal(prompt: str) -> bool:
+    response = input(prompt + " (y/n)")
+    return response.strip() == "y"
+
+
+def echo_on_terminal(text: str):
+    sys.stderr.write(text)
+    sys.stderr.flush()
+
+
 class FunctionHandler:
-    def __init__(self):
+    def __init__(
+        self,
+        confirm: Callable[[str], bool] = confirm_on_terminal,
+        max_workers: int = MAX_WORKERS,
+        echo: Callable[[str], None] = echo_on_terminal,
+    ):
         self.functions = {}
+        # asks the user to approve a function with side effects
+        self.confirm = confirm
+        # shows the user output of functions as they run
+        self.echo = echo
+        # tool calls run concurrently, but prompts to the user must not overlap
+        self.confirm_lock = threading.Lock()
+        self.max_workers = max_workers
+
+    @functools.cached_property
+    def executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def ask(self, prompt: str) -> bool:
+        with self.confirm_lock:
+            return self.confirm(prompt)
 
     def define_function(
         self,
@@ -62,9 +141,10 @@ class FunctionHandler:
         parameters: dict,
         required: list,
         function: Callable,
+        keywords: Sequence[str] = (),
     ):
         self.functions[name] = Function(
-            name, description, parameters, required, function
+            name, description, parameters, required, function, keywords
         )
 
     def handle_function_call(self, name: str, args: dict) -> str:
@@ -72,21 +152,184 @@ class FunctionHandler:
             raise UnknownFunction(f"Unknown chgpt function {name}")
 
         function = self.functions[name]
-        return function(**args)
+        with spans.span("tool." + name) as span:
+            result = function(**args)
+            if spans.active:
+                span.set(result_bytes=len(str(result).encode()))
+        return result
+
+    def handle_tool_call(self, tool_call: dict) -> str:
+        name = tool_call["function"]["name"]
+        try:
+            args = json.loads(tool_call["function"]["arguments"] or "{}")
+        except ValueError as e:
+            return f"Invalid JSON arguments for {name}: {e}"
+        if not isinstance(args, dict):
+            return f"Arguments for {name} must be a JSON object"
 
-    def to_json(self):
-        return [f.to_json() for f in self.functions.values()]
+        try:
+            return str(self.handle_function_call(name, args))
+        except UnknownFunction as e:
+            return str(e)
+        except Exception as e:
+            # the model is told, rather than abandoning the turn with its calls unanswered
+            return f"{name} failed: {e}"
 
+    def handle_tool_call_group(self, tool_calls: list[dict]) -> list[str]:
+        return [self.handle_tool_call(tool_call) for tool_call in tool_calls]
 
-def get_default_handler() -> FunctionHandler:
-    documents_db = documents.DbDelegator()
-    documents_db.init_schema()
+    def handle_tool_calls(self, tool_calls: list[dict]) -> list[str]:
+        """
+        Runs tool calls concurrently, returning their results in order.  Calls
+        naming the same path run one after another, as group_tool_calls groups them.
+        """
+        if len(tool_calls) == 1:
+            return [self.handle_tool_call(tool_calls[0])]
+
+        groups = group_tool_calls(tool_calls)
+        group_results = self.executor.map(
+            self.handle_tool_call_group,
+            [[tool_calls[i] for i in group] for group in groups],
+        )
+        return ungroup_results(groups, group_results)
+
+    def resolve_tools(self, spec: str) -> list[str]:
+        """
+        Names of the functions in a comma separated list of function and profile
+        names, or "all"
+        """
+        names = []
+        for part in spec.split(","):
+            part = part.strip()
+            if part == "all":
+                names.extend(self.functions)
+            elif part in TOOL_PROFILES:
+                names.extend(TOOL_PROFILES[part])
+            elif part in self.functions:
+                names.append(part)
+            elif part:
+                raise UnknownFunction(f"Unknown chgpt function or profile {part}")
+
+        return [name for name in self.functions if name in names]
+
+    def select_functions(
+        self, spec: str, messages: Sequence[BaseMessage]
+    ) -> list[Function]:
+        """
+        Functions to offer the model.  With "auto", those whose keywords appear in
+        the latest user message and those already called in the conversation.
+        """
+        if spec != "auto":
+            return [self.functions[name] for name in self.resolve_tools(spec)]
+
+        text = ""
+        called = set()
+        for message in messages:
+            if isinstance(message, UserMessage):
+                text = message.content
+            elif isinstance(message, ToolCallsMessage):
+                called.update(call["function"]["name"] for call in message.tool_calls)
+
+        return [
+            function
+            for name, function in self.functions.items()
+            if name in called
+            or function.matches(text)
+            or (name in TOOL_PROFILES["files"] and PATH_PATTERN.search(text))
+        ]
+
+    def to_json(self):
+        return [f.to_json() for f in self.functions.values()]
 
-    def get_file_contents(path: str) -> str:
+    def to_tools_json(self):
+        return [f.tool_json for f in self.functions.values()]
+
+
+def _tool_call_path(tool_call: dict) -> Optional[str]:
+    try:
+        args = json.loads(tool_call["function"]["arguments"] or "{}")
+    except ValueError:
+        return None
+    path = args.get("path") if isinstance(args, dict) else None
+    if not isinstance(path, str):
+        return None
+    return os.path.abspath(os.path.expanduser(path))
+
+
+def group_tool_calls(tool_calls: list[dict]) -> list[list[int]]:
+    """
+    Indices of tool calls in groups which may run concurrently.  Calls naming
+    the same path are grouped in the order given, so that a read following a
+    write in a reply sees it and two writes don't interleave.
+    """
+    groups = {}
+    for i, tool_call in enumerate(tool_calls):
+        groups.setdefault(_tool_call_path(tool_call) or i, []).append(i)
+    return list(groups.values())
+
+
+def ungroup_results(
+    groups: list[list[int]], group_results: Iterable[list[str]]
+) -> list[str]:
+    """Results of grouped tool calls in the order the calls were made"""
+    results = [""] * sum(len(group) for group in groups)
+    for group, group_result in zip(groups, group_results):
+        for i, result in zip(group, group_result):
+            results[i] = result
+    return results
+
+
+def check_tools(spec: str):
+    """
+    Raises UnknownFunction if a --tools value names something other than the
+    default functions and their profiles, so it's caught before a turn starts
+    """
+    if spec == "auto":
+        return
+
+    known = {"all", *TOOL_PROFILES}
+    known.update(name for names in TOOL_PROFILES.values() for name in names)
+    for part in spec.split(","):
+        if part.strip() and part.strip() not in known:
+            raise UnknownFunction(f"Unknown chgpt function or profile {part.strip()}")
+
+
+def tools_for_conversation(conversation_name: str) -> str:
+    """The tools configured for a conversation in TOOLS_CONFIG_PATH, if any"""
+    path = os.path.expanduser(TOOLS_CONFIG_PATH)
+    try:
+        with open(path) as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError("expected an object of conversation names")
+        spec = config.get(conversation_name, config.get("default", DEFAULT_TOOLS))
+        if not isinstance(spec, str):
+            raise ValueError(f"expected a string of tools, not {spec!r}")
+        check_tools(spec)
+    except FileNotFoundError:
+        return DEFAULT_TOOLS
+    except (ValueError, UnknownFunction) as e:
+        # a broken config shouldn't stop conversations, which fall back to the default
+        logger.warning(f"Ignoring {path}: {e}")
+        return DEFAULT_TOOLS
+
+    return spec
+
+
+def get_default_handler(
+    documents_db: Optional[documents.DbDelegator] = None,
+) -> FunctionHandler:
+    if documents_db is None:
+        documents_db = documents.DbDelegator()
+
+    def get_file_contents(
+        path: str,
+        offset: Optional[int] = None,
+        start_line: Optional[int] = None,
+        end_line: Optional[int] = None,
+    ) -> str:
         try:
-            expanded_path = os.path.expanduser(path)
-            with open(expanded_path, "r") as f:
-                return f.read()
+            return file_reader.read_file(path, offset, start_line, end_line)
         except IsADirectoryError as e:
             return "That is a directory, not a file.  Try again with a valid path."
         except FileNotFoundError as e:
@@ -105,11 +348,15 @@ def get_default_handler() -> FunctionHandler:
         except FileNotFoundError as e:
             return "That directory does not exist.  Try again with a valid path."
 
-    def execute_shell_command(command: str) -> str:
-        print("executing shell command: " + command)
-        response = input("execute shell command? (y/n)")
-        if response.strip() == "y":
-            return os.popen(command).read()
+    def execute_shell_command(command: str, timeout: Optional[float] = None) -> str:
+        if default_handler.ask(
+            "executing shell command: " + command + "\nexecute shell command?"
+        ):
+            return shell.run_command(
+                command,
+                timeout or shell.DEFAULT_TIMEOUT,
+                echo=default_handler.echo,
+            )
         else:
             return "The user with which you are chatting has declined to execute this command"
 
@@ -123,15 +370,41 @@ def get_default_handler() -> FunctionHandler:
     default_handler = FunctionHandler()
     default_handler.define_function(
         name="get_file_contents",
-        description="Get the contents of a file",
+        description=(
+            "Get the contents of a file.  Large files are returned a part at a "
+            "time, headed by the file's size and how to continue reading"
+        ),
         parameters={
             "path": {
                 "type": "string",
                 "description": "The path to the file",
-            }
+            },
+            "start_line": {
+                "type": "integer",
+                "description": "1-based line to start reading from",
+            },
+            "end_line": {
+                "type": "integer",
+                "description": "last line to read",
+            },
+            "offset": {
+                "type": "integer",
+                "description": "byte offset to start reading from, instead of a line",
+            },
         },
         required=["path"],
         function=get_file_contents,
+        keywords=[
+            "file",
+            "read",
+            "content",
+            "open",
+            "log",
+            "source",
+            "code",
+            "config",
+            "show",
+        ],
     )
 
     default_handler.define_function(
@@ -149,6 +422,17 @@ def get_default_handler() -> FunctionHandler:
         },
         required=["path", "contents"],
         function=set_file_contents,
+        keywords=[
+            "file",
+            "write",
+            "save",
+            "edit",
+            "creat",
+            "chang",
+            "updat",
+            "fix",
+            "append",
+        ],
     )
 
     default_handler.define_function(
@@ -162,19 +446,55 @@ def get_default_handler() -> FunctionHandler:
         },
         required=["path"],
         function=list_directory_files,
+        keywords=[
+            "director",
+            "folder",
+            "dir",
+            "list",
+            "ls",
+            "files",
+            "tree",
+            "project",
+        ],
     )
 
     default_handler.define_function(
         name="execute_shell_command",
-        description="Executes a shell command and returns the output",
+        description=(
+            "Executes a shell command and returns its output and exit code.  Long "
+            "output is shortened to its start and end"
+        ),
         parameters={
             "command": {
                 "type": "string",
                 "description": "The command to execute",
-            }
+            },
+            "timeout": {
+                "type": "number",
+                "description": "seconds after which the command is killed",
+            },
         },
         required=["command"],
         function=execute_shell_command,
+        keywords=[
+            "run",
+            "execut",
+            "command",
+            "shell",
+            "install",
+            "build",
+            "compil",
+            "test",
+            "git",
+            "process",
+            "system",
+            "script",
+            "disk",
+            "memory",
+            "cpu",
+            "package",
+            "servic",
+        ],
     )
 
     default_handler.define_function(
@@ -188,6 +508,7 @@ def get_default_handler() -> FunctionHandler:
         },
         required=["text"],
         function=create_document,
+        keywords=["note", "remember", "record", "appointment", "document", "jot"],
     )
 
     default_handler.define_function(
@@ -201,6 +522,17 @@ def get_default_handler() -> FunctionHandler:
         },
         required=["text"],
         function=search_documents,
+        keywords=[
+            "note",
+            "remember",
+            "recall",
+            "search",
+            "find",
+            "document",
+            "consult",
+            "appointment",
+            "what did",
+        ],
     )
 
     return default_handler
@@ -3,68 +3,596 @@ Persistence of chat history
 """
 
 import os, json
+import logging
+import itertools
+
+from collections import deque
+from typing import Iterator, Optional
 
 from llmtool.genai.message import (
-    ContentMessage,
+    BaseMessage,
     FunctionMessage,
+    FunctionCallResultMessage,
     SystemMessage,
+    ToolCallsMessage,
+    ToolResultMessage,
+    UserMessage,
     message_from_json,
 )
 
-import tiktoken
-
-ENCODING_NAME = "cl100k_base"
+from llmtool import spans
+from llmtool.genai import tokens
 
 
-def count_tokens(msg):
-    if hasattr(msg, "content") and msg.content:
-        encoding = tiktoken.get_encoding(ENCODING_NAME)
-        tokens = encoding.encode(msg.content)
-        return len(tokens)
+def count_tokens(msg) -> int:
+    if isinstance(msg, FunctionMessage):
+        return tokens.count(msg.function_call["name"] + msg.function_call["arguments"])
+    elif isinstance(msg, ToolCallsMessage):
+        return tokens.count(
+            (msg.content or "")
+            + "".join(
+                call["function"]["name"] + call["function"]["arguments"]
+                for call in msg.tool_calls
+            )
+        )
+    elif hasattr(msg, "content") and msg.content:
+        return tokens.count(msg.content)
     else:
         return 0
 
 
+def summary_message(summary: str) -> SystemMessage:
+    return SystemMessage("Summary of the earlier conversation:\n\n" + summary)
+
+
+# the log is rewritten once it holds this many records more than twice the number
+# of live messages
+COMPACTION_SLACK = 200
+
+READ_BLOCK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def _read_lines_reversed(path: str) -> Iterator[bytes]:
+    """Yields the lines of a file from last to first, reading it in blocks"""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        tail = b""
+        while position > 0:
+            size = min(READ_BLOCK_SIZE, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + tail).split(b"\n")
+            tail = lines.pop(0)
+            yield from reversed(lines)
+
+        yield tail
+
+
 class ChatHistory:
-    messages: list[ContentMessage]
+    """
+    Messages in a conversation, along with the token count of each.  Counts are
+    computed once when a message is appended and stored alongside it in the
+    history file, so totals never require re-encoding old messages.
+
+    The history file is an append-only JSONL log.  Each save appends records for
+    new messages, and a watermark record when messages have been truncated from
+    the front.  Every record carries the running token total, so the token count
+    and the last message can be read from the end of the file.  The log is
+    compacted by atomically replacing it once dead records pile up.
+
+    Messages dropped from the front may be replaced by a summary of them, which
+    is sent after the prompt.  It is stored in the watermark record and counted
+    in the token total.
+    """
+
+    messages: deque[BaseMessage]
+    token_counts: deque[int]
 
     def __init__(self, conversation_name: str, prompt: str):
         self.conversation_name = conversation_name
-        self.messages = []
         self.file_path = os.path.expanduser(
+            f"~/tmp/chgpt_hist-{self.conversation_name}.jsonl"
+        )
+        # histories used to be rewritten as a single JSON array
+        self.legacy_file_path = os.path.expanduser(
             f"~/tmp/chgpt_hist-{self.conversation_name}.json"
         )
         self.prompt_message = SystemMessage(prompt)
+        self._reset()
+
+    def _reset(self):
+        self.messages = deque()
+        self.token_counts = deque()
+        self.token_count = 0
+        # absolute index of the first message in self.messages
+        self.start_index = 0
+        # summary of the messages before start_index
+        self.summary: Optional[str] = None
+        self.summary_token_count = 0
+
+        self.loaded = False
+        # state of the log on disk
+        self.persisted_start = 0
+        self.persisted_end = 0
+        self.record_count = 0
+        self.file_signature = None
+
+    def _current_file_signature(self) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+
+        return (stat.st_ino, stat.st_size)
+
+    def has_unsaved_changes(self) -> bool:
+        return (
+            self.start_index != self.persisted_start
+            or self.start_index + len(self.messages) != self.persisted_end
+        )
+
+    def discard_changes(self):
+        """Forgets the messages in memory, so the saved history is read again"""
+        self._reset()
+
+    def is_stale(self) -> bool:
+        """Whether another process has written to the log since we last touched it"""
+        return self.file_signature != self._current_file_signature()
 
     def get_token_count(self) -> int:
-        return sum(count_tokens(msg) for msg in self.messages)
+        return self.token_count + self.summary_token_count
 
     def truncate_by_token_count(self, max_tokens: int):
-        token_count = self.get_token_count()
-        if token_count > max_tokens:
-            diff = token_count - max_tokens
+        with spans.span("history.truncate") as span:
+            dropped = len(self.messages)
             # Remove messages from the beginning of the history until token count is below threshold
-            while diff > 0 and self.messages:
-                msg = self.messages.pop(0)
-                diff -= count_tokens(msg)
+            while self.get_token_count() > max_tokens and self.messages:
+                self.pop_oldest()
+
+            # results whose call was truncated away would be rejected by the API
+            while self.messages and isinstance(
+                self.messages[0], (ToolResultMessage, FunctionCallResultMessage)
+            ):
+                self.pop_oldest()
+            span.set(
+                tokens=self.get_token_count(), dropped=dropped - len(self.messages)
+            )
+
+    def summary_block(self, target_tokens: int) -> int:
+        """
+        Number of the oldest messages to replace with a summary to bring the
+        history down to target_tokens.  Tool calls are kept with their results,
+        and the latest user message and anything after it are never included.
+        """
+        limit = 0
+        for i in range(len(self.messages) - 1, -1, -1):
+            if isinstance(self.messages[i], UserMessage):
+                limit = i
+                break
+
+        count = 0
+        remaining = self.get_token_count()
+        while count < limit and remaining > target_tokens:
+            remaining -= self.token_counts[count]
+            count += 1
+
+        while count < limit and isinstance(
+            self.messages[count], (ToolResultMessage, FunctionCallResultMessage)
+        ):
+            count += 1
+
+        return count
+
+    def replace_oldest_with_summary(self, count: int, summary: str):
+        """Drops the oldest count messages, which summary now covers"""
+        for _ in range(count):
+            self.pop_oldest()
+
+        self.summary = summary
+        self.summary_token_count = count_tokens(summary_message(summary))
+
+    def pop_oldest(self):
+        self.messages.popleft()
+        self.token_count -= self.token_counts.popleft()
+        self.start_index += 1
+
+    def append(self, message, token_count: Optional[int] = None):
+        if token_count is None:
+            token_count = count_tokens(message)
 
-    def append(self, message):
         self.messages.append(message)
+        self.token_counts.append(token_count)
+        self.token_count += token_count
 
     def save(self):
-        # Save updated chat history
-        with open(self.file_path, "w") as f:
-            json.dump([m.to_json() for m in self.messages], f)
+        with spans.span("history.save") as span:
+            if os.path.isfile(self.file_path) and (not self.loaded or self.is_stale()):
+                # we don't know what's in the log, so replace it outright
+                self.compact()
+                return
+
+            end = self.start_index + len(self.messages)
+            first_unsaved = max(self.persisted_end, self.start_index)
+            unsaved = end - first_unsaved
+            total = self.get_token_count() - sum(
+                itertools.islice(self.token_counts, len(self.messages) - unsaved, None)
+            )
+
+            records = []
+            if self.start_index > self.persisted_start:
+                records.append(self._watermark_record(total))
+            for i in range(first_unsaved, end):
+                message = self.messages[i - self.start_index]
+                token_count = self.token_counts[i - self.start_index]
+                total += token_count
+                records.append(
+                    {
+                        "i": i,
+                        "message": message.to_json(),
+                        "token_count": token_count,
+                        "total": total,
+                    }
+                )
+
+            if not records:
+                return
+
+            if (
+                self.record_count + len(records)
+                > 2 * len(self.messages) + COMPACTION_SLACK
+            ):
+                self.compact()
+                return
+
+            # a single write per save; a torn write is dropped when the log is next loaded
+            data = "".join(json.dumps(r) + "\n" for r in records)
+            with open(self.file_path, "a") as f:
+                f.write(data)
+            span.set(records=len(records), bytes=len(data))
+            self._index(records)
+
+            self.persisted_start = self.start_index
+            self.persisted_end = end
+            self.record_count += len(records)
+            self.loaded = True
+            self.file_signature = self._current_file_signature()
+
+    def _index(self, records: list[dict]):
+        """Adds saved records to the search index, which is best effort"""
+        # imported here since sqlite is only needed once something is saved
+        import sqlite3
+
+        from llmtool.genai import history_index
+
+        if not history_index.INDEX_ENABLED:
+            return
+        try:
+            with spans.span("history.index", records=len(records)):
+                history_index.get_index().add_records(self.conversation_name, records)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to index {self.conversation_name}: {e}")
+
+    def _watermark_record(self, total: int) -> dict:
+        record = {"start": self.start_index, "total": total}
+        if self.summary:
+            record["summary"] = self.summary
+            record["summary_token_count"] = self.summary_token_count
+        return record
+
+    def compact(self):
+        """Atomically replaces the log with one holding only the live messages"""
+        with spans.span("history.compact") as span:
+            total = self.summary_token_count
+            records = [self._watermark_record(total)]
+            for i, (message, token_count) in enumerate(
+                zip(self.messages, self.token_counts), self.start_index
+            ):
+                total += token_count
+                records.append(
+                    {
+                        "i": i,
+                        "message": message.to_json(),
+                        "token_count": token_count,
+                        "total": total,
+                    }
+                )
+
+            data = "".join(json.dumps(r) + "\n" for r in records)
+            span.set(records=len(records), bytes=len(data))
+            tmp_path = f"{self.file_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.file_path)
+            self._index(records)
+
+            self.persisted_start = self.start_index
+            self.persisted_end = self.start_index + len(self.messages)
+            self.record_count = len(records)
+            self.loaded = True
+            self.file_signature = self._current_file_signature()
 
     def load(self):
-        if len(self.messages) > 0:
+        with spans.span("history.load") as span:
+            if self.loaded:
+                if self.has_unsaved_changes() or not self.is_stale():
+                    span.set(cached=True)
+                    return self.messages
+
+                # another process has added to the conversation, so read it afresh
+                self._reset()
+
+            if os.path.isfile(self.file_path):
+                self._load_log()
+            elif os.path.isfile(self.legacy_file_path):
+                with open(self.legacy_file_path, "r") as f:
+                    for m in json.load(f):
+                        # histories written before token counts were stored lack them
+                        self.append(message_from_json(m), m.get("token_count"))
+                self.compact()
+
+            self.loaded = True
+            self.file_signature = self._current_file_signature()
+            span.set(messages=len(self.messages), tokens=self.get_token_count())
             return self.messages
 
-        if os.path.isfile(self.file_path):
-            with open(self.file_path, "r") as f:
-                self.messages = list(message_from_json(m) for m in json.load(f))
+    def _load_log(self):
+        entries: deque[tuple[int, dict, int]] = deque()
+        start = 0
+        watermark = {}
+        record_count = 0
+        good_length = 0
 
-        return self.messages
+        with open(self.file_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                good_length += len(line)
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+
+                record_count += 1
+                if "message" in record:
+                    entries.append(
+                        (record["i"], record["message"], record["token_count"])
+                    )
+                else:
+                    start = record["start"]
+                    watermark = record
+                    while entries and entries[0][0] < start:
+                        entries.popleft()
+
+            torn = os.fstat(f.fileno()).st_size > good_length
+
+        if torn:
+            # drop a partially written final record so later appends stay parseable
+            with open(self.file_path, "r+b") as f:
+                f.truncate(good_length)
+
+        for i, message_json, token_count in entries:
+            self.append(message_from_json(message_json), token_count)
+
+        self.start_index = entries[0][0] if entries else start
+        self.summary = watermark.get("summary")
+        self.summary_token_count = watermark.get("summary_token_count", 0)
+        self.persisted_start = start
+        self.persisted_end = self.start_index + len(self.messages)
+        self.record_count = record_count
+
+    def _read_records_reversed(self) -> Iterator[dict]:
+        for line in _read_lines_reversed(self.file_path):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # blank or torn line
+                continue
+
+    def last_message(self, with_content: bool = False) -> Optional[BaseMessage]:
+        """
+        Returns the last message, or the last which has content if with_content,
+        without loading the whole history
+        """
+        if self.loaded or not os.path.isfile(self.file_path):
+            self.load()
+            for message in reversed(self.messages):
+                if not with_content or getattr(message, "content", None):
+                    return message
+            return None
+
+        start = 0
+        for record in self._read_records_reversed():
+            if "message" in record:
+                if record["i"] < start:
+                    return None
+                message = message_from_json(record["message"])
+                if not with_content or getattr(message, "content", None):
+                    return message
+            else:
+                start = max(start, record["start"])
+
+        return None
+
+    def load_token_count(self) -> int:
+        """Returns the token count without loading the whole history"""
+        if self.loaded or not os.path.isfile(self.file_path):
+            self.load()
+            return self.get_token_count()
+
+        for record in self._read_records_reversed():
+            return record["total"]
+
+        return 0
 
     def to_json(self):
-        return [self.prompt_message.to_json()] + [m.to_json() for m in self.messages]
+        head = [self.prompt_message]
+        if self.summary:
+            head.append(summary_message(self.summary))
+        return [m.to_json() for m in head] + [m.to_json() for m in self.messages]
+
+
+class EphemeralChatHistory(ChatHistory):
+    """History of a one-off conversation, which is never read from or written to disk"""
+
+    def save(self):
+        pass
+
+    def load(self):
+        self.loaded = True
+        return self.messages
+
+
+# Allow testing by running this file directly
+if __name__ == "__main__":
+    import random
+    import tempfile
+    import unittest
+
+    from llmtool.genai.message import AssistantMessage
+
+    # saves shouldn't touch the user's search index
+    os.environ["LLMTOOL_HISTORY_INDEX"] = "0"
+
+    class TestChatHistory(unittest.TestCase):
+        def setUp(self):
+            home = tempfile.TemporaryDirectory()
+            self.addCleanup(home.cleanup)
+            os.makedirs(os.path.join(home.name, "tmp"))
+            os.environ["HOME"] = home.name
+
+        def new_history(self) -> ChatHistory:
+            return ChatHistory("test", "prompt")
+
+        def append(self, history: ChatHistory, i: int):
+            # counts are given, so the tokenizer isn't needed
+            message_class = UserMessage if i % 2 == 0 else AssistantMessage
+            history.append(message_class(content=f"message {i}"), 1 + i % 7)
+
+        def assert_matches_disk(self, history: ChatHistory):
+            messages = [m.to_json() for m in history.messages]
+            last = messages[-1] if messages else None
+
+            reloaded = self.new_history()
+            reloaded.load()
+            self.assertEqual([m.to_json() for m in reloaded.messages], messages)
+            self.assertEqual(reloaded.get_token_count(), history.get_token_count())
+            self.assertEqual(reloaded.start_index, history.start_index)
+            self.assertEqual(reloaded.summary, history.summary)
+
+            # read from the end of the log, without loading it
+            last_message = self.new_history().last_message()
+            self.assertEqual(last_message and last_message.to_json(), last)
+            self.assertEqual(
+                self.new_history().load_token_count(), history.get_token_count()
+            )
+
+        def test_round_trip(self):
+            generator = random.Random(0)
+            history = self.new_history()
+            history.load()
+            count = 0
+            for _ in range(500):
+                for _ in range(generator.randint(0, 3)):
+                    self.append(history, count)
+                    count += 1
+                if generator.random() < 0.3:
+                    history.truncate_by_token_count(generator.randint(0, 60))
+                if generator.random() < 0.05 and history.messages:
+                    # as replace_oldest_with_summary, with the summary's count given
+                    history.pop_oldest()
+                    history.summary = f"summary {count}"
+                    history.summary_token_count = 5
+                history.save()
+                self.assert_matches_disk(history)
+
+                if generator.random() < 0.1:
+                    # carry on from what was saved, as a new process would
+                    history = self.new_history()
+                    history.load()
+
+        def test_torn_final_record(self):
+            history = self.new_history()
+            history.load()
+            for i in range(3):
+                self.append(history, i)
+            history.save()
+            with open(history.file_path, "a") as f:
+                f.write('{"i": 3, "message": {"role": "us')
+
+            self.assert_matches_disk(history)
+
+            # the torn record was dropped, so appending after it stays readable
+            reloaded = self.new_history()
+            reloaded.load()
+            self.append(reloaded, 3)
+            reloaded.save()
+            self.assert_matches_disk(reloaded)
+            self.assertEqual(len(reloaded.messages), 4)
+
+        def test_legacy_migration(self):
+            history = self.new_history()
+            with open(history.legacy_file_path, "w") as f:
+                json.dump(
+                    [
+                        {"role": "user", "content": "hello", "token_count": 2},
+                        {"role": "assistant", "content": "hi", "token_count": 1},
+                    ],
+                    f,
+                )
+
+            history.load()
+            self.assertEqual(history.get_token_count(), 3)
+            self.assertTrue(os.path.isfile(history.file_path))
+            self.assert_matches_disk(history)
+
+        def test_reload_when_stale(self):
+            first = self.new_history()
+            first.load()
+            self.append(first, 0)
+            first.save()
+
+            second = self.new_history()
+            second.load()
+            self.append(second, 1)
+            second.save()
+
+            # another process added to the log, so it is read again
+            first.load()
+            self.assertEqual(len(first.messages), 2)
+            self.append(first, 2)
+            first.save()
+            self.assert_matches_disk(first)
+
+        def test_last_message_with_content(self):
+            history = self.new_history()
+            history.load()
+            self.append(history, 0)
+            self.append(history, 1)
+            tool_calls = ToolCallsMessage(
+                tool_calls=[
+                    {
+                        "id": "1",
+                        "type": "function",
+                        "function": {"name": "f", "arguments": "{}"},
+                    }
+                ]
+            )
+            history.append(tool_calls, 3)
+            history.save()
+
+            for loaded in (False, True):
+                reloaded = self.new_history()
+                if loaded:
+                    reloaded.load()
+                self.assertIsNone(reloaded.last_message().content)
+                self.assertEqual(
+                    reloaded.last_message(with_content=True).content, "message 1"
+                )
+
+    unittest.main()
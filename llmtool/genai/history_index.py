@@ -0,0 +1,181 @@
+"""
+Full-text index of the messages of every conversation
+
+ChatHistory.save adds the records it writes, so the index is kept up to date
+without reading history files; `llmtool search --reindex` builds it from them
+once for histories saved before it existed.  User and assistant messages are
+indexed with SQLite FTS5.  Messages stay searchable after they are truncated
+from their conversation.
+"""
+
+import os
+import re
+import glob
+import json
+import time
+import sqlite3
+import functools
+import threading
+
+from typing import NamedTuple, Optional
+
+INDEX_PATH = "~/tmp/llmtool_history_index.sqlite"
+INDEX_ENABLED = os.getenv("LLMTOOL_HISTORY_INDEX", "1") != "0"
+INDEXED_ROLES = ("user", "assistant")
+# words of context shown around matches
+SNIPPET_WORDS = 16
+
+HISTORY_FILE_PATTERN = re.compile(r"chgpt_hist-(.+)\.jsonl?$")
+
+
+class SearchResult(NamedTuple):
+    conversation: str
+    position: int
+    role: str
+    indexed_at: float
+    snippet: str
+
+
+def match_query(text: str) -> str:
+    """An FTS5 query matching messages containing all the words of text"""
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+class HistoryIndex:
+    def __init__(self, path: str = INDEX_PATH):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        self.conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                conversation TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                indexed_at REAL NOT NULL,
+                UNIQUE (conversation, position)
+            );
+
+            -- the text lives in messages; this holds only the full-text index
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content, content='messages', content_rowid='id',
+                tokenize='porter unicode61'
+            );
+
+            CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, content)
+                VALUES (new.id, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content)
+                VALUES ('delete', old.id, old.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content)
+                VALUES ('delete', old.id, old.content);
+                INSERT INTO messages_fts (rowid, content)
+                VALUES (new.id, new.content);
+            END;
+        """)
+
+    def add_records(self, conversation: str, records: list[dict]):
+        """Indexes the message records of a history log"""
+        now = time.time()
+        rows = [
+            (conversation, r["i"], r["message"]["role"], r["message"]["content"], now)
+            for r in records
+            if "message" in r
+            and r["message"]["role"] in INDEXED_ROLES
+            and r["message"].get("content")
+        ]
+        if not rows:
+            return
+
+        with self.lock, self.conn:
+            # unchanged messages, rewritten when a log is compacted, are left alone
+            self.conn.executemany(
+                """
+                INSERT INTO messages (conversation, position, role, content, indexed_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (conversation, position) DO UPDATE
+                SET role = excluded.role, content = excluded.content,
+                    indexed_at = excluded.indexed_at
+                WHERE content != excluded.content
+                """,
+                rows,
+            )
+
+    def search(
+        self,
+        query: str,
+        limit: int = 10,
+        conversation: Optional[str] = None,
+        highlight: tuple[str, str] = ("[", "]"),
+    ) -> list[SearchResult]:
+        """Messages matching an FTS5 query, best first"""
+        sql = """
+            SELECT m.conversation, m.position, m.role, m.indexed_at,
+                   snippet(messages_fts, 0, ?, ?, '...', ?)
+            FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+        """
+        params: list = [*highlight, SNIPPET_WORDS, query]
+        if conversation is not None:
+            sql += " AND m.conversation = ?"
+            params.append(conversation)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+
+        with self.lock:
+            return [SearchResult(*row) for row in self.conn.execute(sql, params)]
+
+    def reindex(self, history_dir: str = "~/tmp") -> int:
+        """Indexes every history file, returning the number of conversations"""
+        paths = glob.glob(os.path.join(os.path.expanduser(history_dir), "chgpt_hist-*"))
+        # a log supersedes the legacy file it was converted from
+        paths.sort(key=lambda path: path.endswith(".jsonl"))
+
+        conversations = set()
+        for path in paths:
+            match = HISTORY_FILE_PATTERN.search(os.path.basename(path))
+            if match is None:
+                continue
+
+            with open(path) as f:
+                if path.endswith(".jsonl"):
+                    records = []
+                    for line in f:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            # a torn write at the end of the log
+                            break
+                else:
+                    records = [
+                        {"i": i, "message": m} for i, m in enumerate(json.load(f))
+                    ]
+
+            self.add_records(match.group(1), records)
+            conversations.add(match.group(1))
+
+        return len(conversations)
+
+    def stats(self) -> dict:
+        with self.lock:
+            (messages,) = self.conn.execute("SELECT COUNT(*) FROM messages").fetchone()
+            (conversations,) = self.conn.execute(
+                "SELECT COUNT(DISTINCT conversation) FROM messages"
+            ).fetchone()
+
+        return {"messages": messages, "conversations": conversations}
+
+
+@functools.lru_cache(maxsize=None)
+def get_index() -> HistoryIndex:
+    return HistoryIndex()
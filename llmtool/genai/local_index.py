@@ -0,0 +1,316 @@
+"""
+File-backed document store and vector index, used when postgres isn't available
+
+Everything lives in one directory:
+
+    vectors   normalized embeddings, one row per embedded text, as raw float32
+              (or float16) values which are memory mapped for search
+    rows      (document id, text offset, text length) of each embedding as int64
+    texts     UTF-8 text of documents, appended back to back
+    documents JSON line per document with its id and content hash
+    meta.json dtype of the vectors file
+
+Each document's text is stored once.  The rows of a long document's chunks
+point at overlapping ranges of it, so a document is the range its rows cover.
+
+Search is a single matrix-vector product over the memory mapped embeddings
+followed by argpartition for the top results.
+"""
+
+import os
+import json
+import fcntl
+import contextlib
+
+import numpy as np
+
+import llmtool.genai.embedding as embedding
+from llmtool.genai import documents
+
+INDEX_PATH = "~/tmp/llmtool_documents"
+# embeddings can be stored as float16 to halve the index size
+DTYPE = os.getenv("LLMTOOL_INDEX_DTYPE", "float32")
+# rows converted to float32 at a time when searching a float16 index
+SEARCH_BLOCK_ROWS = 16384
+
+ROW_FIELDS = 3
+
+
+class LocalDB:
+    def __init__(self, path: str = INDEX_PATH):
+        self.path = os.path.expanduser(path)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @contextlib.contextmanager
+    def _write_lock(self):
+        with open(self._file("lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def init_schema(self):
+        os.makedirs(self.path, exist_ok=True)
+        if not os.path.exists(self._file("meta.json")):
+            with open(self._file("meta.json"), "w") as f:
+                json.dump({"dtype": DTYPE}, f)
+
+        with open(self._file("meta.json")) as f:
+            self.dtype = np.dtype(json.load(f)["dtype"])
+
+    def _row_count(self) -> int:
+        """
+        Number of complete entries.  Rows are written last, so an entry whose
+        write was interrupted has no row and is ignored.
+        """
+        try:
+            size = os.path.getsize(self._file("rows"))
+        except FileNotFoundError:
+            return 0
+
+        return size // (ROW_FIELDS * 8)
+
+    def _load_hashes(self) -> tuple[set[str], int]:
+        hashes = set()
+        document_count = 0
+        if os.path.exists(self._file("documents")):
+            with open(self._file("documents")) as f:
+                for line in f:
+                    try:
+                        document = json.loads(line)
+                    except ValueError:
+                        continue
+                    hashes.add(document["content_hash"])
+                    document_count = max(document_count, document["id"])
+
+        # documents are recorded after their rows, so rows may be ahead of them
+        row_count = self._row_count()
+        if row_count:
+            rows = np.memmap(
+                self._file("rows"),
+                dtype=np.int64,
+                mode="r",
+                shape=(row_count, ROW_FIELDS),
+            )
+            document_count = max(document_count, int(rows[-1][0]))
+
+        return hashes, document_count
+
+    def save_document(self, text: str):
+        self.save_documents([text])
+
+    def save_documents(self, texts: list[str]) -> int:
+        new_documents = {documents.content_hash(text): text for text in texts}
+
+        with self._write_lock():
+            existing, document_count = self._load_hashes()
+            for h in existing & new_documents.keys():
+                del new_documents[h]
+
+            if not new_documents:
+                return 0
+
+            hashes = list(new_documents)
+            encoded = {h: new_documents[h].encode() for h in hashes}
+            spans = {h: embedding.chunk_spans(new_documents[h]) for h in hashes}
+            vectors = np.array(
+                embedding.generate_batch(
+                    [
+                        encoded[h][start:end].decode(errors="replace")
+                        for h in hashes
+                        for start, end in spans[h]
+                    ]
+                ),
+                dtype=np.float32,
+            )
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+            rows = []
+            document_lines = []
+            with open(self._file("texts"), "ab") as texts_file:
+                offset = texts_file.tell()
+                for h in hashes:
+                    document_count += 1
+                    texts_file.write(encoded[h])
+                    document_lines.append(
+                        json.dumps({"id": document_count, "content_hash": h}) + "\n"
+                    )
+                    for start, end in spans[h]:
+                        rows.append((document_count, offset + start, end - start))
+                    offset += len(encoded[h])
+
+            row_count = self._row_count()
+            with open(self._file("vectors"), "r+b" if row_count else "wb") as f:
+                # drop vectors left over from an interrupted write
+                f.truncate(row_count * embedding.VECTOR_SIZE * self.dtype.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(vectors.astype(self.dtype).tobytes())
+            with open(self._file("rows"), "ab") as f:
+                f.write(np.array(rows, dtype=np.int64).tobytes())
+            with open(self._file("documents"), "a") as f:
+                f.write("".join(document_lines))
+
+        return len(hashes)
+
+    def search_documents(self, search_str: str) -> str:
+        count = self._row_count()
+        if count == 0:
+            return ""
+
+        query = np.array(embedding.generate(search_str), dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+
+        vectors = np.memmap(
+            self._file("vectors"),
+            dtype=self.dtype,
+            mode="r",
+            shape=(count, embedding.VECTOR_SIZE),
+        )
+        if self.dtype == np.float32:
+            scores = vectors @ query
+        else:
+            scores = np.concatenate(
+                [
+                    vectors[start : start + SEARCH_BLOCK_ROWS].astype(np.float32)
+                    @ query
+                    for start in range(0, count, SEARCH_BLOCK_ROWS)
+                ]
+            )
+
+        # fetch extra rows since several chunks of a document may match
+        k = min(documents.SEARCH_RESULTS * 3, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        rows = np.memmap(
+            self._file("rows"), dtype=np.int64, mode="r", shape=(count, ROW_FIELDS)
+        )
+        results = []
+        with open(self._file("texts"), "rb") as texts_file:
+            for i in top:
+                document_id, offset, length = (int(v) for v in rows[i])
+                texts_file.seek(offset)
+                # chunks may start or end inside a character, as when they were embedded
+                text = texts_file.read(length).decode(errors="replace")
+                results.append((document_id, text))
+
+        return documents.format_results(results)
+
+
+# Allow testing by running this file directly
+if __name__ == "__main__":
+    import hashlib
+    import tempfile
+    import threading
+    import unittest
+
+    from unittest import mock
+
+    def fake_embedding(text: str) -> list[float]:
+        """A random vector for each text, the same every time it's asked for"""
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        return list(np.random.default_rng(seed).standard_normal(embedding.VECTOR_SIZE))
+
+    class TestLocalDB(unittest.TestCase):
+        def setUp(self):
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            self.path = directory.name
+
+            for name, fake in (
+                ("generate", fake_embedding),
+                ("generate_batch", lambda texts: [fake_embedding(t) for t in texts]),
+            ):
+                patcher = mock.patch.object(embedding, name, fake)
+                patcher.start()
+                self.addCleanup(patcher.stop)
+
+        def open_db(self) -> LocalDB:
+            db = LocalDB(self.path)
+            db.init_schema()
+            return db
+
+        def test_append(self):
+            db = self.open_db()
+            self.assertEqual(db.save_documents(["apples", "pears"]), 2)
+            self.assertEqual(db.save_documents(["pears", "plums"]), 1)
+
+            self.assertEqual(db._row_count(), 3)
+            self.assertEqual(
+                os.path.getsize(db._file("vectors")),
+                3 * embedding.VECTOR_SIZE * db.dtype.itemsize,
+            )
+            self.assertEqual(db._load_hashes()[1], 3)
+
+        def test_search(self):
+            db = self.open_db()
+            db.save_documents(["apples", "pears", "plums"])
+            self.assertTrue(
+                db.search_documents("pears").startswith("Document ID: 2\npears\n")
+            )
+
+        def test_float16_search(self):
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, "meta.json"), "w") as f:
+                json.dump({"dtype": "float16"}, f)
+            db = self.open_db()
+            db.save_documents([f"document {i}" for i in range(10)])
+
+            with mock.patch(__name__ + ".SEARCH_BLOCK_ROWS", 3):
+                result = db.search_documents("document 7")
+            self.assertTrue(result.startswith("Document ID: 8\ndocument 7\n"))
+
+        def test_chunks_point_into_the_document(self):
+            text = " ".join(f"word{i} é" for i in range(200))
+            with mock.patch.object(embedding, "CHUNK_TOKENS", 64), mock.patch.object(
+                embedding, "CHUNK_OVERLAP_TOKENS", 8
+            ):
+                chunks = embedding.chunk(text)
+                db = self.open_db()
+                db.save_documents(["short", text])
+
+            # the document is stored once, however many chunks it has
+            self.assertGreater(len(chunks), 2)
+            self.assertEqual(
+                os.path.getsize(db._file("texts")), len("short") + len(text.encode())
+            )
+            self.assertTrue(
+                db.search_documents(chunks[1]).startswith(
+                    f"Document ID: 2\n{chunks[1]}\n"
+                )
+            )
+
+        def test_concurrent_writers(self):
+            def write(writer: int):
+                db = self.open_db()
+                for i in range(5):
+                    db.save_document(f"writer {writer} document {i}")
+
+            threads = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            db = self.open_db()
+            self.assertEqual(db._row_count(), 20)
+            with open(db._file("documents")) as f:
+                ids = [json.loads(line)["id"] for line in f]
+            self.assertEqual(sorted(ids), list(range(1, 21)))
+
+        def test_interrupted_write_is_ignored(self):
+            db = self.open_db()
+            db.save_documents(["apples"])
+            # vectors and text written, then stopped before the rows were
+            with open(db._file("vectors"), "ab") as f:
+                f.write(b"\0" * embedding.VECTOR_SIZE * db.dtype.itemsize)
+            with open(db._file("texts"), "ab") as f:
+                f.write(b"lost")
+
+            db.save_documents(["pears"])
+            self.assertEqual(db._row_count(), 2)
+            self.assertTrue(
+                db.search_documents("pears").startswith("Document ID: 2\npears\n")
+            )
+
+    unittest.main()
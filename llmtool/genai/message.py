@@ -3,6 +3,7 @@ genai chat message structures and serialization
 """
 
 from dataclasses import dataclass
+from typing import Optional
 
 
 @dataclass
@@ -44,6 +45,13 @@ class FunctionMessage(BaseMessage):
     function_call: dict
     role: str = "function"
 
+    def to_json(self):
+        return {
+            "role": "assistant",
+            "content": None,
+            "function_call": self.function_call,
+        }
+
 
 @dataclass
 class FunctionCallResultMessage(ContentMessage):
@@ -59,13 +67,57 @@ class FunctionCallResultMessage(ContentMessage):
         }
 
 
+@dataclass
+class ToolCallsMessage(BaseMessage):
+    """Assistant message requesting one or more tool calls"""
+
+    tool_calls: list[dict]
+    content: Optional[str] = None
+    role: str = "assistant"
+
+    def to_json(self):
+        return {
+            "role": self.role,
+            "content": self.content,
+            "tool_calls": self.tool_calls,
+        }
+
+
+@dataclass
+class ToolResultMessage(ContentMessage):
+    tool_call_id: str
+    name: str
+    role: str = "tool"
+
+    def to_json(self):
+        return {
+            "role": self.role,
+            "tool_call_id": self.tool_call_id,
+            "name": self.name,
+            "content": self.content,
+        }
+
+
 def message_from_json(message_json: dict) -> BaseMessage:
     if message_json["role"] == "user":
         return UserMessage(content=message_json["content"])
     elif message_json["role"] == "assistant":
+        if message_json.get("tool_calls"):
+            return ToolCallsMessage(
+                tool_calls=message_json["tool_calls"],
+                content=message_json.get("content"),
+            )
+        if message_json.get("function_call"):
+            return FunctionMessage(function_call=message_json["function_call"])
         return AssistantMessage(content=message_json["content"])
     elif message_json["role"] == "system":
         return SystemMessage(content=message_json["content"])
+    elif message_json["role"] == "tool":
+        return ToolResultMessage(
+            tool_call_id=message_json["tool_call_id"],
+            name=message_json["name"],
+            content=message_json["content"],
+        )
     elif message_json["role"] == "function":
         if "content" in message_json:
             return FunctionCallResultMessage(
@@ -20,3 +20,16 @@ a document with a header denoting the date and time, and the body containing the
 you a question to which you don't have an immediate answer, or if I tell you to consult your notes, search the document
 database for supplemental information.
 """
+
+SUMMARIZE = """
+You maintain a running summary of a conversation between a user and an AI
+assistant which controls their linux system, so that the conversation can go on
+once its earliest messages are dropped.  You are given the summary so far, if
+there is one, and the messages which follow it.  Reply with an updated summary
+only.
+
+Keep the facts the assistant will need later: the user's goals and preferences,
+decisions made and their reasons, paths, commands and their notable results,
+and anything left unresolved.  Leave out pleasantries and output which no
+longer matters.  Be concise.
+"""
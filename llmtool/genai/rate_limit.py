@@ -0,0 +1,394 @@
+"""
+Client-side limits on the rate of API requests and tokens
+
+RateLimiter enforces limits given by the user within one event loop.
+SharedRateLimiter tracks the limits the API reports in its response headers,
+in a state file which every llmtool process using the same API key shares.
+"""
+
+import os
+import json
+import time
+import fcntl
+import contextlib
+
+from typing import Mapping, Optional
+
+# tokens assumed for a completion when reserving capacity before a request; the
+# reservation is corrected once the response reports what was actually used
+COMPLETION_TOKENS_ESTIMATE = 256
+
+
+class TokenBucket:
+    """
+    Holds up to capacity units, refilled continuously at capacity per period
+    seconds.  The level may go negative when usage turns out to be higher than
+    was reserved, which delays later takers until it is paid back.
+    """
+
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, capacity: float, period: float = 60.0):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.level = capacity
+        self.updated = self.clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount can be taken, which is 0 if it can be now"""
+        self._refill()
+        # requests larger than the bucket are let through once it is full
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount: float):
+        """Takes amount, or gives it back if negative, up to the capacity"""
+        self._refill()
+        self.level = min(self.capacity, self.level - amount)
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute limits shared by the coroutines
+    of an event loop.  Callers reserve capacity with acquire() before each
+    request and report actual usage with settle() afterwards.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ):
+        # imported here since asyncio is slow to load and most commands are sync
+        import asyncio
+
+        self.requests = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens: int):
+        import asyncio
+
+        # callers are served in turn, so large requests aren't starved by small ones
+        async with self.lock:
+            while True:
+                delay = max(
+                    self.requests.wait_time(1) if self.requests else 0.0,
+                    (self.tokens.wait_time(estimated_tokens) if self.tokens else 0.0),
+                )
+                if delay == 0:
+                    break
+                await asyncio.sleep(delay)
+
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(estimated_tokens)
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        if self.tokens:
+            self.tokens.take(actual_tokens - estimated_tokens)
+
+
+STATE_PATH = "~/tmp/llmtool_ratelimit.json"
+# limits assumed before the API has reported any, from the environment
+DEFAULT_REQUESTS_PER_MINUTE = float(os.getenv("LLMTOOL_RPM", "0")) or None
+DEFAULT_TOKENS_PER_MINUTE = float(os.getenv("LLMTOOL_TPM", "0")) or None
+
+
+class SharedBucket(TokenBucket):
+    """A token bucket on the wall clock, so its state means the same to every process"""
+
+    clock = staticmethod(time.time)
+
+    def to_json(self) -> dict:
+        return {"capacity": self.capacity, "level": self.level, "updated": self.updated}
+
+    @classmethod
+    def from_json(cls, state: dict) -> "SharedBucket":
+        bucket = cls(state["capacity"])
+        bucket.level = state["level"]
+        bucket.updated = state["updated"]
+        return bucket
+
+
+def parse_reset(value: str) -> Optional[float]:
+    """Parses durations like 1s, 6m0s or 120ms from x-ratelimit-reset headers"""
+    seconds = 0.0
+    number = ""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    i = 0
+    while i < len(value):
+        if value[i].isdigit() or value[i] == ".":
+            number += value[i]
+            i += 1
+            continue
+
+        unit = "ms" if value.startswith("ms", i) else value[i]
+        if unit not in units or not number:
+            return None
+        seconds += float(number) * units[unit]
+        number = ""
+        i += len(unit)
+
+    return seconds if not number else None
+
+
+class SharedRateLimiter:
+    """
+    Request and token buckets for each (API key, model), kept in a JSON file
+    which is locked while it is read and updated.  Buckets are sized from the
+    x-ratelimit-limit-* headers of responses, and drained to what the
+    x-ratelimit-remaining-* headers report, so processes which send requests
+    with the same key slow down together before the API starts refusing them.
+    """
+
+    def __init__(self, path: str = STATE_PATH):
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    @contextlib.contextmanager
+    def _state(self):
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path) as f:
+                    state = json.load(f)
+            except (FileNotFoundError, ValueError):
+                state = {}
+
+            yield state
+
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _buckets(state: dict, key: str) -> dict[str, SharedBucket]:
+        buckets = {
+            kind: SharedBucket.from_json(bucket_state)
+            for kind, bucket_state in state.get(key, {}).items()
+        }
+        for kind, default in (
+            ("requests", DEFAULT_REQUESTS_PER_MINUTE),
+            ("tokens", DEFAULT_TOKENS_PER_MINUTE),
+        ):
+            if kind not in buckets and default:
+                buckets[kind] = SharedBucket(default)
+        return buckets
+
+    @staticmethod
+    def _store(state: dict, key: str, buckets: dict[str, SharedBucket]):
+        state[key] = {kind: bucket.to_json() for kind, bucket in buckets.items()}
+
+    def reserve(self, key: str, tokens: int) -> float:
+        """
+        Takes one request and tokens from the buckets and returns 0 if they have
+        room, otherwise takes nothing and returns the seconds to wait first
+        """
+        amounts = {"requests": 1, "tokens": tokens}
+        with self._state() as state:
+            buckets = self._buckets(state, key)
+            delay = max(
+                [bucket.wait_time(amounts[kind]) for kind, bucket in buckets.items()],
+                default=0.0,
+            )
+            if delay == 0:
+                for kind, bucket in buckets.items():
+                    bucket.take(amounts[kind])
+                self._store(state, key, buckets)
+
+        return delay
+
+    def settle(self, key: str, reserved_tokens: int, actual_tokens: int):
+        with self._state() as state:
+            buckets = self._buckets(state, key)
+            if "tokens" in buckets:
+                buckets["tokens"].take(actual_tokens - reserved_tokens)
+                self._store(state, key, buckets)
+
+    def observe(self, key: str, headers: Mapping[str, str]):
+        """Adopts the limits and remaining capacity reported by the API"""
+        with self._state() as state:
+            buckets = self._buckets(state, key)
+            for kind in ("requests", "tokens"):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                if not limit or remaining is None:
+                    continue
+
+                bucket = buckets.get(kind)
+                if bucket is None or bucket.capacity != float(limit):
+                    bucket = buckets[kind] = SharedBucket(float(limit))
+                bucket._refill()
+                bucket.level = min(bucket.level, float(remaining))
+            self._store(state, key, buckets)
+
+    def drain(self, key: str, seconds: float):
+        """Empties the request bucket for seconds after the API refused a request"""
+        with self._state() as state:
+            buckets = self._buckets(state, key)
+            bucket = buckets.get("requests")
+            if bucket is not None:
+                bucket._refill()
+                bucket.level = min(bucket.level, -seconds * bucket.rate + 1)
+                self._store(state, key, buckets)
+
+
+# Allow testing by running this file directly
+if __name__ == "__main__":
+    import asyncio
+    import tempfile
+    import unittest
+
+    from types import SimpleNamespace
+
+    from llmtool.genai.scheduler import BACKOFF_MAX_SECONDS, backoff_delay
+
+    class FakeClock:
+        def __init__(self):
+            self.now = 1000.0
+
+        def __call__(self) -> float:
+            return self.now
+
+    class TestParseReset(unittest.TestCase):
+        def test_durations(self):
+            self.assertEqual(parse_reset("1s"), 1)
+            self.assertEqual(parse_reset("6m0s"), 360)
+            self.assertEqual(parse_reset("1h2m3s"), 3723)
+            self.assertAlmostEqual(parse_reset("120ms"), 0.12)
+            self.assertAlmostEqual(parse_reset("1.5s"), 1.5)
+
+        def test_malformed(self):
+            for value in ("s", "12", "3x", "1s2"):
+                self.assertIsNone(parse_reset(value), value)
+
+    class TestTokenBucket(unittest.TestCase):
+        def setUp(self):
+            self.clock = FakeClock()
+            self.bucket = TokenBucket(60)
+            self.bucket.clock = self.clock
+            self.bucket.updated = self.clock()
+
+        def test_drain_and_refill(self):
+            self.assertEqual(self.bucket.wait_time(60), 0)
+            self.bucket.take(60)
+            # refilled at one unit a second
+            self.assertEqual(self.bucket.wait_time(10), 10)
+            self.clock.now += 4
+            self.assertEqual(self.bucket.wait_time(10), 6)
+            self.clock.now += 1000
+            self.assertEqual(self.bucket.wait_time(10), 0)
+            self.assertEqual(self.bucket.level, 60)
+
+        def test_overdraft_is_paid_back(self):
+            self.bucket.take(50)
+            self.bucket.take(30)
+            self.assertEqual(self.bucket.level, -20)
+            self.assertEqual(self.bucket.wait_time(1), 21)
+
+        def test_refund_is_capped(self):
+            self.bucket.take(10)
+            self.bucket.take(-50)
+            self.assertEqual(self.bucket.level, 60)
+
+        def test_oversized_request_waits_for_a_full_bucket(self):
+            self.bucket.take(30)
+            self.assertEqual(self.bucket.wait_time(500), 30)
+
+    class TestRateLimiter(unittest.TestCase):
+        def test_settle_corrects_the_estimate(self):
+            async def run():
+                limiter = RateLimiter(tokens_per_minute=1000)
+                await limiter.acquire(300)
+                limiter.settle(300, 100)
+                return limiter.tokens.level
+
+            self.assertAlmostEqual(asyncio.run(run()), 900, delta=1)
+
+    class TestSharedRateLimiter(unittest.TestCase):
+        def setUp(self):
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            self.path = os.path.join(directory.name, "state.json")
+
+            self.clock = FakeClock()
+            SharedBucket.clock = self.clock
+            self.addCleanup(setattr, SharedBucket, "clock", staticmethod(time.time))
+
+        def observe(self, limiter: SharedRateLimiter, remaining_tokens: int):
+            limiter.observe(
+                "key",
+                {
+                    "x-ratelimit-limit-requests": "60",
+                    "x-ratelimit-remaining-requests": "60",
+                    "x-ratelimit-limit-tokens": "6000",
+                    "x-ratelimit-remaining-tokens": str(remaining_tokens),
+                },
+            )
+
+        def test_unlimited_until_observed(self):
+            limiter = SharedRateLimiter(self.path)
+            self.assertEqual(limiter.reserve("key", 10**9), 0)
+
+        def test_processes_share_state(self):
+            first = SharedRateLimiter(self.path)
+            second = SharedRateLimiter(self.path)
+            self.observe(first, 1000)
+
+            self.assertEqual(second.reserve("key", 1000), 0)
+            # the first process sees what the second took
+            self.assertEqual(first.reserve("key", 600), 6)
+            self.clock.now += 6
+            self.assertEqual(first.reserve("key", 600), 0)
+
+        def test_observed_remaining_only_lowers_the_level(self):
+            limiter = SharedRateLimiter(self.path)
+            self.observe(limiter, 1000)
+            self.observe(limiter, 5000)
+            self.assertEqual(limiter.reserve("key", 1100), 1)
+
+        def test_settle_and_refund(self):
+            limiter = SharedRateLimiter(self.path)
+            self.observe(limiter, 6000)
+            limiter.reserve("key", 6000)
+            limiter.settle("key", 6000, 0)
+            self.assertEqual(limiter.reserve("key", 6000), 0)
+            limiter.settle("key", 6000, 7000)
+            # a request's worth plus the overdraft of 1000 tokens
+            self.assertAlmostEqual(limiter.reserve("key", 1), 10.01)
+
+        def test_drain(self):
+            limiter = SharedRateLimiter(self.path)
+            self.observe(limiter, 6000)
+            limiter.drain("key", 5)
+            self.assertEqual(limiter.reserve("key", 1), 5)
+
+    class TestBackoff(unittest.TestCase):
+        def test_jitter_is_within_the_ceiling(self):
+            error = Exception()
+            for attempt in range(10):
+                ceiling = min(BACKOFF_MAX_SECONDS, 0.5 * 2**attempt)
+                delays = [backoff_delay(attempt, error) for _ in range(100)]
+                self.assertTrue(all(0 <= delay <= ceiling for delay in delays))
+                self.assertGreater(len(set(delays)), 1)
+
+        def test_retry_after_is_honoured(self):
+            for headers, minimum in (
+                ({"retry-after": "7"}, 7),
+                ({"x-ratelimit-reset-tokens": "1m"}, 60),
+            ):
+                error = Exception()
+                error.response = SimpleNamespace(headers=headers)
+                self.assertGreaterEqual(backoff_delay(0, error), minimum)
+
+    unittest.main()
@@ -0,0 +1,45 @@
+"""
+Opt-in cache of completions, for scripts which send the same request repeatedly
+
+Replies are keyed by the model and a hash of the canonical JSON of the whole
+request, so any change to the prompt, history, message or function schemas is
+a miss.  Only replies with content are cached; replies calling tools are always
+requested, since the tools' results may differ between runs.
+"""
+
+import os
+import json
+import hashlib
+
+from typing import Optional
+
+from llmtool.genai.disk_cache import DiskCache
+from llmtool.genai.message import AssistantMessage
+
+CACHE_PATH = "~/tmp/llmtool_responses.sqlite"
+CACHE_MAX_ENTRIES = 10_000
+# seconds a cached reply is used for
+DEFAULT_TTL = float(os.getenv("LLMTOOL_RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+
+
+def request_key(request: dict) -> str:
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return request["model"] + ":" + hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, ttl: float = DEFAULT_TTL, path: str = CACHE_PATH):
+        self.cache = DiskCache(path, CACHE_MAX_ENTRIES, ttl)
+
+    def get(self, request: dict) -> Optional[AssistantMessage]:
+        value = self.cache.get(request_key(request))
+        if value is None:
+            return None
+        return AssistantMessage(content=value.decode())
+
+    def put(self, request: dict, message: AssistantMessage):
+        self.cache.put(request_key(request), message.content.encode())
+
+    def invalidate_model(self, model: str) -> int:
+        """Drops every reply cached for a model, returning how many there were"""
+        return self.cache.delete_prefix(model + ":")
@@ -0,0 +1,316 @@
+"""
+Sending API requests under rate limits, with retries and hedging
+
+Every request goes through Scheduler.create (or acreate from coroutines), which
+
+  * waits for room in the buckets shared with other llmtool processes, and
+    feeds them the rate limit headers of each response
+  * retries rate limited, timed out and failed requests with jittered
+    exponential backoff, honouring Retry-After
+  * when LLMTOOL_HEDGE is set, sends a second copy of a request which has
+    taken longer than the 95th percentile of recent ones and uses whichever
+    answers first
+
+The openai clients are built with their own retries turned off, so that this
+is the only layer retrying.
+"""
+
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import functools
+import threading
+import concurrent.futures
+
+from collections import deque
+from typing import Any, Optional
+
+from llmtool import spans
+from llmtool.genai.rate_limit import SharedRateLimiter, parse_reset
+
+MAX_ATTEMPTS = 6
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+
+HEDGE = os.getenv("LLMTOOL_HEDGE", "") not in ("", "0")
+# latencies kept per model to estimate the hedging threshold from
+LATENCY_SAMPLES = 200
+# requests to see before hedging, so the threshold means something
+MIN_HEDGE_SAMPLES = 20
+HEDGE_PERCENTILE = 95
+
+logger = logging.getLogger(__name__)
+
+
+def _is_retryable(error: Exception) -> bool:
+    import openai
+
+    if isinstance(error, openai.RateLimitError):
+        # an exhausted quota won't come back by waiting
+        return getattr(error, "code", None) != "insufficient_quota"
+    return isinstance(
+        error,
+        (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError),
+    )
+
+
+def _is_rate_limited(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+
+    headers = response.headers
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    for header in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        if headers.get(header):
+            return parse_reset(headers[header])
+    return None
+
+
+def backoff_delay(attempt: int, error: Exception) -> float:
+    """Full jitter backoff, but never sooner than the API asked for"""
+    ceiling = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt)
+    return max(random.uniform(0, ceiling), _retry_after(error) or 0.0)
+
+
+class LatencyTracker:
+    def __init__(self):
+        self.samples: dict[str, deque[float]] = {}
+        self.lock = threading.Lock()
+
+    def record(self, key: str, seconds: float):
+        with self.lock:
+            self.samples.setdefault(key, deque(maxlen=LATENCY_SAMPLES)).append(seconds)
+
+    def hedge_after(self, key: str) -> Optional[float]:
+        with self.lock:
+            samples = sorted(self.samples.get(key, ()))
+        if len(samples) < MIN_HEDGE_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, len(samples) * HEDGE_PERCENTILE // 100)]
+
+
+class Scheduler:
+    def __init__(
+        self, limiter: Optional[SharedRateLimiter] = None, hedge: bool = HEDGE
+    ):
+        self.limiter = limiter or SharedRateLimiter()
+        self.hedge = hedge
+        self.latencies = LatencyTracker()
+
+    @functools.cached_property
+    def hedge_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        return concurrent.futures.ThreadPoolExecutor(thread_name_prefix="hedge")
+
+    @staticmethod
+    def bucket_key(client, request: dict) -> str:
+        key_hash = hashlib.sha256((client.api_key or "").encode()).hexdigest()[:16]
+        return f"{key_hash}:{request['model']}"
+
+    def _refund(self, key: str, reserved_tokens: int):
+        """Returns the tokens reserved for an attempt which failed or was abandoned"""
+        self.limiter.settle(key, reserved_tokens, 0)
+
+    def _observe(self, key: str, raw, reserved_tokens: int) -> Any:
+        self.limiter.observe(key, raw.headers)
+        response = raw.parse()
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.limiter.settle(key, reserved_tokens, usage.total_tokens)
+        return response
+
+    def _should_hedge(self, request: dict) -> bool:
+        return self.hedge and not request.get("stream")
+
+    @staticmethod
+    def _span(request: dict, estimated_tokens: int):
+        if not spans.active:
+            return spans.NO_SPAN
+        return spans.span(
+            "api.request",
+            model=request["model"],
+            bytes_sent=len(json.dumps(request)),
+            estimated_tokens=estimated_tokens,
+        )
+
+    @staticmethod
+    def _record_usage(span, response):
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            span.set(tokens=usage.total_tokens)
+
+    # Synchronous requests
+
+    def create(self, resource, request: dict, estimated_tokens: int) -> Any:
+        """
+        Calls resource.create(**request), where resource is for example
+        client.chat.completions, returning the parsed response
+        """
+        key = self.bucket_key(resource._client, request)
+        with self._span(request, estimated_tokens) as span:
+            for attempt in range(MAX_ATTEMPTS):
+                span.set(attempts=attempt + 1)
+                with spans.span("api.wait"):
+                    while delay := self.limiter.reserve(key, estimated_tokens):
+                        time.sleep(delay)
+
+                try:
+                    response = self._send(resource, request, key, estimated_tokens)
+                    self._record_usage(span, response)
+                    return response
+                except Exception as e:
+                    if not _is_retryable(e) or attempt == MAX_ATTEMPTS - 1:
+                        raise
+                    delay = backoff_delay(attempt, e)
+                    logger.warning(f"{type(e).__name__}, retrying in {delay:.1f}s")
+                    if _is_rate_limited(e):
+                        # other processes should hold off too
+                        self.limiter.drain(key, delay)
+                    with spans.span("api.backoff"):
+                        time.sleep(delay)
+
+    def _attempt(self, resource, request: dict, key: str, reserved_tokens: int):
+        start = time.monotonic()
+        try:
+            raw = resource.with_raw_response.create(**request)
+        except BaseException:
+            self._refund(key, reserved_tokens)
+            raise
+        self.latencies.record(key, time.monotonic() - start)
+        return self._observe(key, raw, reserved_tokens)
+
+    def _send(self, resource, request: dict, key: str, reserved_tokens: int):
+        hedge_after = self._should_hedge(request) and self.latencies.hedge_after(key)
+        if not hedge_after:
+            return self._attempt(resource, request, key, reserved_tokens)
+
+        attempt = functools.partial(
+            self._attempt, resource, request, key, reserved_tokens
+        )
+        pending = {self.hedge_executor.submit(attempt)}
+        done, _ = concurrent.futures.wait(pending, timeout=hedge_after)
+        # hedges are only sent when there is room for them right away
+        if not done and not self.limiter.reserve(key, reserved_tokens):
+            logger.debug(f"hedging request after {hedge_after:.2f}s")
+            pending.add(self.hedge_executor.submit(attempt))
+
+        # the first to succeed wins; the loser runs to completion, settling its
+        # reservation with what it used
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                if future.exception() is None or not pending:
+                    return future.result()
+
+    # Coroutine requests, for AsyncOpenAI clients
+
+    async def acreate(self, resource, request: dict, estimated_tokens: int) -> Any:
+        """Like create, for the resources of an AsyncOpenAI client"""
+        # imported here since asyncio is slow to load and most commands are sync
+        import asyncio
+
+        key = self.bucket_key(resource._client, request)
+        with self._span(request, estimated_tokens) as span:
+            for attempt in range(MAX_ATTEMPTS):
+                span.set(attempts=attempt + 1)
+                # the state file is locked and rewritten, so it's done off the loop
+                with spans.span("api.wait"):
+                    while delay := await asyncio.to_thread(
+                        self.limiter.reserve, key, estimated_tokens
+                    ):
+                        await asyncio.sleep(delay)
+
+                try:
+                    response = await self._asend(
+                        resource, request, key, estimated_tokens
+                    )
+                    self._record_usage(span, response)
+                    return response
+                except Exception as e:
+                    if not _is_retryable(e) or attempt == MAX_ATTEMPTS - 1:
+                        raise
+                    delay = backoff_delay(attempt, e)
+                    logger.warning(f"{type(e).__name__}, retrying in {delay:.1f}s")
+                    if _is_rate_limited(e):
+                        # other processes should hold off too
+                        await asyncio.to_thread(self.limiter.drain, key, delay)
+                    with spans.span("api.backoff"):
+                        await asyncio.sleep(delay)
+
+    async def _aattempt(self, resource, request: dict, key: str, reserved_tokens: int):
+        import asyncio
+
+        start = time.monotonic()
+        try:
+            raw = await resource.with_raw_response.create(**request)
+        except BaseException:
+            # including cancellation of a hedge which lost
+            await asyncio.to_thread(self._refund, key, reserved_tokens)
+            raise
+        self.latencies.record(key, time.monotonic() - start)
+        return await asyncio.to_thread(self._observe, key, raw, reserved_tokens)
+
+    async def _asend(self, resource, request: dict, key: str, reserved_tokens: int):
+        import asyncio
+
+        hedge_after = self._should_hedge(request) and self.latencies.hedge_after(key)
+        if not hedge_after:
+            return await self._aattempt(resource, request, key, reserved_tokens)
+
+        pending = {
+            asyncio.ensure_future(
+                self._aattempt(resource, request, key, reserved_tokens)
+            )
+        }
+        done, _ = await asyncio.wait(pending, timeout=hedge_after)
+        if not done and not await asyncio.to_thread(
+            self.limiter.reserve, key, reserved_tokens
+        ):
+            logger.debug(f"hedging request after {hedge_after:.2f}s")
+            pending.add(
+                asyncio.ensure_future(
+                    self._aattempt(resource, request, key, reserved_tokens)
+                )
+            )
+
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None or not pending:
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+def make_client(async_: bool = False):
+    """
+    An OpenAI client, or AsyncOpenAI if async_, for requests made through the
+    scheduler.  Its own retries are turned off, since the scheduler retries.
+    """
+    with spans.span("import openai"):
+        from openai import AsyncOpenAI, OpenAI
+
+    client_class = AsyncOpenAI if async_ else OpenAI
+    return client_class(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+
+@functools.lru_cache(maxsize=None)
+def get_scheduler() -> Scheduler:
+    return Scheduler()
@@ -0,0 +1,209 @@
+"""
+Running shell commands for the execute_shell_command function
+
+Output of both streams is read as it is produced, handed to an echo callback so
+the user can watch it, and kept only in part: the first and last
+OUTPUT_MAX_BYTES / 2 bytes.  Commands running past their timeout are killed
+along with anything they started.
+"""
+
+import os
+import time
+import codecs
+import signal
+import selectors
+import subprocess
+
+from typing import Callable, Optional
+
+from llmtool.genai import tokens
+
+DEFAULT_TIMEOUT = float(os.getenv("LLMTOOL_SHELL_TIMEOUT", "120"))
+# output kept for the model, half from the start and half from the end
+OUTPUT_MAX_BYTES = 16 * 1024
+OUTPUT_MAX_TOKENS = 4000
+READ_SIZE = 64 * 1024
+# time given to a timed out command to exit after SIGTERM before it is killed
+KILL_GRACE_SECONDS = 2.0
+
+
+class HeadTailBuffer:
+    """Keeps the first and last max_bytes / 2 bytes written to it"""
+
+    def __init__(self, max_bytes: int):
+        self.half = max_bytes // 2
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, data: bytes):
+        self.total += len(data)
+        room = self.half - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+
+        self.tail += data
+        if len(self.tail) > self.half:
+            del self.tail[: len(self.tail) - self.half]
+
+    @property
+    def omitted(self) -> int:
+        return self.total - len(self.head) - len(self.tail)
+
+
+def _fit_to_tokens(head: str, tail: str, max_tokens: int) -> tuple[str, str]:
+    head_tokens = tokens.encode(head)
+    tail_tokens = tokens.encode(tail)
+    if len(head_tokens) + len(tail_tokens) <= max_tokens:
+        return head, tail
+
+    if not tail_tokens:
+        # output which wasn't cut in the middle is shortened there now
+        tail_tokens = head_tokens
+
+    half = max_tokens // 2
+    encoding = tokens.get_encoding()
+    return (
+        encoding.decode(head_tokens[:half]),
+        encoding.decode(tail_tokens[-half:]) if half else "",
+    )
+
+
+def _kill(process: subprocess.Popen):
+    """Stops the command's whole process group, forcefully if it lingers"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(KILL_GRACE_SECONDS)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def run_command(
+    command: str,
+    timeout: float = DEFAULT_TIMEOUT,
+    echo: Optional[Callable[[str], None]] = None,
+    max_bytes: int = OUTPUT_MAX_BYTES,
+    max_tokens: int = OUTPUT_MAX_TOKENS,
+) -> str:
+    """
+    Runs a command in a shell, returning its combined stdout and stderr (the
+    middle left out if it is long) followed by how it exited
+    """
+    process = subprocess.Popen(
+        command,
+        shell=True,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        # its own process group, so a timeout also stops what it started
+        start_new_session=True,
+    )
+    output = HeadTailBuffer(max_bytes)
+    # output is echoed in pieces, which may split characters
+    echo_decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    deadline = time.monotonic() + timeout
+    timed_out = False
+
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ)
+        fd = process.stdout.fileno()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timed_out = True
+                break
+            if not selector.select(remaining):
+                continue
+
+            data = os.read(fd, READ_SIZE)
+            if not data:
+                break
+            output.write(data)
+            if echo:
+                echo(echo_decoder.decode(data))
+
+    if not timed_out:
+        # a command which closed its output, or left a child holding it open,
+        # may still be running
+        try:
+            process.wait(timeout=max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            timed_out = True
+    if timed_out:
+        _kill(process)
+    process.stdout.close()
+    returncode = process.wait()
+
+    if output.omitted:
+        head = output.head.decode(errors="replace")
+        tail = output.tail.decode(errors="replace")
+    else:
+        head = (output.head + output.tail).decode(errors="replace")
+        tail = ""
+    head, tail = _fit_to_tokens(head, tail, max_tokens)
+
+    omitted = output.total - len(head.encode()) - len(tail.encode())
+    parts = [head]
+    if omitted > 0:
+        parts.append(f"\n[... {omitted} bytes of output omitted ...]\n")
+    parts.append(tail)
+
+    if timed_out:
+        parts.append(f"\n[timed out after {timeout:g}s and was killed]")
+    else:
+        parts.append(f"\n[exit code {returncode}]")
+    return "".join(parts)
+
+
+# Allow testing by running this file directly
+if __name__ == "__main__":
+    import unittest
+
+    class TestHeadTailBuffer(unittest.TestCase):
+        def test_short_output_is_kept(self):
+            buffer = HeadTailBuffer(8)
+            buffer.write(b"abc")
+            self.assertEqual(
+                (buffer.head, buffer.tail, buffer.omitted), (b"abc", b"", 0)
+            )
+
+        def test_middle_is_dropped(self):
+            buffer = HeadTailBuffer(8)
+            for chunk in (b"0123", b"456", b"789ab"):
+                buffer.write(chunk)
+
+            self.assertEqual(buffer.head, b"0123")
+            self.assertEqual(buffer.tail, b"89ab")
+            self.assertEqual(buffer.total, 12)
+            self.assertEqual(buffer.omitted, 4)
+
+    class TestRunCommand(unittest.TestCase):
+        def test_exit_code(self):
+            self.assertEqual(run_command("echo hi"), "hi\n\n[exit code 0]")
+            self.assertTrue(run_command("exit 3").endswith("[exit code 3]"))
+
+        def test_long_output_is_shortened(self):
+            result = run_command("seq 1 100000", max_bytes=100)
+            self.assertTrue(result.startswith("1\n2\n"))
+            self.assertIn("bytes of output omitted", result)
+            self.assertIn("100000\n", result)
+
+        def test_timeout(self):
+            start = time.monotonic()
+            result = run_command("echo started; sleep 10", timeout=0.5)
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertTrue(result.startswith("started\n"))
+            self.assertTrue(result.endswith("[timed out after 0.5s and was killed]"))
+
+        def test_timeout_after_output_is_closed(self):
+            start = time.monotonic()
+            result = run_command("exec 1>&- 2>&-; sleep 10", timeout=0.5)
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertTrue(result.endswith("[timed out after 0.5s and was killed]"))
+
+    unittest.main()
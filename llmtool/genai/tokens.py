@@ -0,0 +1,34 @@
+"""
+Token counting with a tiktoken encoding that is loaded once per process
+"""
+
+import functools
+
+from typing import TYPE_CHECKING
+
+from llmtool import spans
+
+if TYPE_CHECKING:
+    import tiktoken
+
+ENCODING_NAME = "cl100k_base"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(name: str = ENCODING_NAME) -> "tiktoken.Encoding":
+    # imported here since loading tiktoken is slow and not every command counts tokens
+    import tiktoken
+
+    return tiktoken.get_encoding(name)
+
+
+def encode(text: str, encoding_name: str = ENCODING_NAME) -> list[int]:
+    with spans.span("tokenize") as span:
+        # special tokens in user text are counted as plain text rather than rejected
+        encoded = get_encoding(encoding_name).encode(text, disallowed_special=())
+        span.set(chars=len(text), tokens=len(encoded))
+    return encoded
+
+
+def count(text: str, encoding_name: str = ENCODING_NAME) -> int:
+    return len(encode(text, encoding_name))
@@ -0,0 +1,50 @@
+"""
+(Re)builds the document embedding index
+
+    llmtool index [--method hnsw|ivfflat] [--lists N] [--m N] [--ef-construction N]
+
+Run this after loading documents with `llmtool ingest`.  HNSW gives better
+recall for the query time and needs no training data; IVFFlat builds faster and
+smaller, but its lists are trained on the rows present when it is built, so it
+should be rebuilt once the table has grown substantially.
+"""
+
+import sys
+import time
+import argparse
+
+from llmtool.genai.documents import DbDelegator, DB, INDEX_METHODS
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        prog="llmtool index", description="build the document embedding index"
+    )
+    parser.add_argument(
+        "--method", choices=INDEX_METHODS, help="index type", default="hnsw"
+    )
+    parser.add_argument(
+        "--lists",
+        type=int,
+        help="IVFFlat lists, by default based on the number of rows",
+        default=None,
+    )
+    parser.add_argument("--m", type=int, help="HNSW connections per node", default=16)
+    parser.add_argument(
+        "--ef-construction",
+        type=int,
+        help="HNSW candidate list size while building",
+        default=64,
+    )
+    args = parser.parse_args(argv)
+
+    db = DbDelegator().db
+    if not isinstance(db, DB):
+        sys.exit("Indexes are only built for the postgres document database")
+
+    start = time.monotonic()
+    db.build_index(args.method, args.lists, args.m, args.ef_construction)
+    print(
+        f"Built {args.method} index in {time.monotonic() - start:.1f}s",
+        file=sys.stderr,
+    )
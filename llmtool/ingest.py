@@ -0,0 +1,142 @@
+"""
+Bulk loading of files into the document database
+
+    llmtool ingest [--batch-size N] <paths...>
+
+Directories are walked recursively, skipping hidden entries, binary files and
+files which aren't UTF-8.  Each file is stored as one document headed by its
+path.  Documents are embedded and inserted a batch at a time, and content which
+is already stored is skipped.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+from typing import Iterator, Optional
+
+from llmtool.genai import embedding, file_reader
+from llmtool.genai.documents import DbDelegator, DBStub
+
+BATCH_DOCUMENTS = 500
+MAX_FILE_BYTES = 10 * 1024 * 1024
+PROGRESS_INTERVAL = 1.0
+
+
+def iter_files(paths: list[str]) -> Iterator[str]:
+    for path in paths:
+        path = os.path.expanduser(path)
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                if not name.startswith("."):
+                    yield os.path.join(root, name)
+
+
+def read_document(path: str) -> Optional[str]:
+    """Returns the document for a file, or None if it can't be ingested"""
+    try:
+        if os.path.getsize(path) > MAX_FILE_BYTES:
+            return None
+        with open(path, "rb") as f:
+            content = f.read()
+    except OSError:
+        return None
+
+    if file_reader.looks_binary(content):
+        return None
+
+    try:
+        text = content.decode()
+    except UnicodeDecodeError:
+        return None
+
+    if not text.strip():
+        return None
+
+    return f"{path}\n\n{text}"
+
+
+class Progress:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.last_report = 0.0
+        self.files = 0
+        self.inserted = 0
+        self.existing = 0
+        self.skipped = 0
+        self.start_tokens = embedding.usage.tokens
+
+    def report(self, final: bool = False):
+        now = time.monotonic()
+        if not final and now - self.last_report < PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+
+        elapsed = max(now - self.start, 1e-9)
+        documents = self.inserted + self.existing
+        tokens = embedding.usage.tokens - self.start_tokens
+        line = (
+            f"\r{self.files} files: {self.inserted} inserted, "
+            f"{self.existing} already stored, {self.skipped} skipped | "
+            f"{documents / elapsed:.1f} docs/s, {tokens / elapsed:.0f} tokens/s"
+        )
+        if final:
+            cache = embedding.get_cache().stats()
+            line += (
+                f" | embedding cache: {cache['hits']} hits, {cache['misses']} misses"
+            )
+        print(
+            line,
+            end="\n" if final else "",
+            file=sys.stderr,
+            flush=True,
+        )
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        prog="llmtool ingest", description="load files into the document database"
+    )
+    parser.add_argument("paths", nargs="+", help="files or directories to ingest")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="documents embedded and inserted together",
+        default=BATCH_DOCUMENTS,
+    )
+    args = parser.parse_args(argv)
+
+    db = DbDelegator().db
+    if isinstance(db, DBStub):
+        sys.exit("No document database available")
+
+    progress = Progress()
+    batch: list[str] = []
+
+    def flush():
+        inserted = db.save_documents(batch)
+        progress.inserted += inserted
+        progress.existing += len(batch) - inserted
+        batch.clear()
+        progress.report()
+
+    for path in iter_files(args.paths):
+        progress.files += 1
+        document = read_document(path)
+        if document is None:
+            progress.skipped += 1
+            continue
+
+        batch.append(document)
+        if len(batch) >= args.batch_size:
+            flush()
+
+    if batch:
+        flush()
+    progress.report(final=True)
@@ -1,17 +1,43 @@
-import re
 import os
-import tempfile
-import subprocess
-import unittest
+import functools
 
 from dataclasses import dataclass
-from typing import Iterator, Union, Callable
-from typing_extensions import TypeGuard
-
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters import TerminalFormatter
-from pygments.util import ClassNotFound
+from typing import (
+    TYPE_CHECKING,
+    Iterable,
+    Iterator,
+    Optional,
+    Union,
+    Callable,
+)
+
+from llmtool import spans
+
+if TYPE_CHECKING:
+    from pygments.lexer import Lexer
+    from typing_extensions import TypeGuard
+
+# fence languages pygments doesn't know, or only finds after a plugin lookup
+LANGUAGE_ALIASES = {
+    "sh": "bash",
+    "shell": "bash",
+    "zsh": "bash",
+    "py": "python",
+    "py3": "python",
+    "python3": "python",
+    "js": "javascript",
+    "node": "javascript",
+    "ts": "typescript",
+    "yml": "yaml",
+    "patch": "diff",
+    "": "text",
+    "txt": "text",
+    "plaintext": "text",
+}
+# replies with this much code in large blocks highlight them in worker processes
+PARALLEL_MIN_CHARS = 100_000
+# blocks smaller than this are always highlighted in this process
+PARALLEL_BLOCK_MIN_CHARS = 10_000
 
 
 class Error(Exception):
@@ -26,28 +52,95 @@ class SyntaxError(Error):
     pass
 
 
-class SyntaxHighlightingError(Error):
-    """Denotes error in highlighting a code block"""
-
-    pass
-
-
 @dataclass
 class CodeBlock:
     language: str
     code: str
 
     def to_highlighted_string(self) -> str:
-        try:
-            lexer = get_lexer_by_name(self.language)
-            return highlight(self.code, lexer, TerminalFormatter())
-        except ClassNotFound as e:
-            raise SyntaxHighlightingError("Syntax highlighting error: " + str(e))
+        """
+        The code with terminal colors, or as it is if the language is unknown
+        """
+        return highlight_code(self.language, self.code)
+
+    def raw(self) -> str:
+        return "```" + self.language + "\n" + self.code + "```"
+
+
+def resolve_language(language: str) -> str:
+    """Normalizes a fence's info string to a pygments lexer alias"""
+    words = language.split()
+    name = words[0].lower() if words else ""
+    return LANGUAGE_ALIASES.get(name, name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_lexer(language: str) -> Optional["Lexer"]:
+    """A lexer for a fence language, or None if pygments has none"""
+    # pygments is slow to import, so only load it once there's code to highlight
+    from pygments.lexers import get_lexer_by_name
+    from pygments.lexers.special import TextLexer
+    from pygments.util import ClassNotFound
+
+    try:
+        lexer = get_lexer_by_name(resolve_language(language))
+    except ClassNotFound:
+        return None
+    # plain text is left as it is rather than run through the formatter
+    return None if isinstance(lexer, TextLexer) else lexer
+
+
+@functools.lru_cache(maxsize=None)
+def get_formatter():
+    from pygments.formatters import TerminalFormatter
+
+    return TerminalFormatter()
+
+
+def highlight_code(language: str, code: str) -> str:
+    lexer = get_lexer(language)
+    if lexer is None:
+        return code if code.endswith("\n") else code + "\n"
+
+    from pygments import highlight
+
+    with spans.span("highlight", language=language, chars=len(code)):
+        return highlight(code, lexer, get_formatter())
+
+
+def highlight_code_blocks(blocks: list["CodeBlock"]) -> list[str]:
+    """
+    Highlights blocks in order, spreading large ones over worker processes when
+    there is enough code to be worth starting them
+    """
+    large = [i for i, b in enumerate(blocks) if len(b.code) >= PARALLEL_BLOCK_MIN_CHARS]
+    workers = min(len(large), os.cpu_count() or 1)
+    if workers < 2 or sum(len(blocks[i].code) for i in large) < PARALLEL_MIN_CHARS:
+        return [block.to_highlighted_string() for block in blocks]
+
+    import concurrent.futures
+
+    with spans.span("highlight.parallel", blocks=len(large), workers=workers):
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            futures = {
+                i: pool.submit(highlight_code, blocks[i].language, blocks[i].code)
+                for i in large
+            }
+            # the small blocks are done here while the workers get on with the rest
+            return [
+                futures[i].result() if i in futures else block.to_highlighted_string()
+                for i, block in enumerate(blocks)
+            ]
+
+
+def _indent_level(line: str) -> int:
+    return len(line) - len(line.lstrip(" \t"))
 
 
 class MarkdownLine:
     def __init__(self, line: str):
         self.line = line
+        self._indent_level = _indent_level(line)
 
     def raw(self) -> str:
         return self.line
@@ -67,14 +160,108 @@ class MarkdownLine:
 
     def indent_level(self) -> int:
         """Returns the number of whitespace characters at the beginning of the line"""
-        num_whitespace = 0
-        for char in self.line:
-            if char in [" ", "\t"]:
-                num_whitespace += 1
+        return self._indent_level
+
+
+class MarkdownParser:
+    """
+    Push-based markdown parser.  Text is fed in as it arrives, and each node is
+    returned as soon as it is complete: text lines once their newline is seen, code
+    blocks once their closing fence is seen.
+    """
+
+    def __init__(self):
+        # text of the current, unterminated line
+        self._pending: list[str] = []
+        # opening fence of the code block being collected, if any
+        self._fence: Optional[MarkdownLine] = None
+        self._code_lines: list[str] = []
+
+    def feed(self, text: str) -> list[Union[MarkdownLine, CodeBlock]]:
+        newline = text.rfind("\n")
+        if newline == -1:
+            if text:
+                self._pending.append(text)
+            return []
+
+        self._pending.append(text[: newline + 1])
+        complete = "".join(self._pending)
+        rest = text[newline + 1 :]
+        self._pending = [rest] if rest else []
+
+        return self._parse_lines(complete.splitlines())
+
+    def close(self) -> list[Union[MarkdownLine, CodeBlock]]:
+        """Parses any remaining text; the document must not end inside a code block"""
+        remaining = "".join(self._pending)
+        self._pending = []
+        nodes = self._parse_lines(remaining.splitlines())
+        if self._fence is not None:
+            raise SyntaxError("Code block not terminated")
+
+        return nodes
+
+    def flush_raw(self) -> str:
+        """
+        Returns text which has been fed but not yet returned as a node, and resets
+        the parser.  Used to fall back to raw output after a syntax error.
+        """
+        lines = []
+        if self._fence is not None:
+            lines.append(self._fence.raw())
+        lines.extend(self._code_lines)
+        lines.append("".join(self._pending))
+
+        self._pending = []
+        self._fence = None
+        self._code_lines = []
+        return "\n".join(lines)
+
+    def _parse_lines(self, lines: list[str]) -> list[Union[MarkdownLine, CodeBlock]]:
+        nodes: list[Union[MarkdownLine, CodeBlock]] = []
+
+        for i, line in enumerate(lines):
+            if self._fence is None:
+                node = MarkdownLine(line)
+                if node.is_code_fence():
+                    self._fence = node
+                else:
+                    nodes.append(node)
+                continue
+
+            indent = _indent_level(line)
+            if indent < self._fence.indent_level():
+                # keep the rest of the text around for flush_raw
+                self._code_lines.extend(lines[i:])
+                raise SyntaxError("Code block indentation level does not match fence")
+            elif line.startswith("```", indent):
+                nodes.append(self._close_code_block())
             else:
-                break
+                self._code_lines.append(line)
+
+        return nodes
+
+    def _close_code_block(self) -> CodeBlock:
+        assert self._fence is not None
+
+        fence_indent_level = self._fence.indent_level()
+        code_lines = [line[fence_indent_level:] + "\n" for line in self._code_lines]
+        block = CodeBlock(self._fence.code_fence_language(), "".join(code_lines))
+
+        self._fence = None
+        self._code_lines = []
+        return block
+
 
-        return num_whitespace
+def parse_stream(
+    chunks: Iterable[str],
+) -> Iterator[Union[MarkdownLine, CodeBlock]]:
+    """Yields markdown nodes from streamed text as soon as each is complete"""
+    parser = MarkdownParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+
+    yield from parser.close()
 
 
 class MarkdownDocument:
@@ -82,14 +269,20 @@ class MarkdownDocument:
         self.markdown = markdown
 
     def to_highlighted_string(self) -> str:
-        out = ""
-        for node in self.get_nodes():
+        nodes = self.get_nodes()
+        highlighted = iter(
+            highlight_code_blocks([n for n in nodes if isinstance(n, CodeBlock)])
+        )
+
+        out = []
+        for node in nodes:
             if isinstance(node, CodeBlock):
-                out += node.to_highlighted_string() + "\n"
+                out.append(next(highlighted))
             else:
-                out += node.raw() + "\n"
+                out.append(node.raw())
+            out.append("\n")
 
-        return out
+        return "".join(out)
 
     def get_code_blocks(self) -> list[CodeBlock]:
         is_code_block: Callable[
@@ -99,42 +292,7 @@ class MarkdownDocument:
         return list(filter(is_code_block, self.get_nodes()))
 
     def get_nodes(self) -> list[Union[MarkdownLine, CodeBlock]]:
-        within_code_block = False
-        nodes: list[Union[MarkdownLine, CodeBlock]] = []
-
-        def extract_code(
-            lines_iter: Iterator[MarkdownLine], fence_indent_level: int
-        ) -> str:
-            """Consumes the iterator until the end of the code block and returns the code"""
-
-            code = ""
-            for line in lines_iter:
-                if line.indent_level() < fence_indent_level:
-                    raise SyntaxError(
-                        "Code block indentation level does not match fence"
-                    )
-                elif line.is_code_fence():
-                    return code
-                else:
-                    code += line.raw()[fence_indent_level:] + "\n"
-
-            raise SyntaxError("Code block not terminated")
-
-        lines_iter = map(lambda l: MarkdownLine(l), iter(self.markdown.splitlines()))
-
-        for line in lines_iter:
-            if line.is_code_fence():
-                # extract_code consumes the iter, so the for loop will advance to the
-                # end of the code block
-                block = CodeBlock(
-                    line.code_fence_language(),
-                    extract_code(lines_iter, line.indent_level()),
-                )
-                nodes.append(block)
-            else:
-                nodes.append(line)
-
-        return nodes
+        return list(parse_stream([self.markdown]))
 
 
 def extract_code_blocks(markdown: str) -> list[CodeBlock]:
@@ -144,6 +302,7 @@ def extract_code_blocks(markdown: str) -> list[CodeBlock]:
 
 # Allow testing by running this file directly
 if __name__ == "__main__":
+    import unittest
 
     class TestMarkDownProcessor(unittest.TestCase):
         def test_extract_code_blocks(self):
@@ -179,4 +338,50 @@ if __name__ == "__main__":
 
             self.assertEqual(len(blocks), 0)
 
+        def test_parse_stream(self):
+            markdown = "intro\n  ```python\n    x = 1\n  y = 2\n  ```\noutro"
+
+            expected = [n.raw() for n in MarkdownDocument(markdown).get_nodes()]
+            # feeding one character at a time must give the same nodes
+            streamed = [n.raw() for n in parse_stream(iter(markdown))]
+
+            self.assertEqual(streamed, expected)
+            self.assertEqual(
+                expected, ["intro", "```python\n  x = 1\ny = 2\n```", "outro"]
+            )
+
+        def test_parse_stream_unterminated(self):
+            parser = MarkdownParser()
+            self.assertEqual(parser.feed("```sh\nls"), [])
+            self.assertRaises(SyntaxError, parser.close)
+
+        def test_flush_raw_after_indentation_error(self):
+            parser = MarkdownParser()
+            parser.feed("text\n  ```py\n  a = 1\n")
+            parser.feed("b")
+            self.assertRaises(SyntaxError, parser.close)
+            self.assertEqual(parser.flush_raw(), "  ```py\n  a = 1\nb\n")
+
+        def test_resolve_language(self):
+            self.assertEqual(resolve_language("sh"), "bash")
+            self.assertEqual(resolve_language("Python title=x.py"), "python")
+            self.assertEqual(resolve_language(""), "text")
+            self.assertEqual(resolve_language("rust"), "rust")
+
+        def test_unknown_language_is_plain(self):
+            markdown = "```nosuchlanguage\nx = 1\n```\n```python\ny = 2\n```"
+            highlighted = MarkdownDocument(markdown).to_highlighted_string()
+
+            self.assertTrue(highlighted.startswith("x = 1\n"))
+            self.assertIn("\x1b[", highlighted)
+
+        def test_highlight_code_blocks_in_parallel(self):
+            code = "x = 1\n" * (PARALLEL_MIN_CHARS // 6)
+            blocks = [CodeBlock("python", code), CodeBlock("sh", "ls\n")] * 2
+
+            self.assertEqual(
+                highlight_code_blocks(blocks),
+                [block.to_highlighted_string() for block in blocks],
+            )
+
     unittest.main()
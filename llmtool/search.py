@@ -0,0 +1,75 @@
+"""
+Full-text search over the messages of every conversation
+
+    llmtool search [-c CONVERSATION] [-n N] [--fts] <words...>
+    llmtool search --reindex
+
+Results are ranked by relevance and shown as snippets with the matches
+highlighted, each headed by its conversation and position in it.  Words are
+all required; --fts takes an SQLite FTS5 query instead, such as
+`"rate limit" OR backoff`.  --reindex adds conversations saved before the index
+existed.
+"""
+
+import sys
+import time
+import sqlite3
+import argparse
+
+from llmtool.genai.history_index import get_index, match_query
+
+# ANSI bold and reset, around matches in snippets printed to a terminal
+TERMINAL_HIGHLIGHT = ("\x1b[1m", "\x1b[0m")
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        prog="llmtool search", description="search messages of all conversations"
+    )
+    parser.add_argument("query", nargs="*", help="words to search for")
+    parser.add_argument("-c", "--conversation", help="only search this conversation")
+    parser.add_argument("-n", "--limit", type=int, default=10, help="results to show")
+    parser.add_argument(
+        "--fts", help="treat the query as FTS5 query syntax", action="store_true"
+    )
+    parser.add_argument(
+        "--reindex",
+        help="index every conversation's history file, then exit",
+        action="store_true",
+    )
+    args = parser.parse_args(argv)
+
+    index = get_index()
+    if args.reindex:
+        start = time.monotonic()
+        conversations = index.reindex()
+        stats = index.stats()
+        print(
+            f"Indexed {conversations} conversations in "
+            f"{time.monotonic() - start:.1f}s; the index holds {stats['messages']} "
+            f"messages from {stats['conversations']} conversations",
+            file=sys.stderr,
+        )
+        return
+
+    text = " ".join(args.query)
+    if not text.strip():
+        parser.error("a query is required")
+
+    highlight = TERMINAL_HIGHLIGHT if sys.stdout.isatty() else ("[", "]")
+    try:
+        results = index.search(
+            text if args.fts else match_query(text),
+            args.limit,
+            args.conversation,
+            highlight,
+        )
+    except sqlite3.OperationalError as e:
+        sys.exit(f"Invalid query: {e}")
+
+    for result in results:
+        date = time.strftime("%Y-%m-%d", time.localtime(result.indexed_at))
+        print(f"{result.conversation}#{result.position} {result.role} {date}")
+        print("    " + " ".join(result.snippet.split()))
+    if not results:
+        print("No matching messages", file=sys.stderr)
@@ -0,0 +1,141 @@
+"""
+Timing of the phases of a turn
+
+Code marks a phase with
+
+    with spans.span("history.load") as s:
+        ...
+        s.set(messages=len(messages))
+
+Spans are only timed once enable() has been called (the CLI's --profile does)
+or LLMTOOL_TRACE names a file.  Otherwise span() hands back a shared object
+whose methods do nothing, so leaving spans in hot paths is close to free.  Code
+computing costly attributes can check `spans.active` first.
+
+With --profile the total time in each phase is printed when the command ends.
+With LLMTOOL_TRACE every span is appended to the file as a JSON line holding a
+Chrome trace event; `jq -s . trace.jsonl > trace.json` makes a file which
+chrome://tracing or Perfetto can open.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+
+from typing import TextIO
+
+TRACE_PATH = os.getenv("LLMTOOL_TRACE")
+# events buffered before they are appended to the trace, so that long running
+# processes such as the daemon write as they go
+TRACE_FLUSH_EVENTS = 1000
+
+# whether spans are being timed
+active = bool(TRACE_PATH)
+
+_lock = threading.Lock()
+# name: [count, total seconds]
+_totals: dict[str, list] = {}
+_events: list[dict] = []
+_started = time.perf_counter()
+# trace timestamps are on the wall clock, so traces of several processes line up
+_epoch_us = time.time() * 1e6
+
+
+class Span:
+    __slots__ = ("name", "attrs", "start")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __exit__(self, *exc_info):
+        _record(self, time.perf_counter() - self.start)
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def set(self, **attrs):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+def span(name: str, **attrs):
+    return Span(name, attrs) if active else NO_SPAN
+
+
+def _record(span: Span, seconds: float):
+    with _lock:
+        totals = _totals.setdefault(span.name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+        if not TRACE_PATH:
+            return
+        _events.append(
+            {
+                "name": span.name,
+                "ph": "X",
+                "ts": round((span.start - _started) * 1e6 + _epoch_us, 1),
+                "dur": round(seconds * 1e6, 1),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": span.attrs,
+            }
+        )
+        flush = len(_events) >= TRACE_FLUSH_EVENTS
+
+    if flush:
+        write_trace()
+
+
+def enable():
+    global active
+    active = True
+
+
+def report(out: TextIO = sys.stderr):
+    """Prints the time spent in each phase, slowest first"""
+    wall = time.perf_counter() - _started
+    with _lock:
+        rows = sorted(_totals.items(), key=lambda item: -item[1][1])
+
+    print(f"\nprofile: {wall * 1000:.1f}ms wall (phases may nest)", file=out)
+    for name, (count, seconds) in rows:
+        print(
+            f"  {name:32} {seconds * 1000:9.1f}ms {count:6}x "
+            f"{seconds / wall * 100:5.1f}%",
+            file=out,
+        )
+
+
+def write_trace():
+    with _lock:
+        events = list(_events)
+        _events.clear()
+    if not events:
+        return
+
+    with open(os.path.expanduser(TRACE_PATH), "a") as f:
+        f.write("".join(json.dumps(event) + "\n" for event in events))
+
+
+if TRACE_PATH:
+    atexit.register(write_trace)